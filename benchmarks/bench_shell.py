@@ -0,0 +1,452 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Benchmarks for the shell: startup, command discovery, dispatch,
+    completion, token verification and server requests. It also counts the
+    filesystem probes made by imports (and, if strace is available, the
+    stat system calls).
+
+    Usage:
+
+        python benchmarks/bench_shell.py [-o results.json] [--compare old.json] [--quick]
+
+    Results are written as JSON so that runs of different versions can be
+    compared with --compare.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+LIB = os.path.join(HERE, '..', 'lib')
+sys.path.insert(0, LIB)
+
+# keep the benchmarks away from the user's ~/.dt-shell
+HOME = tempfile.mkdtemp(prefix='dts-bench-home-')
+os.environ['HOME'] = HOME
+
+SIZES = [10, 100, 1000]
+DEPTHS = [1, 2, 3]
+
+COMMAND_TEMPLATE = '''
+from dt_shell import DTCommandAbs
+
+
+class DTCommand(DTCommandAbs):
+
+    @staticmethod
+    def command(shell, args):
+        return args
+
+    @staticmethod
+    def complete(shell, word, line):
+        return ['--flag', '--other']
+'''
+
+
+def measure(f, number, repeat):
+    """ Returns statistics (in seconds per call) of `repeat` runs of `number` calls of f. """
+    timer = timeit.Timer(f)
+    times = [t / number for t in timer.repeat(repeat=repeat, number=number)]
+    times.sort()
+    return {
+        'number': number,
+        'repeat': repeat,
+        'min': times[0],
+        'median': times[len(times) // 2],
+        'max': times[-1],
+        'mean': sum(times) / len(times),
+    }
+
+
+def leaf_paths(n, depth):
+    """ Returns n distinct paths of `depth` components, using the smallest fan-out possible. """
+    fanout = 2
+    while fanout ** depth < n:
+        fanout += 1
+    paths = []
+    for i in range(n):
+        digits = []
+        for _ in range(depth):
+            digits.append(i % fanout)
+            i //= fanout
+        paths.append(['c%d' % d for d in reversed(digits)])
+    return paths
+
+
+def create_commands_tree(root, prefix, n, depth):
+    """
+        Creates a synthetic commands repository with n leaf commands at the given depth.
+
+        As in the commands repository, each package imports its children, so
+        that _load_class() can reach `a.b.command.DTCommand` by attribute access.
+    """
+    children = {}
+    for path in leaf_paths(n, depth):
+        path = [prefix + path[0]] + path[1:]
+        for i in range(1, len(path) + 1):
+            children.setdefault(tuple(path[:i - 1]), set()).add(path[i - 1])
+        children.setdefault(tuple(path), set()).add('command')
+
+    for parent, names in children.items():
+        if not parent:
+            continue
+        d = os.path.join(root, *parent)
+        if not os.path.exists(d):
+            os.makedirs(d)
+        with open(os.path.join(d, '__init__.py'), 'w') as f:
+            for name in sorted(names):
+                f.write('from . import %s\n' % name)
+        if len(parent) == 1:
+            open(os.path.join(d, 'installed.flag'), 'w').close()
+        if 'command' in names:
+            with open(os.path.join(d, 'command.py'), 'w') as f:
+                f.write(COMMAND_TEMPLATE)
+    lib = os.path.join(root, 'lib')
+    if not os.path.exists(lib):
+        os.makedirs(lib)
+
+
+def forget_modules(prefix):
+    for k in list(sys.modules):
+        if k.startswith(prefix):
+            del sys.modules[k]
+
+
+def create_shell(commands_path):
+    import dt_shell.cli
+    from dt_shell import DTShell
+
+    os.environ['DTSHELL_COMMANDS'] = commands_path
+    # no network access during the benchmarks
+    dt_shell.cli.check_if_outdated = lambda: None
+    DTShell.check_commands_outdated = lambda self: None
+    return DTShell()
+
+
+def bench_import(quick):
+    """ Time for `import dt_shell` in a fresh interpreter. """
+    code = 'import time; t0 = time.time(); import dt_shell; print(time.time() - t0)'
+    env = dict(os.environ)
+    env['PYTHONPATH'] = LIB
+    times = []
+    for _ in range(3 if quick else 10):
+        out = subprocess.check_output([sys.executable, '-c', code], env=env, stderr=open(os.devnull, 'w'))
+        times.append(float(out.strip()))
+    times.sort()
+    return {
+        'number': 1,
+        'repeat': len(times),
+        'min': times[0],
+        'median': times[len(times) // 2],
+        'max': times[-1],
+        'mean': sum(times) / len(times),
+    }
+
+
+def bench_shell_construction(tmp, quick):
+    root = os.path.join(tmp, 'commands-construction')
+    prefix = 'benchctor_'
+    create_commands_tree(root, prefix, 10, 1)
+
+    def construct():
+        forget_modules(prefix)
+        create_shell(root)
+
+    return measure(construct, number=1 if quick else 5, repeat=3)
+
+
+def bench_discovery(tmp, quick):
+    results = {}
+    shell = None
+    for n in SIZES:
+        if quick and n > 100:
+            continue
+        for depth in DEPTHS:
+            root = os.path.join(tmp, 'commands-%d-%d' % (n, depth))
+            prefix = 'bench%d_%d_' % (n, depth)
+            create_commands_tree(root, prefix, n, depth)
+            if shell is None:
+                shell = create_shell(root)
+            if root not in sys.path:
+                sys.path.insert(0, root)
+
+            number = max(1, 100 // n)
+            get = lambda: shell._get_commands(root)
+            results['_get_commands/n=%d/depth=%d' % (n, depth)] = measure(get, number=number, repeat=3)
+
+            commands = shell._get_commands(root)
+
+            def load():
+                forget_modules(prefix)
+                for cmd, subcmds in commands.items():
+                    shell._load_commands('', cmd, subcmds, 0)
+
+            results['_load_commands/n=%d/depth=%d' % (n, depth)] = measure(load, number=1, repeat=3)
+
+            def load_cached():
+                for cmd, subcmds in commands.items():
+                    shell._load_commands('', cmd, subcmds, 0)
+
+            results['_load_commands_warm/n=%d/depth=%d' % (n, depth)] = measure(load_cached, number=number, repeat=3)
+
+    return results
+
+
+def bench_dispatch(tmp, quick):
+    results = {}
+    n = 100
+    for depth in DEPTHS:
+        root = os.path.join(tmp, 'commands-dispatch-%d' % depth)
+        prefix = 'benchdispatch%d_' % depth
+        create_commands_tree(root, prefix, n, depth)
+        forget_modules(prefix)
+        shell = create_shell(root)
+
+        path = [prefix + 'c0'] + ['c0'] * (depth - 1)
+        top = path[0]
+        line = ' '.join(path[1:] + ['arg1', 'arg2'])
+        do = getattr(shell, 'do_' + top)
+        complete = getattr(shell, 'complete_' + top)
+        number = 1000 if quick else 10000
+
+        results['do_command/depth=%d' % depth] = measure(lambda: do(line), number=number, repeat=3)
+        # completion of a flag of the leaf command walks the whole path
+        full = ' '.join(path) + ' --f'
+        results['complete_command/depth=%d' % depth] = measure(lambda: complete('--f', full, 0, 0),
+                                                                number=number, repeat=3)
+        # completion of the first word, among the n commands
+        results['completenames/depth=%d' % depth] = measure(lambda: shell.completenames(prefix + 'c1'),
+                                                             number=number, repeat=3)
+    return results
+
+
+def bench_verify_token(quick):
+    from dt_shell.duckietown_tokens import DuckietownToken, SAMPLE_TOKEN, verify_token
+    token = DuckietownToken.from_string(SAMPLE_TOKEN)
+    return measure(lambda: verify_token(token), number=20 if quick else 100, repeat=3)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    def answer(self):
+        length = int(self.headers.get('Content-Length', 0) or 0)
+        if length:
+            self.rfile.read(length)
+        body = json.dumps({'ok': True, 'result': {'user_id': -1}})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_DELETE = answer
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def bench_server_request(quick):
+    from dt_shell.remote import make_server_request
+    server = StubServer(('127.0.0.1', 0), StubHandler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    os.environ['DTSERVER'] = 'http://127.0.0.1:%d' % server.server_address[1]
+    try:
+        get = lambda: make_server_request('token', '/info')
+        post = lambda: make_server_request('token', '/submissions', data={'a': 1}, method='POST')
+        number = 50 if quick else 500
+        return {
+            'make_server_request/GET': measure(get, number=number, repeat=3),
+            'make_server_request/POST': measure(post, number=number, repeat=3),
+        }
+    finally:
+        server.shutdown()
+
+
+def count_import_probes(modules, path):
+    """
+        Estimates the number of filesystem probes (stat/open calls) that the
+        Python 2 import system makes to find the given top-level modules by
+        scanning the directories in path, assuming that for each directory it
+        checks for a package and then for each module suffix. This is a
+        model, not a measurement (see count_stat_syscalls()).
+    """
+    import imp
+    per_directory = 1 + len(imp.get_suffixes())
+    probes = 0
+    for name in modules:
+        for d in path:
+            probes += per_directory
+            try:
+                f, _, _ = imp.find_module(name, [d])
+            except ImportError:
+                continue
+            if f is not None:
+                f.close()
+            break
+    return probes
+
+
+def count_stat_syscalls(code, pythonpath):
+    """ Counts the stat-like system calls made by running code, using strace; None if unavailable. """
+    from distutils.spawn import find_executable
+    if find_executable('strace') is None:
+        return None
+    env = dict(os.environ)
+    env['PYTHONPATH'] = pythonpath
+    cmd = ['strace', '-f', '-c', '-e', 'trace=stat,lstat,fstat,newfstatat,open,openat',
+           sys.executable, '-c', code]
+    p = subprocess.Popen(cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    _, err = p.communicate()
+    return parse_strace_total_calls(err)
+
+
+def parse_strace_total_calls(output):
+    """ Returns the total number of calls in the summary of `strace -c`, or None. """
+    # the numbers are right-aligned with their headers; some columns are empty in the total line
+    calls_end = None
+    for line in output.splitlines():
+        if calls_end is None and 'calls' in line.split():
+            calls_end = re.search(r'\bcalls\b', line).end()
+        tokens = line.split()
+        if calls_end is not None and tokens and tokens[-1] == 'total':
+            for m in re.finditer(r'\S+', line):
+                if m.end() == calls_end:
+                    return int(m.group())
+    return None
+
+
+def bench_import_counts(tmp):
+    """
+        Compares the cost of the imports done at startup with the commands
+        prepended to sys.path (as the shell used to do) and with the commands importer.
+    """
+    import dt_shell
+    root = os.path.join(tmp, 'commands-imports')
+    prefix = 'benchimports_'
+    create_commands_tree(root, prefix, 100, 1)
+    lib = os.path.join(root, 'lib')
+    for i in range(20):
+        os.makedirs(os.path.join(lib, 'vendored%d' % i))
+        open(os.path.join(lib, 'vendored%d' % i, '__init__.py'), 'w').close()
+
+    modules = sorted(set(k.split('.')[0] for k in sys.modules
+                         if k and not k.startswith('bench') and k not in sys.builtin_module_names))
+    path = [p for p in sys.path if p not in [root, lib]]
+    counts = {
+        'estimated_import_probes/sys.path_prepend': count_import_probes(modules, [lib, root] + path),
+        'estimated_import_probes/commands_importer': count_import_probes(modules, path),
+    }
+    code = 'import dt_shell, json, xml.dom.minidom, email.mime.text, logging.handlers, decimal'
+    legacy = count_stat_syscalls(code, os.pathsep.join([lib, root, LIB]))
+    current = count_stat_syscalls(code, LIB)
+    if legacy is not None and current is not None:
+        counts['stat_syscalls/sys.path_prepend'] = legacy
+        counts['stat_syscalls/commands_importer'] = current
+    return counts
+
+
+def run_all(quick):
+    import dt_shell
+    tmp = tempfile.mkdtemp(prefix='dts-bench-')
+    devnull = open(os.devnull, 'w')
+    results = {}
+    try:
+        results['import dt_shell'] = bench_import(quick)
+        # commands print their output; keep it out of the report
+        stdout = sys.stdout
+        sys.stdout = devnull
+        try:
+            results['DTShell()'] = bench_shell_construction(tmp, quick)
+            results.update(bench_discovery(tmp, quick))
+            results.update(bench_dispatch(tmp, quick))
+        finally:
+            sys.stdout = stdout
+        results['verify_token'] = bench_verify_token(quick)
+        results.update(bench_server_request(quick))
+        counts = bench_import_counts(tmp)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    return {
+        'version': dt_shell.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+        'quick': quick,
+        'results': results,
+        'counts': counts,
+    }
+
+
+def format_time(t):
+    for unit, scale in [('s', 1.0), ('ms', 1e-3), ('us', 1e-6)]:
+        if t >= scale:
+            return '%8.2f %-2s' % (t / scale, unit)
+    return '%8.2f ns' % (t / 1e-9)
+
+
+def print_report(data, baseline=None):
+    print('duckietown-shell %s, Python %s' % (data['version'], data['python']))
+    for name in sorted(data['results']):
+        median = data['results'][name]['median']
+        line = '%-45s %s' % (name, format_time(median))
+        if baseline is not None and name in baseline['results']:
+            before = baseline['results'][name]['median']
+            line += '   %6.2fx vs %s' % (median / before, baseline['version'])
+        print(line)
+    for name in sorted(data.get('counts', {})):
+        count = data['counts'][name]
+        line = '%-45s %8d' % (name, count)
+        if name.startswith('estimated_'):
+            line += '   (modelled, not measured)'
+        if baseline is not None and name in baseline.get('counts', {}):
+            line += '      was %d in %s' % (baseline['counts'][name], baseline['version'])
+        print(line)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('-o', '--output', help='Write the results to this JSON file.')
+    parser.add_argument('--compare', help='JSON file of a previous run to compare against.')
+    parser.add_argument('--quick', action='store_true', help='Fewer repetitions, smaller trees.')
+    parsed = parser.parse_args(args)
+
+    try:
+        data = run_all(parsed.quick)
+    finally:
+        shutil.rmtree(HOME, ignore_errors=True)
+
+    baseline = None
+    if parsed.compare:
+        with open(parsed.compare) as f:
+            baseline = json.load(f)
+    print_report(data, baseline)
+
+    if parsed.output:
+        with open(parsed.output, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        print('Results written to %s' % parsed.output)
+
+
+if __name__ == '__main__':
+    main()
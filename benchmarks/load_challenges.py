@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Load test of the challenges server clients: N evaluators and M
+    submitters running concurrently, using the functions of dt_shell.remote.
+
+    By default the requests go to a local stub (dt_shell.challenges_stub)
+    started in this process, with optional latency and error injection;
+    use --server to point to another instance of the stub.
+
+    Usage:
+
+        python benchmarks/load_challenges.py [--evaluators 10] [--submitters 5] [--duration 10]
+                                             [--latency 0.01] [--error-rate 0.02] [-o results.json]
+
+    Reports throughput, latency percentiles and error rates per operation.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import sys
+import threading
+import time
+from collections import defaultdict
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+LIB = os.path.join(HERE, '..', 'lib')
+sys.path.insert(0, LIB)
+
+
+class Recorder(object):
+    """ Latencies and errors of each operation, shared by the simulated clients. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(lambda: defaultdict(int))
+
+    def call(self, op, f, *args):
+        """ Calls f(*args), recording its latency; returns (ok, result). """
+        t0 = time.time()
+        try:
+            res = f(*args)
+            ok = True
+        except Exception as e:
+            res = None
+            ok = False
+            kind = type(e).__name__
+        dt = time.time() - t0
+        with self.lock:
+            self.latencies[op].append(dt)
+            if not ok:
+                self.errors[op][kind] += 1
+        return ok, res
+
+    def report(self, elapsed):
+        from dt_shell.history import percentile
+        results = {}
+        for op in sorted(self.latencies):
+            values = sorted(self.latencies[op])
+            n_errors = sum(self.errors[op].values())
+            results[op] = {
+                'requests': len(values),
+                'throughput': len(values) / elapsed,
+                'p50': percentile(values, 50),
+                'p95': percentile(values, 95),
+                'p99': percentile(values, 99),
+                'max': values[-1],
+                'error_rate': float(n_errors) / len(values),
+                'errors': dict(self.errors[op]),
+            }
+        return results
+
+
+def evaluator(recorder, token, i, deadline, eval_time, poll_interval, done):
+    from dt_shell.remote import dtserver_report_job, dtserver_work_submission
+    machine_id = 'load-machine-%d' % i
+    while time.time() < deadline:
+        ok, job = recorder.call('take-submission', dtserver_work_submission, token, None, machine_id, i, 'load')
+        if not ok or not job or job.get('job_id', None) is None:
+            time.sleep(poll_interval)
+            continue
+        time.sleep(eval_time)
+        ok, _ = recorder.call('report-job', dtserver_report_job, token, job['job_id'], 'success',
+                              {'scores': {'score': 1.0}}, machine_id, i, 'load-container', 'load')
+        if ok:
+            done.append(job['job_id'])
+
+
+def submitter(recorder, token, queue, deadline, interval, list_every):
+    from dt_shell.remote import dtserver_get_user_submissions, dtserver_submit, get_dtserver_user_info
+    recorder.call('info', get_dtserver_user_info, token)
+    n = 0
+    while time.time() < deadline:
+        recorder.call('submit', dtserver_submit, token, queue, {'image': 'load/test'})
+        n += 1
+        if n % list_every == 0:
+            recorder.call('list-submissions', dtserver_get_user_submissions, token)
+        time.sleep(interval)
+
+
+def run_load(parsed):
+    from dt_shell.remote import dtserver_update_challenge
+
+    server = None
+    if parsed.server:
+        url = parsed.server
+    else:
+        from dt_shell.challenges_stub import start_challenges_stub
+        kinds = [k for k in parsed.error_kinds.split(',') if k] if parsed.error_kinds else None
+        server, url = start_challenges_stub(latency=parsed.latency, jitter=parsed.jitter,
+                                            error_rate=parsed.error_rate, error_kinds=kinds)
+    os.environ['DTSERVER'] = url
+    queue = 'load-test-queue'
+    recorder = Recorder()
+    recorder.call('challenge-update', dtserver_update_challenge, 'load-admin', queue, {'steps': 1})
+
+    done = []
+    t0 = time.time()
+    deadline = t0 + parsed.duration
+    threads = []
+    for i in range(parsed.evaluators):
+        threads.append(threading.Thread(target=evaluator, args=(recorder, 'load-evaluator-%d' % i, i, deadline,
+                                                                parsed.eval_time, parsed.poll_interval, done)))
+    for i in range(parsed.submitters):
+        threads.append(threading.Thread(target=submitter, args=(recorder, 'load-submitter-%d' % i, queue,
+                                                                deadline, parsed.submit_interval, 10)))
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - t0
+    if server is not None:
+        server.shutdown()
+        server.server_close()
+
+    return {
+        'python': platform.python_version(),
+        'settings': dict((k, v) for k, v in vars(parsed).items() if k != 'output'),
+        'elapsed': elapsed,
+        'jobs_completed': len(done),
+        'operations': recorder.report(elapsed),
+    }
+
+
+def print_report(data):
+    print('%d evaluators, %d submitters, %.1f s; %d jobs completed (%.1f/s)' % (
+        data['settings']['evaluators'], data['settings']['submitters'], data['elapsed'],
+        data['jobs_completed'], data['jobs_completed'] / data['elapsed']))
+    print('')
+    print('%-18s %8s %9s %9s %9s %9s %8s' % ('operation', 'requests', 'req/s', 'p50', 'p95', 'p99', 'errors'))
+    for op, r in sorted(data['operations'].items()):
+        print('%-18s %8d %9.1f %7.1fms %7.1fms %7.1fms %7.1f%%' % (
+            op, r['requests'], r['throughput'], r['p50'] * 1000, r['p95'] * 1000, r['p99'] * 1000,
+            r['error_rate'] * 100))
+    for op, r in sorted(data['operations'].items()):
+        for kind, n in sorted(r['errors'].items()):
+            print('  %s: %d x %s' % (op, n, kind))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--server', help='URL of a running stub (default: start one in this process).')
+    parser.add_argument('--evaluators', type=int, default=10)
+    parser.add_argument('--submitters', type=int, default=5)
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds.')
+    parser.add_argument('--eval-time', type=float, default=0.05, help='Seconds spent on each job.')
+    parser.add_argument('--poll-interval', type=float, default=0.1, help='Seconds between polls with no job.')
+    parser.add_argument('--submit-interval', type=float, default=0.1, help='Seconds between submissions.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Latency added by the stub (seconds).')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Random extra latency of the stub (seconds).')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests failed by the stub.')
+    parser.add_argument('--error-kinds', default=None, help='Comma-separated kinds of injected errors.')
+    parser.add_argument('-o', '--output', help='Write the results to this JSON file.')
+    parsed = parser.parse_args(args)
+
+    data = run_load(parsed)
+    print_report(data)
+    if parsed.output:
+        with open(parsed.output, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        print('Results written to %s' % parsed.output)
+
+
+if __name__ == '__main__':
+    main()
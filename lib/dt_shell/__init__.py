@@ -3,11 +3,15 @@ import logging
 import sys
 import traceback
 
-logging.basicConfig()
-
+# the handlers are installed by cli_main() (see logs.py), not at import;
+# until then (e.g. dt_shell used as a library) the warnings and errors go to stderr
 dtslogger = logging.getLogger('dts')
 dtslogger.setLevel(logging.INFO)
 
+from .logs import FallbackHandler
+
+dtslogger.addHandler(FallbackHandler())
+
 import termcolor
 
 __version__ = '0.2.34'
@@ -17,26 +21,55 @@ from .cli import DTShell
 from .dt_command_abs import DTCommandAbs
 from .dt_command_placeholder import DTCommandPlaceholder
 
-dtslogger.info('duckietown-shell %s' % __version__)
-dtslogger.info(
-        'Please report problems with specific commands at https://github.com/duckietown/duckietown-shell-commands/issues/new')
-dtslogger.info('Please report problems with the shell at https://github.com/duckietown/duckietown-shell/issues/new')
-
 
 def cli_main():
     # TODO: register handler for Ctrl-C
 
     from dt_shell.env_checks import InvalidEnvironment
+    from dt_shell.logs import dump_log_ring, setup_logging
+    from dt_shell.memory import MemoryBudgetExceeded, MemoryTrace, parse_memory_flag
+    from dt_shell.profiling import ProfileSession, parse_profile_flag
+
+    setup_logging()
+    dtslogger.debug('duckietown-shell %s', __version__)
 
-    shell = DTShell()
     arguments = sys.argv[1:]
+    if arguments[:1] == ['cache-server']:
+        from dt_shell.cache_server import cache_server_main
+        cache_server_main(arguments[1:])
+        return
+    if arguments[:1] == ['challenges-stub']:
+        from dt_shell.challenges_stub import challenges_stub_main
+        challenges_stub_main(arguments[1:])
+        return
+
+    # instrumentation flags, in any order before the command
+    try:
+        profile_mode, arguments = parse_profile_flag(arguments)
+        memory_trace, budget, arguments = parse_memory_flag(arguments)
+        if profile_mode is None:
+            profile_mode, arguments = parse_profile_flag(arguments)
+    except ValueError as e:
+        termcolor.cprint(str(e), 'yellow')
+        print('Usage: dts [--profile[=full|sample]] [--memory[=<budget>]] <command ...>')
+        sys.exit(1)
+
+    shell = DTShell()
 
-    known_exceptions = (InvalidEnvironment,)
+    known_exceptions = (InvalidEnvironment, MemoryBudgetExceeded)
 
     try:
         if arguments:
             cmdline = " ".join(arguments)
-            shell.onecmd(cmdline)
+            sessions = []
+            if profile_mode is not None:
+                sessions.append(ProfileSession(cmdline, mode=profile_mode))
+            if memory_trace:
+                sessions.append(MemoryTrace(cmdline, budget=budget))
+            if sessions:
+                shell.run_instrumented(cmdline, sessions)
+            else:
+                shell.onecmd(cmdline)
         else:
             shell.cmdloop()
     except known_exceptions as e:
@@ -46,4 +79,11 @@ def cli_main():
     except Exception as e:
         msg = traceback.format_exc(e)
         termcolor.cprint(msg, 'red')
+        fn = dump_log_ring(msg)
+        if fn is not None:
+            termcolor.cprint('The last log messages are in %s.' % fn, 'red')
+        termcolor.cprint('Please report problems with specific commands at '
+                         'https://github.com/duckietown/duckietown-shell-commands/issues/new', 'red')
+        termcolor.cprint('Please report problems with the shell at '
+                         'https://github.com/duckietown/duckietown-shell/issues/new', 'red')
         sys.exit(2)
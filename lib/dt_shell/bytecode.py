@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+    Precompilation of the commands repository.
+
+    After the commands are installed or updated, all the modules of the
+    commands and of their `lib` are compiled in parallel, so that the first
+    run of the shell does not pay for it.
+
+    If the tree is read-only (shared installations, or DTSHELL_COMMANDS
+    pointing to a read-only mount), Python cannot write the .pyc files next
+    to the sources; in that case they are written to a user-writable
+    directory and loaded from there by the commands importer (see importer.py).
+"""
+from __future__ import print_function
+
+import hashlib
+import imp
+import marshal
+import os
+import py_compile
+import struct
+import sys
+import time
+
+from . import dtslogger
+from .constants import DTShellConstants
+from .local_cache import CacheEntry, cache_get, cache_set, NoCacheAvailable
+
+COMMANDS_LOAD_TIMES = CacheEntry('commands-load-times', types=(dict,))
+
+SKIP_DIRS = ['.git']
+
+
+def get_bytecode_cache_dir(commands_path):
+    """ Returns the user-writable directory used for the bytecode of a read-only tree. """
+    d0 = os.path.expanduser(DTShellConstants.ROOT)
+    h = hashlib.sha1(os.path.realpath(commands_path).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(d0, 'bytecode', h)
+
+
+def is_read_only(commands_path):
+    return os.path.exists(commands_path) and not os.access(commands_path, os.W_OK)
+
+
+def find_sources(commands_path):
+    """ Yields the paths of all the Python files in the tree (including `lib`). """
+    for dirpath, dirnames, filenames in os.walk(commands_path):
+        dirnames[:] = [d for d in dirnames if d not in SKIP_DIRS]
+        for f in filenames:
+            if f.endswith('.py'):
+                yield os.path.join(dirpath, f)
+
+
+def get_cached_bytecode_filename(commands_path, cache_dir, source):
+    rel = os.path.relpath(source, commands_path)
+    return os.path.join(cache_dir, rel + 'c')
+
+
+def _compile_one(job):
+    """ Compiles one file; returns an error message or None. Runs in a worker process. """
+    source, cfile = job
+    try:
+        if cfile is not None:
+            d = os.path.dirname(cfile)
+            if not os.path.exists(d):
+                try:
+                    os.makedirs(d)
+                except OSError:
+                    pass
+        py_compile.compile(source, cfile=cfile, doraise=True)
+    except Exception as e:
+        return '%s: %s' % (source, e)
+    return None
+
+
+class PrecompileReport(object):
+
+    def __init__(self, commands_path, nfiles, errors, elapsed, cache_dir):
+        self.commands_path = commands_path
+        self.nfiles = nfiles
+        self.errors = errors
+        self.elapsed = elapsed
+        self.cache_dir = cache_dir
+
+    def __str__(self):
+        s = 'Precompiled %d modules in %.2f s' % (self.nfiles - len(self.errors), self.elapsed)
+        if self.cache_dir is not None:
+            s += ' (bytecode of the read-only parts in %s)' % self.cache_dir
+        if self.errors:
+            s += '; %d could not be compiled' % len(self.errors)
+        return s
+
+
+def precompile_commands(commands_path, processes=None):
+    """
+        Compiles all the modules of the commands repository using a pool
+        of processes. Returns a PrecompileReport.
+    """
+    t0 = time.time()
+    sources = list(find_sources(commands_path))
+    cache_dir = None
+    if is_read_only(commands_path):
+        cache_dir = get_bytecode_cache_dir(commands_path)
+        jobs = [(s, get_cached_bytecode_filename(commands_path, cache_dir, s)) for s in sources]
+    else:
+        # a writable tree might still contain read-only directories
+        jobs = []
+        for s in sources:
+            if os.access(os.path.dirname(s), os.W_OK):
+                jobs.append((s, None))
+            else:
+                if cache_dir is None:
+                    cache_dir = get_bytecode_cache_dir(commands_path)
+                jobs.append((s, get_cached_bytecode_filename(commands_path, cache_dir, s)))
+
+    results = _run_jobs(jobs, processes)
+    errors = [r for r in results if r is not None]
+    for e in errors:
+        dtslogger.debug('Could not compile %s', e)
+    report = PrecompileReport(commands_path, len(jobs), errors, time.time() - t0, cache_dir)
+    mark_commands_changed(commands_path)
+    return report
+
+
+def _run_jobs(jobs, processes):
+    if len(jobs) < 2 or processes == 1:
+        return [_compile_one(j) for j in jobs]
+    try:
+        from multiprocessing import Pool
+        pool = Pool(processes)
+    except (ImportError, OSError, NotImplementedError) as e:
+        dtslogger.debug('Cannot create process pool (%s); compiling serially.', e)
+        return [_compile_one(j) for j in jobs]
+    try:
+        return pool.map(_compile_one, jobs, chunksize=16)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def find_cached_module(commands_path, cache_dir, d, name):
+    """
+        Looks for module `name` in directory d of the tree; returns a
+        BytecodeLoader if its bytecode in cache_dir is up to date, else None.
+    """
+    pkg_init = os.path.join(d, name, '__init__.py')
+    if os.path.isfile(pkg_init):
+        source, is_package = pkg_init, True
+    else:
+        source, is_package = os.path.join(d, name + '.py'), False
+        if not os.path.isfile(source):
+            return None
+    cfile = get_cached_bytecode_filename(commands_path, cache_dir, source)
+    code = read_bytecode(source, cfile)
+    if code is None:
+        return None
+    return BytecodeLoader(source, code, is_package)
+
+
+class BytecodeLoader(object):
+
+    def __init__(self, source, code, is_package):
+        self.source = source
+        self.code = code
+        self.is_package = is_package
+
+    def load_module(self, fullname):
+        is_reload = fullname in sys.modules
+        mod = sys.modules.setdefault(fullname, imp.new_module(fullname))
+        mod.__file__ = self.source
+        mod.__loader__ = self
+        if self.is_package:
+            mod.__path__ = [os.path.dirname(self.source)]
+            mod.__package__ = fullname
+        else:
+            mod.__package__ = fullname.rpartition('.')[0]
+        try:
+            exec(self.code, mod.__dict__)
+        except BaseException:
+            if not is_reload:
+                sys.modules.pop(fullname, None)
+            raise
+        return sys.modules[fullname]
+
+
+def read_bytecode(source, cfile):
+    """ Returns the code object in cfile if it is up to date with source, else None. """
+    try:
+        with open(cfile, 'rb') as f:
+            data = f.read()
+        mtime = int(os.stat(source).st_mtime) & 0xFFFFFFFF
+    except (IOError, OSError):
+        return None
+    if len(data) < 8 or data[:4] != imp.get_magic():
+        return None
+    if struct.unpack('<I', data[4:8])[0] != mtime:
+        return None
+    try:
+        return marshal.loads(data[8:])
+    except (ValueError, EOFError, TypeError):
+        return None
+
+
+def get_bytecode_dir(commands_path):
+    """
+        Returns the directory with the bytecode of the tree if the tree is
+        read-only (precompiling it the first time), or if some of it was
+        compiled there (a writable tree with read-only packages); else None.
+    """
+    cache_dir = get_bytecode_cache_dir(commands_path)
+    if not is_read_only(commands_path):
+        # the modules that are not in the cache are imported as usual
+        return cache_dir if os.path.exists(cache_dir) else None
+    if not os.path.exists(cache_dir):
+        dtslogger.info('The commands in %s are read-only; compiling them in %s.', commands_path, cache_dir)
+        dtslogger.info(str(precompile_commands(commands_path)))
+    return cache_dir
+
+
+def mark_commands_changed(commands_path):
+    """ The next load of the commands is a cold start. """
+    times = _get_load_times(commands_path)
+    times['next'] = 'cold'
+    cache_set(COMMANDS_LOAD_TIMES, times, key=os.path.realpath(commands_path))
+
+
+def record_load_time(commands_path, elapsed):
+    """ Records the time taken by DTShell.reload_commands(), as a cold or warm start. """
+    times = _get_load_times(commands_path)
+    kind = times.pop('next', 'warm')
+    times[kind] = elapsed
+    cache_set(COMMANDS_LOAD_TIMES, times, key=os.path.realpath(commands_path))
+    dtslogger.debug('Commands loaded in %.3f s (%s start).', elapsed, kind)
+
+
+def get_load_times(commands_path):
+    """ Returns a dict with the last 'cold' and 'warm' load times in seconds (if known). """
+    times = _get_load_times(commands_path)
+    times.pop('next', None)
+    return times
+
+
+def _get_load_times(commands_path):
+    try:
+        return dict(cache_get(COMMANDS_LOAD_TIMES, key=os.path.realpath(commands_path)))
+    except NoCacheAvailable:
+        return {}
+
+
+def format_load_times(commands_path):
+    times = get_load_times(commands_path)
+    parts = []
+    for kind in ['cold', 'warm']:
+        if kind in times:
+            parts.append('%s start %.3f s' % (kind, times[kind]))
+    return ', '.join(parts) if parts else 'no start times recorded yet'
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+    LAN cache server: `dts cache-server`.
+
+    One machine of a lab runs it; the others point to it with the env
+    variable DTSHELL_CACHE_SERVER (or the config key `cache_server`). It answers:
+
+        GET /pypi/<package>/json                     (the version check)
+        GET /repos/<owner>/<name>/branches/<branch>  (the commands update check)
+        GET /commands.git/...                        (git fetches of the commands)
+
+    The first two are forwarded upstream and cached for --ttl seconds; after
+    that they are revalidated with conditional requests (ETag/Last-Modified),
+    which GitHub does not count against the rate limit. If the upstream cannot
+    be reached, the last answer is served.
+
+    The commands are served from a local mirror using git's "dumb" HTTP
+    protocol; the mirror is refreshed at most every --mirror-ttl seconds.
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import re
+import subprocess
+import threading
+import time
+import urllib2
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+from . import dtslogger
+from .constants import DTShellConstants
+from .upstreams import COMMANDS_MIRROR_PATH, GITHUB_API_URL, PYPI_URL
+
+DEFAULT_PORT = 8098
+DEFAULT_TTL = 60
+DEFAULT_MIRROR_TTL = 5 * 60
+UPSTREAM_TIMEOUT = 10
+
+PYPI_PATH = re.compile(r'^/pypi/[A-Za-z0-9._-]+/json$')
+GITHUB_BRANCH_PATH = re.compile(r'^/repos/[A-Za-z0-9._-]+/[A-Za-z0-9._-]+/branches/[A-Za-z0-9._/-]+$')
+
+
+class CachedResponse(object):
+
+    def __init__(self, status, body, content_type, etag, last_modified):
+        self.status = status
+        self.body = body
+        self.content_type = content_type
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched = time.time()
+
+
+class UpstreamCache(object):
+    """ Caches upstream GET answers, revalidating them after `ttl` seconds. """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.locks = {}
+        self.stats = {'hits': 0, 'revalidated': 0, 'fetched': 0, 'stale': 0}
+
+    def _lock_for(self, url):
+        with self.lock:
+            return self.locks.setdefault(url, threading.Lock())
+
+    def get(self, url):
+        # one request per URL at a time: concurrent clients wait for the same answer
+        with self._lock_for(url):
+            cached = self.entries.get(url, None)
+            if cached is not None and time.time() - cached.fetched < self.ttl:
+                self.stats['hits'] += 1
+                return cached
+            try:
+                response = self._fetch(url, cached)
+            except (urllib2.URLError, IOError) as e:
+                if cached is None:
+                    raise
+                dtslogger.warning('Cannot revalidate %s (%s); serving the cached answer.', url, e)
+                self.stats['stale'] += 1
+                return cached
+            self.entries[url] = response
+            return response
+
+    def _fetch(self, url, cached):
+        req = urllib2.Request(url)
+        if cached is not None:
+            if cached.etag:
+                req.add_header('If-None-Match', cached.etag)
+            if cached.last_modified:
+                req.add_header('If-Modified-Since', cached.last_modified)
+        try:
+            res = urllib2.urlopen(req, timeout=UPSTREAM_TIMEOUT)
+            status, body, headers = res.getcode(), res.read(), res.info()
+        except urllib2.HTTPError as e:
+            if e.code == 304 and cached is not None:
+                self.stats['revalidated'] += 1
+                cached.fetched = time.time()
+                return cached
+            if e.code >= 500:
+                raise
+            # errors such as 404 are answers too
+            status, body, headers = e.code, e.read(), e.info()
+        self.stats['fetched'] += 1
+        return CachedResponse(status, body,
+                              headers.get('Content-Type', 'application/json'),
+                              headers.get('ETag', None),
+                              headers.get('Last-Modified', None))
+
+
+class CommandsMirror(object):
+    """ A `git clone --mirror` of the commands, refreshed at most every `ttl` seconds. """
+
+    def __init__(self, path, remote_url, ttl):
+        self.path = path
+        self.remote_url = remote_url
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.last_update = 0
+
+    def refresh(self, force=False):
+        with self.lock:
+            if not force and time.time() - self.last_update < self.ttl:
+                return
+            try:
+                if not os.path.exists(os.path.join(self.path, 'HEAD')):
+                    dtslogger.info('Cloning %s in %s', self.remote_url, self.path)
+                    self._git(['clone', '--mirror', self.remote_url, self.path], cwd=None)
+                else:
+                    self._git(['remote', 'update', '--prune'], cwd=self.path)
+                # needed by the dumb HTTP protocol
+                self._git(['update-server-info'], cwd=self.path)
+                self.last_update = time.time()
+            except (OSError, subprocess.CalledProcessError) as e:
+                if not os.path.exists(os.path.join(self.path, 'HEAD')):
+                    raise
+                dtslogger.warning('Cannot refresh the mirror (%s); serving the last copy.', e)
+
+    def _git(self, args, cwd):
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(['git'] + args, cwd=cwd, stdout=devnull, stderr=devnull)
+
+    def get_file(self, rel):
+        """ Returns the full path of a file of the mirror, or None if it is not there or outside it. """
+        full = os.path.realpath(os.path.join(self.path, rel.lstrip('/')))
+        root = os.path.realpath(self.path)
+        if not full.startswith(root + os.sep) or not os.path.isfile(full):
+            return None
+        return full
+
+
+class CacheServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, pypi_url, github_api_url, mirror, ttl):
+        HTTPServer.__init__(self, address, CacheRequestHandler)
+        self.pypi_url = pypi_url.rstrip('/')
+        self.github_api_url = github_api_url.rstrip('/')
+        self.mirror = mirror
+        self.cache = UpstreamCache(ttl)
+
+
+class CacheRequestHandler(BaseHTTPRequestHandler):
+    server_version = 'dts-cache-server'
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        try:
+            if PYPI_PATH.match(path):
+                self._proxy(self.server.pypi_url + path)
+            elif GITHUB_BRANCH_PATH.match(path):
+                self._proxy(self.server.github_api_url + path)
+            elif path.startswith(COMMANDS_MIRROR_PATH + '/') and self.server.mirror is not None:
+                self._serve_mirror(path[len(COMMANDS_MIRROR_PATH):])
+            else:
+                self._send(404, 'Not found: %s\n' % path, 'text/plain')
+        except (urllib2.URLError, IOError, OSError, subprocess.CalledProcessError) as e:
+            self._send(502, 'Upstream error: %s\n' % e, 'text/plain')
+
+    def _proxy(self, url):
+        response = self.server.cache.get(url)
+        self._send(response.status, response.body, response.content_type, etag=response.etag)
+
+    def _serve_mirror(self, rel):
+        mirror = self.server.mirror
+        if rel == '/info/refs':
+            # clients start every fetch from here
+            mirror.refresh()
+        fn = mirror.get_file(rel)
+        if fn is None:
+            self._send(404, 'Not found: %s\n' % rel, 'text/plain')
+            return
+        with open(fn, 'rb') as f:
+            self._send(200, f.read(), 'application/octet-stream')
+
+    def _send(self, status, body, content_type, etag=None):
+        if etag and self.headers.get('If-None-Match', None) == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if etag:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        dtslogger.debug('%s ' + fmt, self.address_string(), *args)
+
+
+def create_cache_server(host='0.0.0.0', port=DEFAULT_PORT, pypi_url=PYPI_URL, github_api_url=GITHUB_API_URL,
+                        commands_url=DTShellConstants.COMMANDS_REMOTE_URL, mirror_path=None,
+                        ttl=DEFAULT_TTL, mirror_ttl=DEFAULT_MIRROR_TTL):
+    """ Creates the server (not started); a mirror of the commands is kept if mirror_path is given. """
+    mirror = None
+    if mirror_path is not None:
+        mirror = CommandsMirror(mirror_path, commands_url, mirror_ttl)
+        mirror.refresh(force=True)
+    return CacheServer((host, port), pypi_url, github_api_url, mirror, ttl)
+
+
+def cache_server_main(args=None):
+    default_mirror = os.path.join(os.path.expanduser(DTShellConstants.ROOT), 'cache-server', 'commands.git')
+    parser = argparse.ArgumentParser(prog='dts cache-server',
+                                     description='Caching proxy for the dts clients of a LAN.')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--ttl', type=float, default=DEFAULT_TTL,
+                        help='Seconds before an upstream answer is revalidated.')
+    parser.add_argument('--mirror', default=default_mirror, help='Directory of the mirror of the commands.')
+    parser.add_argument('--mirror-ttl', type=float, default=DEFAULT_MIRROR_TTL,
+                        help='Seconds between updates of the mirror.')
+    parser.add_argument('--no-mirror', action='store_true', help='Do not serve the commands.')
+    parser.add_argument('--pypi-url', default=PYPI_URL)
+    parser.add_argument('--github-api-url', default=GITHUB_API_URL)
+    parser.add_argument('--commands-url', default=DTShellConstants.COMMANDS_REMOTE_URL)
+    parsed = parser.parse_args(args)
+
+    server = create_cache_server(host=parsed.host, port=parsed.port,
+                                 pypi_url=parsed.pypi_url, github_api_url=parsed.github_api_url,
+                                 commands_url=parsed.commands_url,
+                                 mirror_path=None if parsed.no_mirror else parsed.mirror,
+                                 ttl=parsed.ttl, mirror_ttl=parsed.mirror_ttl)
+    host, port = server.server_address
+    print('Cache server listening on %s:%d.' % (host, port))
+    print('On the clients:\n\n    export %s=http://<this machine>:%d\n' % (DTShellConstants.ENV_CACHE_SERVER, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+"""
+    Local stand-in for the challenges server: `dts challenges-stub`.
+
+    It implements the endpoints used by remote.py, with the same
+    {'ok': ..., 'result': ...} envelope, keeping everything in memory:
+
+        GET    /info               the user of the token
+        GET    /submissions        the submissions of the user
+        POST   /submissions        submits (queue, parameters)
+        DELETE /submissions        retires a submission
+        GET    /take-submission    gives a job to an evaluator (job_id is None if there is nothing to do)
+        POST   /take-submission    reports the result of a job
+        POST   /job-progress       partial progress and stats of a job being evaluated
+        POST   /challenge-update   creates or updates a challenge
+        POST   /uploads/check      which chunks of a file are missing
+        PUT    /uploads/chunks/<sha256>
+        POST   /uploads/commit     assembles a file from its chunks
+
+    Point the clients to it with DTSERVER=http://127.0.0.1:<port>. The
+    answers can be delayed (--latency, --jitter) and a fraction of them
+    replaced by errors (--error-rate, --error-kinds), to test the clients
+    and to load-test them (see benchmarks/load_challenges.py).
+"""
+from __future__ import print_function
+
+import argparse
+import datetime
+import hashlib
+import json
+import random
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+from . import dtslogger
+
+DEFAULT_PORT = 8099
+# how an injected error looks to the client
+ERROR_HTTP = 'http'  # HTTP 500 with a non-JSON body
+ERROR_ENVELOPE = 'envelope'  # {'ok': False, 'error': ...}
+ERROR_GARBAGE = 'garbage'  # HTTP 200 with a body that is not JSON
+ERROR_DROP = 'drop'  # connection closed without an answer
+ERROR_KINDS = [ERROR_HTTP, ERROR_ENVELOPE, ERROR_GARBAGE, ERROR_DROP]
+
+STATUS_SUBMITTED = 'submitted'
+STATUS_EVALUATING = 'evaluating'
+STATUS_RETIRED = 'retired'
+
+
+class StubRequestFailed(Exception):
+    """ Becomes an {'ok': False, 'error': msg} answer. """
+
+
+def now_iso():
+    return datetime.datetime.utcnow().isoformat() + 'Z'
+
+
+class ChallengesState(object):
+    """ Users, challenges, submissions and jobs of the stub, shared by the request threads. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.users = {}
+        self.challenges = {}
+        self.submissions = {}
+        self.jobs = {}
+        # sha256 -> bytes of the chunks and of the committed files
+        self.chunks = {}
+        self.files = {}
+        self.next_id = 1
+        self.counts = {}
+
+    def _new_id(self):
+        i = self.next_id
+        self.next_id += 1
+        return i
+
+    def get_user(self, token):
+        if not token:
+            raise StubRequestFailed('Missing token.')
+        with self.lock:
+            if token not in self.users:
+                user_id = int(hashlib.sha1(token).hexdigest()[:6], 16)
+                self.users[token] = {'user_id': user_id, 'name': 'user-%d' % user_id}
+            return self.users[token]
+
+    def info(self, user, data):
+        return dict(user)
+
+    def challenge_update(self, user, data):
+        queue = data.get('queue', None)
+        if not queue:
+            raise StubRequestFailed('Missing queue.')
+        with self.lock:
+            self.challenges[queue] = {'queue': queue, 'challenge_parameters': data.get('challenge_parameters', {}),
+                                      'last_update': now_iso()}
+        return {'queue': queue}
+
+    def submit(self, user, data):
+        queue = data.get('queue', None)
+        if not queue:
+            raise StubRequestFailed('Missing queue.')
+        with self.lock:
+            submission_id = self._new_id()
+            t = now_iso()
+            self.submissions[submission_id] = {
+                'submission_id': submission_id,
+                'user_id': user['user_id'],
+                'queue': queue,
+                'parameters': data.get('parameters', {}),
+                'artifacts': data.get('artifacts', []),
+                'status': STATUS_SUBMITTED,
+                'date_submitted': t,
+                'last_status_change': t,
+            }
+        return {'submission_id': submission_id}
+
+    def list_submissions(self, user, data):
+        since = data.get('since', None)
+        # inclusive: another submission may have changed later with the same timestamp
+        with self.lock:
+            return dict((str(k), dict(v)) for k, v in self.submissions.items()
+                        if v['user_id'] == user['user_id'] and (since is None or v['last_status_change'] >= since))
+
+    def retire(self, user, data):
+        submission_id = data.get('submission_id', None)
+        with self.lock:
+            s = self.submissions.get(submission_id, None)
+            if s is None or s['user_id'] != user['user_id']:
+                raise StubRequestFailed('Submission %r not found.' % submission_id)
+            self._set_status(s, STATUS_RETIRED)
+        return {'submission_id': submission_id}
+
+    def take_submission(self, user, data):
+        wanted = data.get('submission_id', None)
+        with self.lock:
+            candidates = [s for s in sorted(self.submissions.values(), key=lambda s: s['submission_id'])
+                          if s['status'] == STATUS_SUBMITTED and wanted in [None, s['submission_id']]]
+            if not candidates:
+                return {'job_id': None}
+            s = candidates[0]
+            self._set_status(s, STATUS_EVALUATING)
+            job_id = self._new_id()
+            self.jobs[job_id] = {'job_id': job_id, 'submission_id': s['submission_id'],
+                                 'machine_id': data.get('machine_id', None),
+                                 'process_id': data.get('process_id', None),
+                                 'evaluator_version': data.get('evaluator_version', None),
+                                 'status': STATUS_EVALUATING}
+            challenge = self.challenges.get(s['queue'], {})
+            return {'job_id': job_id,
+                    'submission_id': s['submission_id'],
+                    'queue': s['queue'],
+                    'parameters': s['parameters'],
+                    'challenge_parameters': challenge.get('challenge_parameters', {})}
+
+    def report_job(self, user, data):
+        job_id = data.get('job_id', None)
+        with self.lock:
+            job = self.jobs.get(job_id, None)
+            if job is None:
+                raise StubRequestFailed('Job %r not found.' % job_id)
+            if job['status'] != STATUS_EVALUATING:
+                raise StubRequestFailed('Job %r was already reported.' % job_id)
+            job['status'] = data.get('result', None) or 'unknown'
+            job['stats'] = data.get('stats', {})
+            self._set_status(self.submissions[job['submission_id']], job['status'])
+        return {}
+
+    def job_progress(self, user, data):
+        job_id = data.get('job_id', None)
+        seq = data.get('seq', 0)
+        with self.lock:
+            job = self.jobs.get(job_id, None)
+            if job is None:
+                raise StubRequestFailed('Job %r not found.' % job_id)
+            if job['status'] != STATUS_EVALUATING:
+                raise StubRequestFailed('Job %r was already reported.' % job_id)
+            # a batch sent again, or overtaken by a later one
+            if seq <= job.get('progress_seq', 0):
+                return {'seq': job['progress_seq']}
+            job['progress_seq'] = seq
+            job.setdefault('progress', {}).update(data.get('progress', {}))
+            job.setdefault('partial_stats', {}).update(data.get('stats', {}))
+            return {'seq': seq}
+
+    def check_chunks(self, user, data):
+        with self.lock:
+            return {'missing': [h for h in data.get('chunks', []) if h not in self.chunks]}
+
+    def put_chunk(self, user, sha256, body):
+        if hashlib.sha256(body).hexdigest() != sha256:
+            raise StubRequestFailed('The chunk does not match its hash %s.' % sha256)
+        with self.lock:
+            self.chunks[sha256] = body
+        return {'sha256': sha256}
+
+    def commit_upload(self, user, data):
+        with self.lock:
+            missing = [h for h in data.get('chunks', []) if h not in self.chunks]
+            if missing:
+                raise StubRequestFailed('Missing %d chunks.' % len(missing))
+            content = ''.join(self.chunks[h] for h in data['chunks'])
+        if len(content) != data.get('size', None) or hashlib.sha256(content).hexdigest() != data.get('sha256'):
+            raise StubRequestFailed('The file does not match its size or hash.')
+        with self.lock:
+            self.files[data['sha256']] = content
+        return {'sha256': data['sha256'], 'size': len(content)}
+
+    def _set_status(self, submission, status):
+        submission['status'] = status
+        submission['last_status_change'] = now_iso()
+
+    def count(self, key):
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+
+ROUTES = {
+    ('GET', '/info'): ChallengesState.info,
+    ('GET', '/submissions'): ChallengesState.list_submissions,
+    ('POST', '/submissions'): ChallengesState.submit,
+    ('DELETE', '/submissions'): ChallengesState.retire,
+    ('GET', '/take-submission'): ChallengesState.take_submission,
+    ('POST', '/take-submission'): ChallengesState.report_job,
+    ('POST', '/challenge-update'): ChallengesState.challenge_update,
+    ('POST', '/job-progress'): ChallengesState.job_progress,
+    ('POST', '/uploads/check'): ChallengesState.check_chunks,
+    ('POST', '/uploads/commit'): ChallengesState.commit_upload,
+}
+CHUNKS_PATH = '/uploads/chunks/'
+
+
+class ChallengesStubHandler(BaseHTTPRequestHandler):
+    server_version = 'dts-challenges-stub'
+    protocol_version = 'HTTP/1.1'
+
+    def handle_request(self):
+        method = self.command
+        path = self.path.split('?', 1)[0]
+        length = int(self.headers.get('Content-Length', 0) or 0)
+        body = self.rfile.read(length) if length else ''
+        server = self.server
+        server.state.count('%s %s' % (method, path))
+
+        delay = server.latency + random.uniform(0, server.jitter) if server.jitter else server.latency
+        if delay > 0:
+            time.sleep(delay)
+        if server.error_rate and random.random() < server.error_rate:
+            self._inject_error(random.choice(server.error_kinds))
+            return
+
+        if method == 'PUT' and path.startswith(CHUNKS_PATH):
+            # the body is the chunk itself
+            sha256 = path[len(CHUNKS_PATH):]
+            route = lambda state, user, data: state.put_chunk(user, sha256, body)
+        else:
+            route = ROUTES.get((method, path), None)
+        if route is None:
+            self._send(404, 'Not found: %s %s\n' % (method, path), 'text/plain')
+            return
+        try:
+            data = json.loads(body) if body and method != 'PUT' else {}
+            if not isinstance(data, dict):
+                raise StubRequestFailed('Expected a JSON object.')
+            user = server.state.get_user(self.headers.get('X-Messaging-Token', None))
+            answer = {'ok': True, 'result': route(server.state, user, data)}
+        except ValueError:
+            answer = {'ok': False, 'error': 'Invalid JSON.'}
+        except StubRequestFailed as e:
+            answer = {'ok': False, 'error': str(e)}
+        self._send(200, json.dumps(answer), 'application/json')
+
+    do_GET = do_POST = do_PUT = do_DELETE = handle_request
+
+    def _inject_error(self, kind):
+        if kind == ERROR_HTTP:
+            self._send(500, 'Internal Server Error (injected)\n', 'text/plain')
+        elif kind == ERROR_ENVELOPE:
+            self._send(200, json.dumps({'ok': False, 'error': 'Injected error.'}), 'application/json')
+        elif kind == ERROR_GARBAGE:
+            self._send(200, '<html>injected</html>', 'text/html')
+        else:
+            self.close_connection = 1
+
+    def _send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        dtslogger.debug('%s ' + fmt, self.address_string(), *args)
+
+
+class ChallengesStubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def create_challenges_stub(host='127.0.0.1', port=DEFAULT_PORT, latency=0.0, jitter=0.0, error_rate=0.0,
+                           error_kinds=None, state=None):
+    """ Creates the server (port 0 = any free port); call serve_forever() on it. """
+    for kind in error_kinds or []:
+        if kind not in ERROR_KINDS:
+            raise ValueError('Unknown error kind %r; use one of %s.' % (kind, ', '.join(ERROR_KINDS)))
+    server = ChallengesStubServer((host, port), ChallengesStubHandler)
+    server.state = state if state is not None else ChallengesState()
+    server.latency = latency
+    server.jitter = jitter
+    server.error_rate = error_rate
+    server.error_kinds = list(error_kinds or ERROR_KINDS)
+    return server
+
+
+def start_challenges_stub(**kwargs):
+    """ Starts the server in a background thread; returns (server, url). """
+    kwargs.setdefault('port', 0)
+    server = create_challenges_stub(**kwargs)
+    t = threading.Thread(target=server.serve_forever, name='dts-challenges-stub')
+    t.daemon = True
+    t.start()
+    return server, 'http://%s:%d' % server.server_address
+
+
+def challenges_stub_main(args=None):
+    parser = argparse.ArgumentParser(prog='dts challenges-stub',
+                                     description='Local stand-in for the challenges server.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to each answer.')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Random extra latency, up to this many seconds.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests that fail.')
+    parser.add_argument('--error-kinds', default=','.join(ERROR_KINDS),
+                        help='Comma-separated kinds of injected errors: %s.' % ', '.join(ERROR_KINDS))
+    parsed = parser.parse_args(args)
+
+    server = create_challenges_stub(host=parsed.host, port=parsed.port, latency=parsed.latency,
+                                    jitter=parsed.jitter, error_rate=parsed.error_rate,
+                                    error_kinds=[k for k in parsed.error_kinds.split(',') if k])
+    host, port = server.server_address
+    print('Challenges stub listening on %s:%d.' % (host, port))
+    print('On the clients:\n\n    export DTSERVER=http://%s:%d\n' % (host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
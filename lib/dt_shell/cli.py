@@ -5,20 +5,42 @@ import glob
 import json
 import os
 import sys
+import threading
 import time
 from cmd import Cmd
 from os import makedirs, remove, utime
-from os.path import basename, isfile, isdir, exists, join, getmtime
+from os.path import basename, isfile, isdir, exists, join
+from shutil import rmtree
 
 import termcolor
 from dt_shell.version_check import check_if_outdated
 from git import Repo
 from git.exc import NoSuchPathError, InvalidGitRepositoryError
 
-from . import __version__, dtslogger
+from . import __version__, dtslogger, upstreams
+from .bytecode import format_load_times, get_bytecode_dir, precompile_commands, record_load_time
+from .commands_trees import can_swap_trees, ensure_tree_layout, link_tree, new_tree_path, publish_tree, \
+    remove_old_trees, repair_worktree_links
+from .commands_versions import InvalidCommandsVersion, add_commands_version, get_commands_branch, \
+    get_commands_path_for_version, is_default_version, list_commands_versions, remove_commands_version
 from .constants import DTShellConstants
 from .dt_command_abs import DTCommandAbs
 from .dt_command_placeholder import DTCommandPlaceholder
+from .history import STATUS_ERROR, STATUS_INTERRUPTED, STATUS_NOT_FOUND, STATUS_OK, compute_stats, format_stats, \
+    get_history_log, is_history_enabled
+from .importer import get_lib_zip, install_commands_importer, make_lib_zip
+from .jobs import JobManager, format_job
+from .local_cache import COMMANDS_REMOTE_SHA, NoCacheAvailable, cache_get, cache_set, write_atomic
+from .locking import get_commands_lock, wait_for_writers
+from .memoize import EVENT_COMMANDS, EVENT_CONFIG, format_memo_stats, get_memo_registry
+from .memory import MemoryBudgetExceeded, MemoryBudgetInterrupt, MemoryTrace, get_memory_settings_from_env, \
+    parse_size
+from .prefetch import PrefetchScheduler, format_prefetch_status, get_declared_images, \
+    get_prefetch_settings, prefetch_images, read_status, spawn_prefetch_process
+from .profiling import ProfileSession, get_profile_mode_from_env
+from .registry import CommandRegistry
+from .reloading import CommandsWatcher, evict_modules, get_commands_fingerprints, get_lib_packages, \
+    get_tree_fingerprint
 
 import requests
 
@@ -28,7 +50,12 @@ DEBUG = False
 class InvalidConfig(Exception):
     pass
 
-CHECK_CMDS_UPDATE_EVERY_MINS = 5
+# how long to wait for another process that is installing/updating the commands
+INSTALL_WAIT_SECS = 10 * 60
+UPDATE_WAIT_SECS = 60
+READ_WAIT_SECS = 10
+
+NOT_IN_JOBS_MSG = 'Profiling and memory tracing are not available in background jobs.'
 
 DNAME = 'Duckietown Shell'
 
@@ -42,42 +69,64 @@ Type "help" or "?" to list commands.
            version=__version__).lstrip()
 
 
+def is_main_thread():
+    return isinstance(threading.current_thread(), threading._MainThread)
+
+
 class DTShell(Cmd, object):
     prompt = 'dt> '
     config = {}
     commands = {}
+    # name -> loaded DTCommandAbs class of the first-level commands
+    command_classes = {}
+    command_registry = CommandRegistry.build({})
+    commands_fingerprints = {}
+    lib_fingerprint = None
+    commands_watcher = None
+    prefetch_scheduler = None
+    interactive = False
+    prefetch_pending = False
+    commands_tree_swapped = False
     core_commands = ['commands', 'install', 'uninstall', 'update', 'version', 'exit', 'help']
 
     def __init__(self):
         self.intro = INTRO
-
-        check_if_outdated()
+        self._commands_changed = threading.Event()
+        # number of commands running, in the main thread and in the background jobs
+        self._busy_lock = threading.Lock()
+        self._busy = 0
 
         self.config_path = os.path.expanduser(DTShellConstants.ROOT)
         self.config_file = join(self.config_path, 'config')
+        # create config if it does not exist
+        if not exists(self.config_path):
+            makedirs(self.config_path, mode=0755)
+        if not exists(self.config_file):
+            self.save_config()
+        # load config
+        self.load_config()
+        upstreams.configure(self.config)
+        check_if_outdated()
         # define commands_path
         V = DTShellConstants.ENV_COMMANDS
+        self.commands_main_path = join(self.config_path, 'commands')
         if V in os.environ:
             self.commands_path = os.environ[V]
             self.commands_path_leave_alone = True
             msg = 'Using path %r as prescribed by env variable %s.' % (self.commands_path, V)
             dtslogger.info(msg)
         else:
-            self.commands_path = join(self.config_path, 'commands')
+            version = self.config.get(DTShellConstants.CONFIG_COMMANDS_VERSION, None)
+            self.commands_path = get_commands_path_for_version(self.config_path, self.commands_main_path, version)
             self.commands_path_leave_alone = False
-        self.commands_update_check_flag = join(self.commands_path, '.updates-check')
-        # add commands_path to the path of this session
-        sys.path.insert(0, self.commands_path)
-        # add third-party libraries dir to the path of this session
-        sys.path.insert(0, join(self.commands_path, 'lib'))
-
-        # create config if it does not exist
-        if not exists(self.config_path):
-            makedirs(self.config_path, mode=0755)
-        if not exists(self.config_file):
-            self.save_config()
-        # load config
-        self.load_config()
+        # make the commands and the third-party libraries in `lib` importable
+        # (without prepending them to sys.path, which slows down every other import)
+        self.commands_importer = install_commands_importer(self.commands_path,
+                                                           bytecode_dir=get_bytecode_dir(self.commands_path),
+                                                           lib_zip=get_lib_zip(self.commands_path))
+        # one process at a time installs or updates the commands
+        self.commands_lock = get_commands_lock(self.commands_path if self.commands_path_leave_alone
+                                               else self.commands_main_path)
         # init commands
         cmds_just_initialized = False
         if exists(self.commands_path) and isfile(self.commands_path):
@@ -86,7 +135,10 @@ class DTShell(Cmd, object):
             if not self._init_commands():
                 exit()
             cmds_just_initialized = True
-        # discover commands
+        # discover commands (if another process is updating them in place, wait for it a little;
+        # a symlinked tree is always complete, see commands_trees.py)
+        if not os.path.islink(self.commands_path) and not wait_for_writers(self.commands_lock, READ_WAIT_SECS):
+            dtslogger.warning('The commands are being updated by another process; using them as they are.')
         self.reload_commands()
         # call super constructor
         super(DTShell, self).__init__()
@@ -102,16 +154,76 @@ class DTShell(Cmd, object):
     def postcmd(self, stop, line):
         if len(line.strip()) > 0:
             print('')
+        if '_jobs' in self.__dict__:
+            for job in self.jobs.pop_finished():
+                print('%s    (`fg %d` shows its output)' % (format_job(job), job.id))
+        # an update run by a background job
+        self._apply_commands_update()
 
     def emptyline(self):
         pass
 
+    # path of the command being dispatched (filled by the registry) and its status;
+    # they are per thread, as background jobs dispatch commands too
+
+    @property
+    def _dispatch(self):
+        return self.__dict__.setdefault('_dispatch_local', threading.local())
+
+    @property
+    def command_path(self):
+        return getattr(self._dispatch, 'command_path', None)
+
+    @command_path.setter
+    def command_path(self, value):
+        self._dispatch.command_path = value
+
+    @property
+    def command_status(self):
+        return getattr(self._dispatch, 'command_status', None)
+
+    @command_status.setter
+    def command_status(self, value):
+        self._dispatch.command_status = value
+
+    @property
+    def instrumented(self):
+        return getattr(self._dispatch, 'instrumented', False)
+
+    @instrumented.setter
+    def instrumented(self, value):
+        self._dispatch.instrumented = value
+
+    def _add_busy(self, n):
+        with self._busy_lock:
+            self._busy += n
+
+    @property
+    def jobs(self):
+        """ The executor of the background jobs; commands can submit work to it. See jobs.py. """
+        if '_jobs' not in self.__dict__:
+            self._jobs = JobManager()
+        return self._jobs
+
+    def default(self, line):
+        self.command_status = STATUS_NOT_FOUND
+        return Cmd.default(self, line)
+
+    def completenames(self, text, *ignored):
+        return self.command_registry.complete_top(text)
+
     def complete(self, text, state):
         res = super(DTShell, self).complete(text, state)
         if res is not None:
             res += ' '
         return res
 
+    @property
+    def docker_client(self):
+        """ The docker client shared by all commands; see get_docker_client(). """
+        from .docker_client import get_docker_client
+        return get_docker_client()
+
     def get_version(self):
         return self.VERSION
 
@@ -120,8 +232,13 @@ class DTShell(Cmd, object):
             self.config = json.load(fp)
 
     def save_config(self):
-        with open(self.config_file, 'w') as fp:
-            json.dump(self.config, fp)
+        write_atomic(self.config_file, json.dumps(self.config))
+        self.memos.invalidate(EVENT_CONFIG)
+
+    @property
+    def memos(self):
+        """ The memos of DTCommandAbs.memoize, with their hit/miss counters; see memoize.py. """
+        return get_memo_registry()
 
     def check_commands_outdated(self):
         local_sha = None
@@ -132,26 +249,21 @@ class DTShell(Cmd, object):
         except (NoSuchPathError, InvalidGitRepositoryError) as e:
             # the repo does not exist, this should never happen
             return
-        local_sha = commands_repo.heads.master.commit.hexsha
+        branch = get_commands_branch(commands_repo)
+        if branch is None:
+            # pinned to a commit, there is nothing to update
+            return True
+        local_sha = commands_repo.head.commit.hexsha
         # get remote SHA
         use_cached_sha = False
-        if exists(self.commands_update_check_flag) and isfile(self.commands_update_check_flag):
-            now = time.time()
-            last_time_checked = getmtime(self.commands_update_check_flag)
-            use_cached_sha = now-last_time_checked < CHECK_CMDS_UPDATE_EVERY_MINS*60
-        # get remote SHA
-        if use_cached_sha:
-            # no need to check now
-            with open(self.commands_update_check_flag, 'r') as fp:
-                try:
-                    cached_check = json.load( fp )
-                except ValueError: return False
-                remote_sha = cached_check['remote']
-        else:
-            url = "https://api.github.com/repos/%s/%s/branches/%s" % (
+        try:
+            remote_sha = cache_get(COMMANDS_REMOTE_SHA, key=self.commands_path)
+            use_cached_sha = True
+        except NoCacheAvailable:
+            url = upstreams.get_github_branch_url(
                 DTShellConstants.COMMANDS_REPO_OWNER,
                 DTShellConstants.COMMANDS_REPO_NAME,
-                DTShellConstants.COMMANDS_REPO_BRANCH
+                branch
             )
             try:
                 res = requests.get(url, timeout=1)
@@ -169,27 +281,98 @@ class DTShell(Cmd, object):
             ))
         # cache remote SHA
         if not use_cached_sha:
-            with open(self.commands_update_check_flag, 'w') as fp:
-                json.dump( {'remote' : remote_sha}, fp )
+            cache_set(COMMANDS_REMOTE_SHA, remote_sha, key=self.commands_path)
         # return success
         return True
 
     def reload_commands(self):
-        # get installed commands
-        installed_commands = self.commands.keys()
-        for command in installed_commands:
+        """
+            Discovers the commands and (re)loads the ones that changed since
+            the last call; the first call loads everything.
+
+            The modules of a changed command are evicted from sys.modules, so
+            that the new code is actually imported. If the `lib` directory
+            changed, all the commands are reloaded.
+
+            Returns the list of the commands that were (re)loaded.
+        """
+        # the tree loaded: commands_path may be a symlink that another process pointed to a new tree
+        loaded = self.commands_importer.commands_path
+        if os.path.realpath(self.commands_path) != loaded:
+            return self._switch_commands_path(self.commands_path)
+        t0 = time.time()
+        previous = self.commands
+        commands = self._get_commands(self.commands_path)
+        if commands is None:
+            print('No commands found.')
+            commands = {}
+        fingerprints = get_commands_fingerprints(self.commands_path, commands)
+        lib = join(self.commands_path, 'lib')
+        lib_fingerprint = get_tree_fingerprint(lib)
+        lib_changed = lib_fingerprint != self.lib_fingerprint
+
+        removed = [c for c in previous if c not in commands]
+        changed = [c for c in commands
+                   if lib_changed or previous.get(c) != commands[c] or
+                   self.commands_fingerprints.get(c) != fingerprints[c]]
+        # uninstall removed and changed commands
+        for command in removed + changed:
             for a in ['do_', 'complete_', 'help_']:
                 if hasattr(DTShell, a + command):
                     delattr(DTShell, a + command)
-        # re-install commands
-        self.commands = self._get_commands(self.commands_path)
-        if self.commands is None:
-            print('No commands found.')
-            self.commands = {}
+        evict_modules(removed + changed, loaded)
+        if lib_changed:
+            evict_modules(get_lib_packages(loaded), join(loaded, 'lib'))
         # load commands
-        # print('commands: %s' % self.commands)
-        for cmd, subcmds in self.commands.items():
-            self._load_commands('', cmd, subcmds, 0)
+        self.commands_importer.refresh()
+        self.commands = commands
+        self.commands_fingerprints = fingerprints
+        self.lib_fingerprint = lib_fingerprint
+        command_classes = dict((c, k) for c, k in self.command_classes.items() if c in commands)
+        for cmd in changed:
+            command_classes[cmd] = self._load_commands('', cmd, commands[cmd], 0)
+        self.command_classes = command_classes
+        builtin_names = [a[3:] for a in dir(DTShell) if a.startswith('do_')]
+        self.command_registry = CommandRegistry.build(command_classes, builtin_names)
+        if changed and len(changed) == len(commands):
+            record_load_time(self.commands_path, time.time() - t0)
+        if previous and (changed or removed):
+            self.memos.invalidate(EVENT_COMMANDS)
+        return changed
+
+    def _compute_fingerprints(self):
+        commands = self._get_commands(self.commands_path) or {}
+        fingerprints = get_commands_fingerprints(self.commands_path, commands)
+        return commands, fingerprints, get_tree_fingerprint(join(self.commands_path, 'lib'))
+
+    def watch_commands(self, interval=1.0):
+        """ Reloads the commands that change on disk; the reload happens before the next command. """
+        if self.commands_watcher is not None:
+            return
+        self.commands_watcher = CommandsWatcher(self._compute_fingerprints, self._commands_changed.set,
+                                                interval=interval)
+        self.commands_watcher.start()
+
+    def precmd(self, line):
+        if self._commands_changed.is_set():
+            self._commands_changed.clear()
+            reloaded = self.reload_commands()
+            if reloaded:
+                dtslogger.info('Reloaded commands: %s', ', '.join(sorted(reloaded)))
+        return line
+
+    def preloop(self):
+        self.interactive = True
+        V = DTShellConstants.ENV_WATCH
+        if os.environ.get(V, ''):
+            try:
+                interval = float(os.environ[V])
+            except ValueError:
+                interval = 1.0
+            self.watch_commands(interval if interval > 0 else 1.0)
+        settings = get_prefetch_settings(self.config)
+        if settings is not None:
+            self.start_prefetch_scheduler(settings)
 
     def enable_command(self, command_name):
         if command_name in self.core_commands:
@@ -220,45 +403,93 @@ class DTShell(Cmd, object):
             msg = 'Will not try to update the commands path.'
             print(msg)
             return
+        with self.commands_lock.exclusive(timeout=INSTALL_WAIT_SECS):
+            if exists(self.commands_path):
+                # installed by another process while we were waiting
+                return True
+            return self._init_commands_locked()
+
+    def _init_commands_locked(self):
         print('Downloading commands in %s ...' % self.commands_path)
-        # create commands repo
-        commands_repo = Repo.init(self.commands_path)
-        # the repo now exists
-        origin = commands_repo.create_remote('origin', DTShellConstants.COMMANDS_REMOTE_URL)
-        # check existence of `origin`
-        if not origin.exists():
-            print('The commands repository %r cannot be found. Exiting.' % origin.urls)
-            return False
-        # pull data
-        origin.fetch()
-        # create local.master <-> remote.master
-        commands_repo.create_head('master', origin.refs.master)
-        commands_repo.heads.master.set_tracking_branch(origin.refs.master)
-        # pull data
-        _res = origin.pull()
-        # the repo is there and there is a `origin` remote, merge
-        commands_repo.heads.master.checkout()
+        # work in a temporary directory and move it in place at the end, so that other
+        # processes never see a half-initialized repository
+        swap = can_swap_trees() and not self.commands_path_leave_alone
+        tmp_path = new_tree_path(self.config_path) if swap else '%s.tmp-%s' % (self.commands_path, os.getpid())
+        if exists(tmp_path):
+            rmtree(tmp_path)
+        try:
+            # create commands repo
+            commands_repo = Repo.init(tmp_path)
+            # the repo now exists
+            origin = commands_repo.create_remote('origin', upstreams.get_commands_remote_url())
+            # check existence of `origin`
+            if not origin.exists():
+                print('The commands repository %r cannot be found. Exiting.' % origin.urls)
+                return False
+            # pull data
+            origin.fetch()
+            # create local.master <-> remote.master
+            commands_repo.create_head('master', origin.refs.master)
+            commands_repo.heads.master.set_tracking_branch(origin.refs.master)
+            # pull data
+            _res = origin.pull()
+            # the repo is there and there is a `origin` remote, merge
+            commands_repo.heads.master.checkout()
+            if swap:
+                publish_tree(self.commands_path, tmp_path)
+            else:
+                os.rename(tmp_path, self.commands_path)
+        finally:
+            if exists(tmp_path) and not os.path.islink(self.commands_path):
+                rmtree(tmp_path, ignore_errors=True)
+        self._precompile_commands()
         return True
 
     def update_commands(self):
+        # if another process is updating the commands, wait for it and use its result
+        if not self.commands_lock.acquire(timeout=UPDATE_WAIT_SECS):
+            print('Another process is updating the commands; using the current version.')
+            return True
+        try:
+            res = self._update_commands_locked()
+        finally:
+            self.commands_lock.release()
+        # pull the images of the new commands once this command is done
+        if res:
+            self.memos.invalidate(EVENT_COMMANDS)
+            if get_prefetch_settings(self.config) is not None:
+                self.prefetch_pending = True
+        return res
+
+    def _update_commands_locked(self):
         # create commands repo
         commands_repo = None
         try:
             commands_repo = Repo(self.commands_path)
         except (NoSuchPathError, InvalidGitRepositoryError) as e:
             # the repo does not exist
-            if not self._init_commands():
+            if self.commands_path_leave_alone:
                 return False
+            return self._init_commands_locked()
         # the repo exists
         print('Updating commands...', end='')
         origin = commands_repo.remote('origin')
+        self._set_origin_url(origin)
         # check existence of `origin`
         if not origin.exists():
             print('The commands repository %r cannot be found. Exiting.' % origin.urls)
             return False
+        branch = get_commands_branch(commands_repo)
+        if branch is None:
+            print('the commands are pinned to %s.' % commands_repo.head.commit.hexsha)
+            return True
+        if can_swap_trees() and not self.commands_path_leave_alone and \
+                os.path.abspath(self.commands_path) == os.path.abspath(self.commands_main_path):
+            return self._update_commands_tree(branch)
+        # the worktrees of the other versions (and custom paths) are updated in place
         _res = origin.pull()
-        # pull data from remote.master to local.master
-        commands_repo.heads.master.checkout()
+        # pull data from remote.<branch> to local.<branch>
+        commands_repo.heads[branch].checkout()
         print('OK')
         # update all submodules
         print('Updating libraries...', end='')
@@ -271,12 +502,484 @@ class DTShell(Cmd, object):
         # everything should be fine
         print('OK')
         # cache current (local=remote) SHA
-        current_sha = commands_repo.heads.master.commit.hexsha
-        with open(self.commands_update_check_flag, 'w') as fp:
-            json.dump( {'remote' : current_sha}, fp )
+        current_sha = commands_repo.head.commit.hexsha
+        cache_set(COMMANDS_REMOTE_SHA, current_sha, key=self.commands_path)
+        self._precompile_commands()
         # return success
         return True
 
+    def _update_commands_tree(self, branch):
+        """ Updates a copy of the main checkout, then makes it current (see commands_trees.py). """
+        ensure_tree_layout(self.config_path, self.commands_path)
+        tree = new_tree_path(self.config_path)
+        published = False
+        try:
+            link_tree(os.path.realpath(self.commands_path), tree)
+            commands_repo = Repo(tree)
+            _res = commands_repo.remote('origin').pull()
+            # pull data from remote.<branch> to local.<branch>
+            commands_repo.heads[branch].checkout()
+            print('OK')
+            # update all submodules
+            print('Updating libraries...', end='')
+            commands_repo.submodule_update(recursive=True, to_latest_revision=False)
+            print('OK')
+            self._precompile_commands(tree)
+            publish_tree(self.commands_path, tree)
+            published = True
+        finally:
+            if not published:
+                rmtree(tree, ignore_errors=True)
+        repair_worktree_links(self.commands_path)
+        remove_old_trees(self.config_path, self.commands_path)
+        # cache current (local=remote) SHA
+        cache_set(COMMANDS_REMOTE_SHA, commands_repo.head.commit.hexsha, key=self.commands_path)
+        # this process switches to the new tree once the current command is done
+        self.commands_tree_swapped = True
+        return True
+
+    def use_commands_version(self, ref):
+        """
+            Switches to another version (branch or commit) of the commands,
+            checking it out as a worktree of the main checkout if needed.
+        """
+        if self.commands_path_leave_alone:
+            msg = 'The commands path is set by the env variable %s; cannot switch version.' % \
+                  DTShellConstants.ENV_COMMANDS
+            raise InvalidCommandsVersion(msg)
+        with self.commands_lock.exclusive(timeout=INSTALL_WAIT_SECS):
+            path = add_commands_version(self.config_path, self.commands_main_path, ref)
+            repair_worktree_links(self.commands_main_path)
+        self.config[DTShellConstants.CONFIG_COMMANDS_VERSION] = None if is_default_version(ref) else ref
+        self.save_config()
+        self._switch_commands_path(path)
+        return path
+
+    def remove_commands_version(self, ref):
+        """ Removes the worktree of a version of the commands; returns False if there is none. """
+        if is_default_version(ref):
+            raise InvalidCommandsVersion('The default version of the commands cannot be removed.')
+        if ref == self.config.get(DTShellConstants.CONFIG_COMMANDS_VERSION, None):
+            msg = 'The commands version %r is in use; switch to another one first.' % ref
+            raise InvalidCommandsVersion(msg)
+        with self.commands_lock.exclusive(timeout=INSTALL_WAIT_SECS):
+            return remove_commands_version(self.config_path, self.commands_main_path, ref)
+
+    def _switch_commands_path(self, path):
+        # the tree loaded (commands_path may be a symlink that now points to another one)
+        loaded = self.commands_importer.commands_path
+        if os.path.realpath(path) == loaded:
+            return
+        # forget everything loaded from the previous tree
+        for command in self.commands:
+            for a in ['do_', 'complete_', 'help_']:
+                if hasattr(DTShell, a + command):
+                    delattr(DTShell, a + command)
+        evict_modules(list(self.commands), loaded)
+        evict_modules(get_lib_packages(loaded), join(loaded, 'lib'))
+        if self.commands_importer in sys.meta_path:
+            sys.meta_path.remove(self.commands_importer)
+        # load the new one
+        self.commands_path = path
+        self.commands = {}
+        self.commands_fingerprints = {}
+        self.lib_fingerprint = None
+        self.commands_importer = install_commands_importer(path,
+                                                           bytecode_dir=get_bytecode_dir(path),
+                                                           lib_zip=get_lib_zip(path))
+        return self.reload_commands()
+
+    def do_commands_use(self, line):
+        """
+            Usage: commands use [<branch>|<commit>]
+
+            Switches to another version of the commands; without arguments,
+            shows the current version and the ones available locally.
+        """
+        args = line.split()
+        if not args:
+            version = self.config.get(DTShellConstants.CONFIG_COMMANDS_VERSION, None)
+            print('Current commands version: %s (%s)' % (version or DTShellConstants.COMMANDS_REPO_BRANCH,
+                                                         self.commands_path))
+            available = [DTShellConstants.COMMANDS_REPO_BRANCH] + list_commands_versions(self.config_path)
+            print('Available locally: %s' % ', '.join(available))
+            return
+        try:
+            path = self.use_commands_version(args[0])
+        except InvalidCommandsVersion as e:
+            termcolor.cprint(str(e), 'yellow')
+            return
+        print('Using commands version %s (%s).' % (args[0], path))
+
+    def do_commands_remove(self, line):
+        """
+            Usage: commands remove <branch>|<commit>
+
+            Removes a version of the commands checked out with `commands use`.
+        """
+        args = line.split()
+        if len(args) != 1:
+            print(self.do_commands_remove.__doc__)
+            return
+        try:
+            removed = self.remove_commands_version(args[0])
+        except InvalidCommandsVersion as e:
+            termcolor.cprint(str(e), 'yellow')
+            return
+        if removed:
+            print('Removed commands version %s.' % args[0])
+        else:
+            termcolor.cprint('The commands version %s is not available locally.' % args[0], 'yellow')
+
+    def onecmd(self, line):
+        if self.command_path is not None:
+            return self._onecmd(line)
+        if self.interactive and line.rstrip().endswith('&'):
+            line = line.rstrip()[:-1].strip()
+            if line:
+                job = self.jobs.submit(line, self.onecmd, line)
+                print('[%d] %s' % (job.id, line))
+            return
+        cmd, _, _ = self.parseline(line)
+        if not cmd:
+            return self._onecmd(line)
+        self.command_path = []
+        self.command_status = STATUS_OK
+        self._add_busy(1)
+        t0 = time.time()
+        try:
+            return self._onecmd(line)
+        except KeyboardInterrupt:
+            self.command_status = STATUS_INTERRUPTED
+            raise
+        except MemoryBudgetExceeded as e:
+            self.command_status = STATUS_ERROR
+            if not self.interactive:
+                raise
+            # the session goes on
+            termcolor.cprint(str(e), 'yellow')
+        except SystemExit as e:
+            if e.code not in [None, 0]:
+                self.command_status = STATUS_ERROR
+            raise
+        except BaseException:
+            self.command_status = STATUS_ERROR
+            raise
+        finally:
+            if is_history_enabled():
+                command = ' '.join(self.command_path) or cmd
+                get_history_log().record(command, time.time() - t0, self.command_status, t0)
+            self.command_path = None
+            self._add_busy(-1)
+            self._apply_commands_update()
+
+    def _apply_commands_update(self):
+        """
+            Switches to the commands updated by `update` and pulls their images.
+            Only in the main thread, once no command runs (also in the background
+            jobs); otherwise postcmd tries again after the next line.
+        """
+        if not is_main_thread() or self.is_busy():
+            return
+        if self.commands_tree_swapped:
+            self.commands_tree_swapped = False
+            self._switch_commands_path(self.commands_path)
+        if self.prefetch_pending:
+            self.prefetch_pending = False
+            self.prefetch_images_after_update()
+
+    def _onecmd(self, line):
+        # `commands use/remove` are handled by the shell itself, as they change where the commands come from
+        cmd, arg, line = self.parseline(line)
+        if cmd == 'commands' and arg is not None and arg.split()[:1] in [['use'], ['remove']]:
+            rest = arg.split(None, 1)[1] if len(arg.split()) > 1 else ''
+            if arg.split()[0] == 'use':
+                return self.do_commands_use(rest)
+            return self.do_commands_remove(rest)
+        if not self.instrumented and cmd not in [None, 'profile', 'memory']:
+            sessions = self._get_sessions_from_env(line)
+            if sessions and not is_main_thread():
+                termcolor.cprint('%s Running %r without them.' % (NOT_IN_JOBS_MSG, line), 'yellow')
+            elif sessions:
+                return self.run_instrumented(line, sessions)
+        return super(DTShell, self).onecmd(line)
+
+    def _get_sessions_from_env(self, line):
+        sessions = []
+        mode = get_profile_mode_from_env()
+        if mode is not None:
+            sessions.append(ProfileSession(line, mode=mode))
+        memory_trace, budget = get_memory_settings_from_env()
+        if memory_trace:
+            sessions.append(MemoryTrace(line, budget=budget))
+        return sessions
+
+    def run_instrumented(self, line, sessions):
+        """
+            Runs the command in the line with the given context managers (profiler,
+            memory trace, ...) around its dispatch. Only in the main thread: the
+            samplers and the memory budgets use signals and interrupt it.
+        """
+        if not is_main_thread():
+            termcolor.cprint(NOT_IN_JOBS_MSG, 'yellow')
+            return
+        self.instrumented = True
+        try:
+            return self._run_within(list(sessions), line)
+        except MemoryBudgetInterrupt:
+            # raised as a memory trace was exiting, before it could stop its watchdog
+            for session in sessions:
+                if isinstance(session, MemoryTrace):
+                    session.watchdog.stop()
+            raise MemoryBudgetExceeded('The command %r exceeded the memory budget and was stopped.' % line)
+        finally:
+            self.instrumented = False
+
+    def _run_within(self, sessions, line):
+        if not sessions:
+            return self.onecmd(line)
+        with sessions[0]:
+            return self._run_within(sessions[1:], line)
+
+    def profile_command(self, line, mode='full'):
+        """ Runs the command in the line under the profiler (see profiling.py). """
+        return self.run_instrumented(line, [ProfileSession(line, mode=mode)])
+
+    def do_profile(self, line):
+        """
+            Usage: profile [--sample] <command ...>
+
+            Runs the command under the profiler, prints the hot functions and saves
+            the profile (.pstats) and the stacks for flame graphs (.collapsed)
+            in ~/.dt-shell/profiles/.
+        """
+        args = line.split()
+        mode = 'full'
+        if args and args[0] == '--sample':
+            mode = 'sample'
+            args = args[1:]
+        if not args:
+            print(self.do_profile.__doc__)
+            return
+        return self.profile_command(' '.join(args), mode)
+
+    def do_memory(self, line):
+        """
+            Usage: memory [--budget <size>] <command ...>
+
+            Runs the command and reports its peak RSS, the memory it allocated and
+            the top allocation sites. With a budget (e.g. 512M, 2G), the command is
+            stopped if the memory of the shell exceeds it.
+        """
+        args = line.split()
+        budget = None
+        if len(args) >= 2 and args[0] == '--budget':
+            try:
+                budget = parse_size(args[1])
+            except ValueError as e:
+                termcolor.cprint(str(e), 'yellow')
+                return
+            args = args[2:]
+        if not args:
+            print(self.do_memory.__doc__)
+            return
+        line = ' '.join(args)
+        try:
+            return self.run_instrumented(line, [MemoryTrace(line, budget=budget)])
+        except MemoryBudgetExceeded as e:
+            termcolor.cprint(str(e), 'yellow')
+
+    def do_stats(self, line):
+        """
+            Usage: stats [<n>]
+
+            Shows the slowest and the most frequently used commands, with the
+            median (p50) and p95 of their duration, from ~/.dt-shell/history/.
+        """
+        args = line.split()
+        try:
+            top = int(args[0]) if args else 10
+        except ValueError:
+            print(self.do_stats.__doc__)
+            return
+        log = get_history_log()
+        log.flush()
+        print(format_stats(compute_stats(log.read()), top=top))
+
+    def do_jobs(self, line):
+        """
+            Usage: jobs
+
+            Lists the background jobs (started with `<command> &`).
+        """
+        jobs = self.jobs.list()
+        if not jobs:
+            print('No jobs.')
+        for job in jobs:
+            print(format_job(job))
+
+    def do_fg(self, line):
+        """
+            Usage: fg [<id>]
+
+            Shows the output of a background job (the last one by default) and
+            waits for it to finish. Ctrl-C stops waiting; the job continues.
+        """
+        jobs = self.jobs.list()
+        try:
+            job = self.jobs.get(int(line)) if line.strip() else (jobs[-1] if jobs else None)
+        except ValueError:
+            job = None
+        if job is None:
+            print('No such job.')
+            return
+        offset = 0
+        try:
+            while True:
+                finished = job.done.is_set()
+                text, offset = job.output.read(offset)
+                sys.stdout.write(text)
+                if finished:
+                    break
+                job.wait(0.1)
+        except KeyboardInterrupt:
+            print('\nThe job continues in the background.')
+            return
+        print(format_job(job))
+        self.jobs.acknowledge(job)
+
+    def do_kill(self, line):
+        """
+            Usage: kill <id>
+
+            Stops a background job.
+        """
+        try:
+            job_id = int(line)
+        except ValueError:
+            print(self.do_kill.__doc__)
+            return
+        if not self.jobs.kill(job_id):
+            print('Job %d is not running.' % job_id)
+
+    def do_memo(self, line):
+        """
+            Usage: memo [stats]
+                   memo clear [<name>]
+
+            Shows the hits and misses of the functions memoized by the commands
+            (DTCommandAbs.memoize), or clears their values.
+        """
+        args = line.split()
+        if not args or args[0] == 'stats':
+            print(format_memo_stats(self.memos.stats()))
+        elif args[0] == 'clear':
+            self.memos.clear(args[1] if len(args) > 1 else None)
+        else:
+            print(self.do_memo.__doc__)
+
+    def is_busy(self):
+        """ Returns True while a command is running (also in a background job); any thread can call it. """
+        with self._busy_lock:
+            return self._busy > 0
+
+    def start_prefetch_scheduler(self, settings):
+        """ Pulls the images of the commands in the background of the interactive shell. """
+        if self.prefetch_scheduler is not None:
+            self.prefetch_scheduler.stop()
+        self.prefetch_scheduler = PrefetchScheduler(lambda: self.docker_client, settings, self.is_busy)
+        self.prefetch_scheduler.set_images(get_declared_images(self.command_classes).keys())
+        self.prefetch_scheduler.start()
+
+    def prefetch_images_after_update(self):
+        self.reload_commands()
+        images = list(get_declared_images(self.command_classes).keys())
+        if not images:
+            return
+        if self.prefetch_scheduler is not None:
+            self.prefetch_scheduler.request(images)
+        else:
+            # `dts` exits after the command: pull in a separate process
+            spawn_prefetch_process(images, get_prefetch_settings(self.config))
+
+    def do_prefetch(self, line):
+        """
+            Usage: prefetch status|now|disable
+                   prefetch enable [--parallel <n>] [--max-rate <size>] [--registry <host:port>]
+
+            Pulls the Docker images declared by the commands in the background,
+            after the commands are updated and when the machine is idle.
+            --max-rate spaces out the pulls to keep their average rate below it
+            (e.g. 10M per second; each image is still downloaded at full speed);
+            --registry pulls from a local registry (e.g. localhost:5000).
+        """
+        args = line.split()
+        action = args[0] if args else 'status'
+        declared = get_declared_images(self.command_classes)
+        if action == 'status':
+            print(format_prefetch_status(read_status(), declared=declared.keys()))
+        elif action == 'now':
+            settings = get_prefetch_settings(self.config) or {}
+            status = prefetch_images(self.docker_client, sorted(declared.keys()), settings)
+            if status is None:
+                print('Another process is pulling the images.')
+            else:
+                print(format_prefetch_status(status))
+        elif action == 'enable':
+            settings = {'enabled': True, 'parallel': 2, 'max_rate': None, 'registry': None}
+            options = args[1:]
+            try:
+                while options:
+                    option, value = options[0], options[1]
+                    options = options[2:]
+                    if option == '--parallel':
+                        settings['parallel'] = int(value)
+                    elif option == '--max-rate':
+                        settings['max_rate'] = parse_size(value)
+                    elif option == '--registry':
+                        settings['registry'] = value
+                    else:
+                        raise ValueError('Unknown option %r.' % option)
+            except IndexError:
+                print(self.do_prefetch.__doc__)
+                return
+            except ValueError as e:
+                termcolor.cprint(str(e), 'yellow')
+                return
+            self.config[DTShellConstants.CONFIG_PREFETCH] = settings
+            self.save_config()
+            if self.prefetch_scheduler is not None:
+                self.start_prefetch_scheduler(settings)
+            print('The images of the commands will be pulled in the background.')
+        elif action == 'disable':
+            self.config[DTShellConstants.CONFIG_PREFETCH] = {'enabled': False}
+            self.save_config()
+            if self.prefetch_scheduler is not None:
+                self.prefetch_scheduler.stop()
+                self.prefetch_scheduler = None
+            print('Images prefetch disabled.')
+        else:
+            print(self.do_prefetch.__doc__)
+
+    def _precompile_commands(self, path=None):
+        path = path or self.commands_path
+        print('Compiling commands...', end='')
+        previous = format_load_times(self.commands_path)
+        report = precompile_commands(path)
+        lib_zip = self.commands_importer.lib_zip
+        if lib_zip is not None:
+            make_lib_zip(path, lib_zip)
+        print('OK')
+        print('%s. Previous load times: %s.' % (report, previous))
+
+    def _set_origin_url(self, origin):
+        """ Fetches from the LAN cache server if one is configured, else from the canonical URL. """
+        current = origin.url
+        if upstreams.get_cache_server() is not None or upstreams.is_mirror_url(current):
+            url = upstreams.get_commands_remote_url()
+            if url != current:
+                origin.set_url(url, current)
+
     def _get_commands(self, path, lvl=0, all_commands=False):
         entries = glob.glob(join(path, '*'))
         files = [basename(e) for e in entries if isfile(e)]
@@ -337,14 +1040,11 @@ class DTShell(Cmd, object):
         klass.name = command
         klass.level = lvl
         klass.commands = {}
-        # attach first-level commands to the shell
+        # attach first-level commands to the shell; dispatch and completion go through the registry
         if lvl == 0:
-            do_command = getattr(klass, 'do_command')
-            complete_command = getattr(klass, 'complete_command')
             help_command = getattr(klass, 'help_command')
-            # wrap [klass, function] around a lambda function
-            do_command_lam = lambda s, w: do_command(klass, s, w)
-            complete_command_lam = lambda s, w, l, i, e: complete_command(klass, s, w, l, i, e)
+            do_command_lam = lambda s, w: s.command_registry.dispatch(s, [command] + w.split())
+            complete_command_lam = lambda s, w, l, i, e: s.command_registry.complete(s, w, l, i, e)
             help_command_lam = lambda s: help_command(klass, s)
             # add functions do_* and complete_* to the shell
             setattr(DTShell, 'do_' + command, do_command_lam)
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+    Atomic updates of the main checkout of the commands.
+
+    ~/.dt-shell/commands is a symlink to a complete tree in
+    ~/.dt-shell/commands-trees/. An update copies the current tree (with
+    hard links, so it is cheap), updates the copy and then replaces the
+    symlink with one rename: a process that starts during the update loads
+    the previous tree, never a partially updated one. A process that is
+    running keeps using the tree it loaded (the importer resolves the
+    symlink), which is kept until the next update.
+
+    Git replaces the files that it changes instead of writing them in
+    place (except logs such as the reflogs and FETCH_HEAD), so the files
+    shared by the two trees are never modified. The .pyc files are not
+    shared, as they are rewritten in place.
+
+    Where symlinks are not available (Windows), the checkout is updated in
+    place as before.
+"""
+import os
+import shutil
+import time
+
+from . import dtslogger
+from .constants import DTShellConstants
+
+KEEP_PREVIOUS_TREES = 1
+
+
+def can_swap_trees():
+    return hasattr(os, 'symlink')
+
+
+def get_trees_dir(config_path):
+    return os.path.join(config_path, DTShellConstants.COMMANDS_TREES_DIR)
+
+
+def new_tree_path(config_path):
+    d = get_trees_dir(config_path)
+    if not os.path.exists(d):
+        os.makedirs(d)
+    # sorted by creation
+    base = os.path.join(d, '%s-%d' % (time.strftime('%Y%m%d-%H%M%S'), os.getpid()))
+    path, i = base, 1
+    while os.path.lexists(path):
+        path = '%s-%d' % (base, i)
+        i += 1
+    return path
+
+
+def publish_tree(commands_path, tree):
+    """ Points commands_path to tree, atomically (commands_path must be a symlink or not exist). """
+    tmp = '%s.link-%d' % (commands_path, os.getpid())
+    if os.path.lexists(tmp):
+        os.unlink(tmp)
+    os.symlink(tree, tmp)
+    os.rename(tmp, commands_path)
+
+
+def ensure_tree_layout(config_path, commands_path):
+    """
+        Moves a checkout made by a previous version of the shell into the
+        trees directory, replacing it with a symlink. Returns the current tree.
+    """
+    if os.path.islink(commands_path):
+        return os.path.realpath(commands_path)
+    tree = new_tree_path(config_path)
+    dtslogger.debug('Moving %s to %s.', commands_path, tree)
+    # a process starting right now finds no commands, and waits for the lock held by the caller
+    os.rename(commands_path, tree)
+    publish_tree(commands_path, tree)
+    return tree
+
+
+def link_tree(src, dst):
+    """ Copies the tree src to dst with hard links (copies where they are not possible), without the .pyc files. """
+    for dirpath, dirnames, filenames in os.walk(src):
+        target = os.path.normpath(os.path.join(dst, os.path.relpath(dirpath, src)))
+        os.makedirs(target)
+        for name in list(dirnames):
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), os.path.join(target, name))
+                dirnames.remove(name)
+        for name in filenames:
+            if name.endswith('.pyc'):
+                continue
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), os.path.join(target, name))
+                continue
+            try:
+                os.link(path, os.path.join(target, name))
+            except OSError:
+                shutil.copy2(path, os.path.join(target, name))
+
+
+def repair_worktree_links(commands_path):
+    """
+        Makes the worktrees of the other versions (see commands_versions.py)
+        refer to the repository through the symlink, so that they follow it
+        to the current tree.
+    """
+    d = os.path.join(commands_path, '.git', 'worktrees')
+    if not os.path.isdir(d):
+        return
+    for name in os.listdir(d):
+        try:
+            with open(os.path.join(d, name, 'gitdir')) as f:
+                dotgit = f.read().strip()
+        except (IOError, OSError):
+            continue
+        if not os.path.isfile(dotgit):
+            continue
+        content = 'gitdir: %s\n' % os.path.join(os.path.abspath(commands_path), '.git', 'worktrees', name)
+        with open(dotgit) as f:
+            if f.read() == content:
+                continue
+        with open(dotgit, 'w') as f:
+            f.write(content)
+
+
+def remove_old_trees(config_path, commands_path, keep=KEEP_PREVIOUS_TREES):
+    """ Removes the trees other than the current one and the `keep` most recent ones before it. """
+    d = get_trees_dir(config_path)
+    if not os.path.isdir(d):
+        return
+    current = os.path.realpath(commands_path)
+    previous = [t for t in sorted(os.listdir(d), reverse=True) if os.path.join(d, t) != current]
+    for name in previous[keep:]:
+        dtslogger.debug('Removing the old commands tree %s.', name)
+        shutil.rmtree(os.path.join(d, name), ignore_errors=True)
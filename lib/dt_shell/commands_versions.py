@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+    Side-by-side versions of the commands.
+
+    Besides the main checkout in ~/.dt-shell/commands (which follows
+    DTShellConstants.COMMANDS_REPO_BRANCH), other branches or commits of the
+    commands can be checked out as git worktrees in
+    ~/.dt-shell/commands-versions/. The worktrees share the object store of
+    the main checkout, so adding one does not clone anything and switching
+    between them only changes the path recorded in the configuration.
+"""
+import hashlib
+import os
+import re
+
+from git import Repo
+from git.exc import BadName, GitCommandError
+
+from . import dtslogger
+from .constants import DTShellConstants
+
+
+class InvalidCommandsVersion(Exception):
+    pass
+
+
+def get_versions_dir(config_path):
+    return os.path.join(config_path, DTShellConstants.COMMANDS_VERSIONS_DIR)
+
+
+def get_worktree_path(config_path, ref):
+    safe = re.sub(r'[^A-Za-z0-9._-]', '_', ref)
+    # tells apart the refs that differ only in the replaced characters (feature/x, feature_x)
+    h = hashlib.sha1(ref.encode('utf-8')).hexdigest()[:8]
+    return os.path.join(get_versions_dir(config_path), '%s-%s' % (safe, h))
+
+
+def get_ref_filename(worktree_path):
+    """ The file, next to the worktree, with the ref it was created for. """
+    return worktree_path + '.ref'
+
+
+def is_default_version(ref):
+    return ref in [None, '', DTShellConstants.COMMANDS_REPO_BRANCH]
+
+
+def get_commands_path_for_version(config_path, main_path, ref):
+    """ Returns the path of the commands for the given version (None = the main checkout). """
+    if is_default_version(ref):
+        return main_path
+    path = get_worktree_path(config_path, ref)
+    if not os.path.exists(path):
+        msg = 'The commands version %r is not available anymore (%s); using the default.' % (ref, path)
+        dtslogger.warning(msg)
+        return main_path
+    return path
+
+
+def get_commands_branch(commands_repo):
+    """ Returns the name of the branch checked out, or None if the worktree is pinned to a commit. """
+    if commands_repo.head.is_detached:
+        return None
+    return commands_repo.active_branch.name
+
+
+def add_commands_version(config_path, main_path, ref):
+    """
+        Makes sure that a worktree for `ref` (a branch of the remote, or a
+        commit) exists; returns its path. Fetches from origin only if the ref is
+        not known locally.
+    """
+    if is_default_version(ref):
+        return main_path
+    path = get_worktree_path(config_path, ref)
+    if os.path.exists(path):
+        return path
+
+    main_repo = Repo(main_path)
+    origin = main_repo.remote('origin')
+    branch_ref = _resolve(main_repo, origin, ref)
+    if branch_ref is None:
+        dtslogger.info('Fetching %r from %s...', ref, list(origin.urls))
+        origin.fetch()
+        branch_ref = _resolve(main_repo, origin, ref)
+        if branch_ref is None:
+            msg = 'Cannot find a branch or commit %r in the commands repository.' % ref
+            raise InvalidCommandsVersion(msg)
+
+    versions_dir = get_versions_dir(config_path)
+    if not os.path.exists(versions_dir):
+        os.makedirs(versions_dir)
+    try:
+        if branch_ref is True:
+            # a commit: pin the worktree to it
+            main_repo.git.worktree('add', '--detach', path, ref)
+        else:
+            # a branch: a local branch that tracks the remote one, so that `update` works
+            main_repo.git.worktree('add', '-B', ref, path, branch_ref)
+    except GitCommandError as e:
+        msg = 'Could not create a worktree for %r:\n%s' % (ref, e)
+        raise InvalidCommandsVersion(msg)
+
+    Repo(path).submodule_update(recursive=True, to_latest_revision=False)
+    with open(get_ref_filename(path), 'w') as f:
+        f.write(ref)
+    return path
+
+
+def _resolve(repo, origin, ref):
+    """ Returns the remote branch name for ref, True if ref is a commit, or None if unknown. """
+    remote_branch = '%s/%s' % (origin.name, ref)
+    if remote_branch in [r.name for r in origin.refs]:
+        return remote_branch
+    try:
+        repo.commit(ref)
+        return True
+    except (BadName, ValueError, GitCommandError):
+        return None
+
+
+def list_commands_versions(config_path):
+    """ Returns the refs that have a worktree. """
+    d = get_versions_dir(config_path)
+    if not os.path.exists(d):
+        return []
+    refs = []
+    for name in os.listdir(d):
+        path = os.path.join(d, name)
+        if not os.path.isdir(path):
+            continue
+        try:
+            with open(get_ref_filename(path)) as f:
+                refs.append(f.read().strip())
+        except (IOError, OSError):
+            continue
+    return sorted(refs)
+
+
+def remove_commands_version(config_path, main_path, ref):
+    path = get_worktree_path(config_path, ref)
+    if not os.path.exists(path):
+        return False
+    Repo(main_path).git.worktree('remove', '--force', path)
+    try:
+        os.unlink(get_ref_filename(path))
+    except OSError:
+        pass
+    return True
@@ -7,7 +7,33 @@ class DTShellConstants(object):
     COMMANDS_REPO_BRANCH = 'master'
     COMMANDS_REMOTE_URL = 'https://github.com/%s/%s' % (COMMANDS_REPO_OWNER, COMMANDS_REPO_NAME)
     ROOT = '~/.dt-shell/'
+    # other versions of the commands, as worktrees of the main checkout (relative to ROOT)
+    COMMANDS_VERSIONS_DIR = 'commands-versions'
+    # snapshots of the main checkout; ~/.dt-shell/commands is a symlink to the current one (relative to ROOT)
+    COMMANDS_TREES_DIR = 'commands-trees'
     ENV_COMMANDS = 'DTSHELL_COMMANDS'
+    # if set (to an interval in seconds), the interactive shell reloads the commands that change
+    ENV_WATCH = 'DTSHELL_WATCH'
+    # if set to the path of a zip archive, the `lib` of the commands is imported from there
+    ENV_LIB_ZIP = 'DTSHELL_LIB_ZIP'
+    # base URL of a LAN cache server (`dts cache-server`) to use instead of PyPI, GitHub
+    ENV_CACHE_SERVER = 'DTSHELL_CACHE_SERVER'
+    # if set to `sample` or `full`, every command is profiled (see profiling.py)
+    ENV_PROFILE = 'DTSHELL_PROFILE'
+    # if set, every command gets a memory report; the budget (e.g. 512M) stops commands that exceed it
+    ENV_MEMORY_TRACE = 'DTSHELL_MEMORY_TRACE'
+    ENV_MEMORY_BUDGET = 'DTSHELL_MEMORY_BUDGET'
+    # set to 0 to stop recording the commands run and their duration
+    ENV_HISTORY = 'DTSHELL_HISTORY'
+    # per-module log levels (e.g. dts=INFO,remote=DEBUG) and log format (text or json); see logs.py
+    ENV_LOG_LEVELS = 'DTSHELL_LOG_LEVELS'
+    ENV_LOG_FORMAT = 'DTSHELL_LOG_FORMAT'
 
     DT1_TOKEN_CONFIG_KEY = 'token_dt1'
     CONFIG_DOCKER_USERNAME = 'docker_username'
+    CONFIG_COMMANDS_VERSION = 'commands_version'
+    CONFIG_CACHE_SERVER = 'cache_server'
+    # {"enabled": true, "parallel": 2, "max_rate": <bytes/s>, "registry": "host:port"}
+    CONFIG_PREFETCH = 'prefetch_images'
+    CONFIG_LOG_LEVELS = 'log_levels'
+    CONFIG_LOG_FORMAT = 'log_format'
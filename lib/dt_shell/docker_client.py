@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import atexit
+import json
+import threading
+
+from . import dtslogger
+from .local_cache import DOCKER_API_VERSION, NoCacheAvailable, cache_get, cache_set
+
+# Number of connections kept open to the daemon; enough for the worker
+# threads of a command that operates on many containers/images at once.
+DOCKER_POOL_SIZE = 16
+DOCKER_TIMEOUT = 60
+
+
+class Storage(object):
+    lock = threading.Lock()
+    client = None
+
+
+def get_docker_client():
+    """
+        Returns the docker.DockerClient shared by the whole process.
+
+        The client is created on first use, has a connection pool of
+        DOCKER_POOL_SIZE connections and is safe to use from worker threads.
+        The API version negotiated with the daemon is cached on disk so that
+        the negotiation is only repeated when the daemon changes.
+    """
+    if Storage.client is not None:
+        return Storage.client
+    with Storage.lock:
+        if Storage.client is None:
+            Storage.client = _create_docker_client()
+            atexit.register(close_docker_client)
+    return Storage.client
+
+
+def close_docker_client():
+    with Storage.lock:
+        client = Storage.client
+        Storage.client = None
+    if client is not None:
+        try:
+            client.close()
+        except Exception as e:
+            dtslogger.debug('Error while closing the docker client: %s', e)
+
+
+def _create_docker_client():
+    import docker
+
+    daemon_id = _get_daemon_id()
+    version = read_api_version_cache(daemon_id)
+    client = _from_env(docker, version or 'auto')
+    if version is None:
+        write_api_version_cache(daemon_id, client.api.api_version)
+    return client
+
+
+def _from_env(docker, version):
+    kwargs = dict(version=version, timeout=DOCKER_TIMEOUT)
+    try:
+        return docker.from_env(max_pool_size=DOCKER_POOL_SIZE, **kwargs)
+    except TypeError:
+        # older versions of docker-py do not let us choose the pool size
+        return docker.from_env(**kwargs)
+
+
+def _get_daemon_id():
+    """ Identifies the daemon we are talking to: the API version is cached per daemon. """
+    from .env_checks import get_environment_fingerprint
+    fingerprint = get_environment_fingerprint()
+    return [fingerprint['docker_host'], fingerprint['docker_socket']]
+
+
+def read_api_version_cache(daemon_id):
+    try:
+        return cache_get(DOCKER_API_VERSION, key=json.dumps(daemon_id))
+    except NoCacheAvailable:
+        return None
+
+
+def write_api_version_cache(daemon_id, version):
+    cache_set(DOCKER_API_VERSION, version, key=json.dumps(daemon_id))
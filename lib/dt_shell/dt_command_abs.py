@@ -2,6 +2,9 @@
 
 from abc import ABCMeta, abstractmethod
 
+from .history import STATUS_NOT_FOUND
+from .memoize import memoize
+
 
 class DTCommandAbs(object):
     __metaclass__ = ABCMeta
@@ -11,6 +14,8 @@ class DTCommandAbs(object):
     help = None
     commands = None
     fake = False
+    # Docker images used by the command, pulled in the background (see prefetch.py)
+    images = None
 
     @staticmethod
     @abstractmethod
@@ -21,6 +26,9 @@ class DTCommandAbs(object):
     def complete(shell, word, line):
         return []
 
+    # decorator for session-scoped memoization of expensive functions, see memoize.py
+    memoize = staticmethod(memoize)
+
     @staticmethod
     def fail(msg):
         raise Exception(msg)
@@ -32,12 +40,15 @@ class DTCommandAbs(object):
         parts = [p.strip() for p in line.split(' ')]
         args = [p for p in parts if len(p) > 0]
         word = parts[0]
+        if getattr(shell, 'command_path', None) is not None:
+            shell.command_path.append(cls.name)
         # print '[%s, %r]@(%s, %s)' % (word, parts, cls.name, cls.__class__)
         if len(word) > 0:
             if len(cls.commands) > 0:
                 if word in cls.commands:
                     cls.commands[word].do_command(cls.commands[word], shell, ' '.join(parts[1:]))
                 else:
+                    shell.command_status = STATUS_NOT_FOUND
                     print('Command `%s` not recognized.\nAvailable sub-commands are:\n\n\t%s' % (
                     word.strip(), '\n\t'.join(cls.commands.keys())))
             else:
@@ -1,45 +1,190 @@
 import getpass
+import imp
+import os
 import sys
+import threading
 
 from system_cmd import system_cmd_result, CmdException
 from whichcraft import which
 
 from dt_shell.constants import DTShellConstants
+from dt_shell.local_cache import ENV_CHECK, NoCacheAvailable, cache_get, cache_set
 
 
 class InvalidEnvironment(Exception):
     pass
 
 
+DEFAULT_DOCKER_SOCKET = '/var/run/docker.sock'
+
+
 def check_docker_environment():
+    """
+        Checks that docker is installed, usable by the current user and
+        that the daemon answers.
+
+        The result of a successful check is cached on disk, keyed by
+        a fingerprint of the environment (see get_environment_fingerprint());
+        the checks are only re-run when the fingerprint changes.
+    """
+    fingerprint = get_environment_fingerprint()
+    if read_env_check_cache() == fingerprint:
+        return
+
     print('checking docker environment')
+    checks = [check_docker_executable, check_docker_groups, check_docker_daemon]
+    # in the threads, the imports would wait for py2's import lock, which is held
+    # if we are called while a module (e.g. a command) is being imported
+    import_error = import_check_modules()
+    if import_error is not None:
+        errors = run_concurrently(checks[:-1])
+        errors[check_docker_daemon] = import_error
+    else:
+        errors = run_concurrently(checks)
+    # report the first failure in the order in which the checks are listed
+    for check in checks:
+        if check in errors:
+            raise errors[check]
+
+    write_env_check_cache(fingerprint)
+
+
+def import_check_modules():
+    """
+        Imports the modules that the checks need, in the calling thread.
+        Returns the InvalidEnvironment to raise if docker cannot be imported.
+    """
+    try:
+        import grp
+    except ImportError:  # Windows
+        pass
+    try:
+        import docker
+    except Exception as e:
+        return docker_import_error(e)
+    from . import docker_client
+    return None
+
+
+def docker_import_error(e):
+    msg = 'Could not import package docker:\n%s' % e
+    msg += '\n\nTry    pip install --user -U docker'
+    return InvalidEnvironment(msg)
+
+
+def run_concurrently(functions):
+    """
+        Runs the functions in parallel threads; returns a dict function -> exception raised.
+
+        The modules that the functions import must already be imported (see
+        import_check_modules()). With py2's global import lock, any import
+        statement in the threads (even of a module already imported, e.g. in
+        getpass) would wait for the caller if it is itself being imported;
+        in that case the functions are run one after the other.
+    """
+    errors = {}
+    if imp.lock_held():
+        for f in functions:
+            try:
+                f()
+            except Exception as e:
+                errors[f] = e
+        return errors
+
+    def wrap(f):
+        def run():
+            try:
+                f()
+            except Exception as e:
+                errors[f] = e
+
+        return run
+
+    threads = [threading.Thread(target=wrap(f)) for f in functions]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    return errors
+
+
+def check_docker_executable():
     check_executable_exists('docker')
 
+
+def check_docker_groups():
     if on_linux():
         username = getpass.getuser()
         if username != 'root':
             check_user_in_group('docker')
-        print('checked groups')
-    else:
-        print('skipping env check')
 
 
+def check_docker_daemon():
     try:
         import docker
     except Exception as e:
-        msg ='Could not import package docker:\n%s' % e
-        msg += '\n\nTry    pip install --user -U docker'
-        raise InvalidEnvironment(msg)
+        raise docker_import_error(e)
 
+    from .docker_client import get_docker_client
     try:
-        client = docker.from_env()
-        containers = client.containers.list(filters=dict(status='running'))
+        client = get_docker_client()
+        # a ping is much cheaper than listing the containers
+        client.ping()
     except Exception as e:
         msg = 'I cannot communicate with Docker:\n%s' % e
         msg += '\n\nMake sure the docker service is running.'
         raise InvalidEnvironment(msg)
 
 
+def get_docker_socket():
+    """ Returns the path of the unix socket used to talk to the daemon, or None if not using one. """
+    host = os.environ.get('DOCKER_HOST', None)
+    if not host:
+        return DEFAULT_DOCKER_SOCKET
+    if host.startswith('unix://'):
+        return host[len('unix://'):]
+    return None
+
+
+def get_environment_fingerprint():
+    """
+        Returns a JSON-serializable description of the parts of the environment
+        that determine the outcome of check_docker_environment(): user,
+        group IDs, docker binary and docker socket identity.
+
+        It costs a few stat() calls.
+    """
+    socket = get_docker_socket()
+    if socket is not None:
+        try:
+            st = os.stat(socket)
+            socket_id = [socket, st.st_ino, st.st_mtime]
+        except OSError:
+            socket_id = [socket, None, None]
+    else:
+        socket_id = None
+
+    return {
+        'user': getpass.getuser(),
+        'groups': sorted(os.getgroups()) if hasattr(os, 'getgroups') else None,
+        'docker_host': os.environ.get('DOCKER_HOST', None),
+        'docker_socket': socket_id,
+        'docker_binary': which('docker'),
+    }
+
+
+def read_env_check_cache():
+    """ Returns the fingerprint of the last successful check, or None. """
+    try:
+        return cache_get(ENV_CHECK)
+    except NoCacheAvailable:
+        return None
+
+
+def write_env_check_cache(fingerprint):
+    cache_set(ENV_CHECK, fingerprint)
+
 
 def on_linux():
     return sys.platform.startswith('linux')
@@ -53,7 +198,7 @@ def check_executable_exists(cmdname):
 
 
 def check_user_in_group(name):
-    active_groups = get_active_groups(username=None)
+    active_groups = get_process_groups()
 
     if name not in active_groups:
         msg = 'The user is not in group "%s".' % name
@@ -72,6 +217,24 @@ def check_git_supports_superproject():
                             env=None)
 
 
+def get_process_groups():
+    """ Returns the names of the groups of this process, without spawning `groups`. """
+    try:
+        import grp
+    except ImportError:
+        return get_active_groups(username=None)
+
+    gids = set(os.getgroups())
+    gids.add(os.getegid())
+    names = []
+    for gid in gids:
+        try:
+            names.append(grp.getgrgid(gid).gr_name)
+        except KeyError:
+            names.append(str(gid))
+    return names
+
+
 def get_active_groups(username=None):
     cmd = ['groups']
 
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+    Log of the commands run and of how long they took, and the statistics
+    shown by the `stats` command.
+
+    Each dispatch appends one JSON line to ~/.dt-shell/history/commands.jsonl:
+
+        {"t": <timestamp>, "c": "<command path>", "d": <seconds>, "s": "<status>"}
+
+    where status is one of `ok`, `error`, `interrupted`, `not-found`. The
+    writes are done by a background thread, so that the command does not wait
+    for the disk; the log is rotated when it exceeds MAX_BYTES.
+"""
+from __future__ import print_function
+
+import atexit
+import json
+import math
+import os
+import threading
+from collections import defaultdict
+
+from . import dtslogger
+from .constants import DTShellConstants
+
+try:
+    from Queue import Queue
+except ImportError:  # Python 3
+    from queue import Queue
+
+MAX_BYTES = 1024 * 1024
+BACKUPS = 3
+CLOSE_TIMEOUT = 2.0
+
+STATUS_OK = 'ok'
+STATUS_ERROR = 'error'
+STATUS_INTERRUPTED = 'interrupted'
+STATUS_NOT_FOUND = 'not-found'
+
+
+def get_history_filename():
+    d0 = os.path.expanduser(DTShellConstants.ROOT)
+    return os.path.join(d0, 'history', 'commands.jsonl')
+
+
+def is_history_enabled():
+    return os.environ.get(DTShellConstants.ENV_HISTORY, '1').strip() not in ['0', 'false', 'no']
+
+
+class HistoryLog(object):
+    """ Append-only log with asynchronous writes and size-based rotation. """
+
+    def __init__(self, filename, max_bytes=MAX_BYTES, backups=BACKUPS):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.queue = Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def record(self, command, duration, status, timestamp):
+        entry = {'t': round(timestamp, 3), 'c': command, 'd': round(duration, 6), 's': status}
+        self._ensure_thread()
+        self.queue.put(entry)
+
+    def _ensure_thread(self):
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='dts-history')
+                self.thread.daemon = True
+                self.thread.start()
+                atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            entry = self.queue.get()
+            if entry is None:
+                self.queue.task_done()
+                return
+            entries = [entry]
+            # write whatever else is pending in one go
+            while not self.queue.empty():
+                e = self.queue.get()
+                if e is None:
+                    self.queue.put(None)
+                    self.queue.task_done()
+                    break
+                entries.append(e)
+            try:
+                self._write(entries)
+            except (IOError, OSError) as e:
+                dtslogger.debug('Cannot write the history: %s', e)
+            for _ in entries:
+                self.queue.task_done()
+
+    def _write(self, entries):
+        d = os.path.dirname(self.filename)
+        if not os.path.exists(d):
+            os.makedirs(d)
+        data = ''.join(json.dumps(e, separators=(',', ':')) + '\n' for e in entries)
+        with open(self.filename, 'a') as f:
+            f.write(data)
+            size = f.tell()
+        if size > self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            src = '%s.%d' % (self.filename, i)
+            if os.path.exists(src):
+                os.rename(src, '%s.%d' % (self.filename, i + 1))
+        os.rename(self.filename, self.filename + '.1')
+
+    def flush(self):
+        """ Waits until all the recorded entries are written. """
+        if self.thread is not None:
+            self.queue.join()
+
+    def close(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join(CLOSE_TIMEOUT)
+
+    def read(self):
+        """ Returns all the entries, oldest first, including the rotated files. """
+        files = ['%s.%d' % (self.filename, i) for i in range(self.backups, 0, -1)] + [self.filename]
+        entries = []
+        for fn in files:
+            if not os.path.exists(fn):
+                continue
+            with open(fn) as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        # e.g. a line cut by a crash
+                        continue
+        return entries
+
+
+class Storage(object):
+    log = None
+
+
+def get_history_log():
+    if Storage.log is None:
+        Storage.log = HistoryLog(get_history_filename())
+    return Storage.log
+
+
+def percentile(sorted_values, p):
+    """ Nearest-rank percentile of an already sorted list. """
+    if not sorted_values:
+        return None
+    k = int(math.ceil(p / 100.0 * len(sorted_values))) - 1
+    return sorted_values[max(0, min(k, len(sorted_values) - 1))]
+
+
+class CommandStats(object):
+
+    def __init__(self, command, durations, errors):
+        self.command = command
+        self.durations = sorted(durations)
+        self.count = len(durations)
+        self.errors = errors
+        self.p50 = percentile(self.durations, 50)
+        self.p95 = percentile(self.durations, 95)
+        self.max = self.durations[-1]
+        self.total = sum(self.durations)
+
+
+def compute_stats(entries):
+    """ Returns a list of CommandStats, one for each command path. """
+    durations = defaultdict(list)
+    errors = defaultdict(int)
+    for e in entries:
+        try:
+            c, d, s = e['c'], float(e['d']), e['s']
+        except (KeyError, TypeError, ValueError):
+            continue
+        durations[c].append(d)
+        if s != STATUS_OK:
+            errors[c] += 1
+    return [CommandStats(c, durations[c], errors[c]) for c in durations]
+
+
+def format_stats(stats, top=10):
+    def table(title, rows):
+        lines = [title, '',
+                 '  %-40s %7s %9s %9s %9s %6s' % ('command', 'runs', 'p50', 'p95', 'max', 'fail')]
+        for s in rows:
+            lines.append('  %-40s %7d %8.3fs %8.3fs %8.3fs %6d' % (s.command[:40], s.count, s.p50, s.p95,
+                                                                   s.max, s.errors))
+        return lines
+
+    if not stats:
+        return 'No commands recorded yet.'
+    slowest = sorted(stats, key=lambda s: -s.p95)[:top]
+    frequent = sorted(stats, key=lambda s: -s.count)[:top]
+    lines = table('Slowest commands (by p95):', slowest) + [''] + table('Most frequent commands:', frequent)
+    return '\n'.join(lines)
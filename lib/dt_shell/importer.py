@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+    Import hook for the commands repository.
+
+    Instead of prepending the commands directory and its `lib` to sys.path
+    (which makes every import in the process, stdlib included, probe those
+    directories first), the shell installs a CommandsImporter in
+    sys.meta_path. It knows the top-level packages of the commands and of
+    `lib` from an index built at discovery time, answers only for those,
+    and leaves everything else to the normal import machinery.
+
+    Optionally, `lib` can be imported from a single zip archive (see
+    make_lib_zip() and DTShellConstants.ENV_LIB_ZIP).
+"""
+import imp
+import marshal
+import os
+import pkgutil
+import struct
+import sys
+import zipfile
+import zipimport
+
+from . import dtslogger
+from .bytecode import find_cached_module
+from .constants import DTShellConstants
+
+SKIP_DIRS = ['.git', 'lib']
+
+
+def get_module_suffixes():
+    return [s[0] for s in imp.get_suffixes()]
+
+
+def index_directory(d, skip=()):
+    """ Returns a dict name -> d for the top-level modules and packages in directory d. """
+    index = {}
+    if not os.path.isdir(d):
+        return index
+    suffixes = get_module_suffixes()
+    for f in os.listdir(d):
+        if f in skip:
+            continue
+        full = os.path.join(d, f)
+        if os.path.isdir(full):
+            if os.path.isfile(os.path.join(full, '__init__.py')):
+                index[f] = d
+        else:
+            for suffix in suffixes:
+                if f.endswith(suffix):
+                    index[f[:-len(suffix)]] = d
+                    break
+    return index
+
+
+def index_zip(zip_path):
+    """ Returns the set of top-level modules and packages in a zip archive. """
+    names = set()
+    with zipfile.ZipFile(zip_path) as z:
+        for n in z.namelist():
+            first = n.split('/', 1)[0]
+            if '/' in n:
+                names.add(first)
+            elif first.endswith('.py') or first.endswith('.pyc'):
+                names.add(first.rsplit('.', 1)[0])
+    return names
+
+
+def make_lib_zip(commands_path, zip_path):
+    """
+        Creates a zip archive with the sources and the bytecode of the
+        `lib` directory of the commands.
+    """
+    lib = os.path.join(commands_path, 'lib')
+    tmp = zip_path + '.tmp-%s' % os.getpid()
+    with zipfile.ZipFile(tmp, 'w', zipfile.ZIP_DEFLATED) as z:
+        for dirpath, dirnames, filenames in os.walk(lib):
+            dirnames[:] = [x for x in dirnames if x != '.git']
+            for f in filenames:
+                if not f.endswith('.py'):
+                    continue
+                full = os.path.join(dirpath, f)
+                arcname = os.path.relpath(full, lib)
+                z.write(full, arcname)
+                try:
+                    bytecode = compile_to_bytecode(full)
+                except SyntaxError as e:
+                    dtslogger.debug('Cannot compile %s: %s', full, e)
+                    continue
+                info = zipfile.ZipInfo(arcname + 'c', z.getinfo(arcname).date_time)
+                info.compress_type = zipfile.ZIP_DEFLATED
+                z.writestr(info, bytecode)
+    os.rename(tmp, zip_path)
+    forget_zip_directory(zip_path)
+    return zip_path
+
+
+def forget_zip_directory(zip_path):
+    """
+        zipimport caches the directory (names and offsets) of each archive it
+        opened, by path: it must be dropped when the archive is rewritten.
+    """
+    cache = getattr(zipimport, '_zip_directory_cache', None)
+    if cache is None:
+        return
+    for k in set([zip_path, os.path.abspath(zip_path), os.path.realpath(zip_path)]):
+        cache.pop(k, None)
+
+
+def compile_to_bytecode(source):
+    """ Returns the contents of the .pyc file for source. """
+    with open(source, 'rU') as f:
+        code = compile(f.read() + '\n', source, 'exec')
+    mtime = int(os.stat(source).st_mtime) & 0xFFFFFFFF
+    return imp.get_magic() + struct.pack('<I', mtime) + marshal.dumps(code)
+
+
+def get_lib_zip(commands_path):
+    """
+        Returns the zip archive to use for `lib` if requested with the env
+        variable DTShellConstants.ENV_LIB_ZIP, creating it if needed; else None.
+    """
+    zip_path = os.environ.get(DTShellConstants.ENV_LIB_ZIP, '')
+    if not zip_path:
+        return None
+    zip_path = os.path.expanduser(zip_path)
+    if not os.path.exists(zip_path) and os.path.isdir(os.path.join(commands_path, 'lib')):
+        dtslogger.info('Creating archive %s with the libraries of the commands.', zip_path)
+        make_lib_zip(commands_path, zip_path)
+    return zip_path
+
+
+class CommandsImporter(object):
+    """
+        Finder (PEP 302) for the top-level packages of the commands tree and of its `lib`.
+
+        If the tree (or part of it) is read-only, bytecode_dir is the
+        directory with its precompiled bytecode (see bytecode.py); in that
+        case the finder also serves the submodules of the tree from there.
+    """
+
+    def __init__(self, commands_path, bytecode_dir=None, lib_zip=None):
+        self.commands_path = os.path.realpath(commands_path)
+        self.lib_path = os.path.join(self.commands_path, 'lib')
+        self.bytecode_dir = bytecode_dir
+        self.lib_zip = lib_zip
+        self.zip_importer = None
+        self.index = {}
+        self.zip_index = set()
+        self.refresh()
+
+    def refresh(self):
+        """ Rebuilds the index of the top-level names; call it after the tree changes. """
+        index = {}
+        zip_index = set()
+        if self.lib_zip is not None and os.path.exists(self.lib_zip):
+            zip_index = index_zip(self.lib_zip)
+            # the archive may have been rewritten (by this process or another one)
+            forget_zip_directory(self.lib_zip)
+            self.zip_importer = zipimport.zipimporter(self.lib_zip)
+        else:
+            index.update(index_directory(self.lib_path))
+        # the commands take precedence, as when they were both prepended to sys.path
+        index.update(index_directory(self.commands_path, skip=SKIP_DIRS))
+        self.index = index
+        self.zip_index = zip_index
+
+    def find_module(self, fullname, path=None):
+        if path is not None:
+            if self.bytecode_dir is None:
+                return None
+            return self._find_submodule(fullname, path)
+        if fullname in self.index:
+            d = self.index[fullname]
+            if self.bytecode_dir is not None:
+                loader = find_cached_module(self.commands_path, self.bytecode_dir, d, fullname)
+                if loader is not None:
+                    return loader
+            return pkgutil.ImpImporter(d).find_module(fullname)
+        if fullname in self.zip_index:
+            return self.zip_importer.find_module(fullname)
+        return None
+
+    def _find_submodule(self, fullname, path):
+        name = fullname.rpartition('.')[2]
+        for d in path:
+            d = os.path.realpath(d)
+            if d == self.commands_path or d.startswith(self.commands_path + os.sep):
+                return find_cached_module(self.commands_path, self.bytecode_dir, d, name)
+        return None
+
+    def __repr__(self):
+        return 'CommandsImporter(%r)' % self.commands_path
+
+
+def install_commands_importer(commands_path, bytecode_dir=None, lib_zip=None):
+    """ Installs (or replaces) the importer for this commands tree in sys.meta_path. """
+    importer = CommandsImporter(commands_path, bytecode_dir=bytecode_dir, lib_zip=lib_zip)
+    sys.meta_path[:] = [f for f in sys.meta_path
+                        if not (isinstance(f, CommandsImporter) and f.commands_path == importer.commands_path)]
+    sys.meta_path.insert(0, importer)
+    dtslogger.debug('Installed %r with %d top-level names.', importer, len(importer.index))
+    return importer
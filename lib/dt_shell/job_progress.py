@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+"""
+    Streaming of the progress and partial stats of an evaluator job.
+
+        reporter = JobProgressReporter(token, job_id, interval=5)
+        for i, episode in enumerate(episodes):
+            ...
+            reporter.set_progress(fraction=(i + 1.0) / len(episodes), message=episode)
+            reporter.update_stats({'episode-%d' % i: score})
+        reporter.report('success', final_stats, machine_id, process_id, container, version)
+
+    The updates are only merged in memory; a background thread sends what
+    changed every `interval` seconds (POST /job-progress). If the server is
+    slow or cannot be reached, the updates keep being merged into the next
+    batch (the latest value of each key wins), so what is waiting to be sent
+    does not grow with the number of updates, and the thread waits longer
+    between attempts (up to MAX_BACKOFF).
+
+    Everything streamed is also written, at each batch, to a journal in
+    ~/.dt-shell/job-progress/<job_id>.json: an evaluator restarted on the
+    same job continues from there (and sends what was not sent), so at most
+    the updates of the last interval are lost if it crashes. report() sends
+    the final report with the streamed stats merged into the final ones,
+    then removes the journal. replay_job_progress() sends what was left
+    unsent by the evaluators that did not restart, and removes the journals.
+
+    The thread of a reporter holds a lock on the journal (<job_id>.lock)
+    while it runs: replay_job_progress() skips the journals that are locked,
+    and there cannot be two reporters for the same job. The lock files are
+    not removed with the journals.
+"""
+import json
+import os
+import threading
+import time
+
+from . import dtslogger
+from .constants import DTShellConstants
+from .local_cache import write_atomic
+from .locking import FileLock
+from .remote import RequestException, RequestFailed, dtserver_report_job, dtserver_report_job_progress
+
+DEFAULT_INTERVAL = 5.0
+MAX_BACKOFF = 60.0
+SEND_TIMEOUT = 10
+CLOSE_TIMEOUT = SEND_TIMEOUT + 5
+
+
+def get_job_progress_dir():
+    d0 = os.path.expanduser(DTShellConstants.ROOT)
+    return os.path.join(d0, 'job-progress')
+
+
+def get_job_progress_journal_filename(job_id, d=None):
+    return os.path.join(d or get_job_progress_dir(), '%s.json' % job_id)
+
+
+def get_journal_lock_filename(fn):
+    return os.path.splitext(fn)[0] + '.lock'
+
+
+def next_seq(seq):
+    # also greater than the last seq sent from a journal that was removed since
+    return max(seq + 1, int(time.time() * 1000))
+
+
+def remove_journal(fn):
+    """
+        Removes the journal; to be called with the lock held. The (empty) lock
+        file stays: removing it while locked would let a new reporter lock a
+        new file of the same name while another process waits on the old one.
+    """
+    try:
+        os.unlink(fn)
+    except OSError:
+        pass
+
+
+class JobProgressLocked(Exception):
+    pass
+
+
+def read_job_progress_journal(fn):
+    try:
+        with open(fn) as f:
+            journal = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    return journal if isinstance(journal, dict) else None
+
+
+class JobProgressReporter(object):
+
+    def __init__(self, token, job_id, interval=DEFAULT_INTERVAL, journal_dir=None):
+        self.token = token
+        self.job_id = job_id
+        self.interval = interval
+        self.journal = get_job_progress_journal_filename(job_id, journal_dir)
+        self.cond = threading.Condition()
+        # everything streamed, and what is still to be sent
+        self.progress = {}
+        self.stats = {}
+        self.unsent_progress = {}
+        self.unsent_stats = {}
+        self.seq = 0
+        self.updates = self.batches = self.failures = 0
+        self.error = None
+        self.closed = False
+        self.reported = False
+        # set by the thread once it sent what it could after close()
+        self.stopped = threading.Event()
+        # set by report() once the journal is removed (or by close()): the thread can release the lock
+        self.finished = threading.Event()
+        self.started = threading.Event()
+        self.locked = False
+
+        # the lock is held by the thread, as the locks are per thread
+        self.lock = FileLock(get_journal_lock_filename(self.journal))
+        self.thread = threading.Thread(target=self._run, name='dts-job-progress-%s' % job_id)
+        self.thread.daemon = True
+        self.thread.start()
+        self.started.wait()
+        if not self.locked:
+            self.thread.join()
+            msg = 'The progress of job %s is already being reported (%s is locked).' % (job_id, self.lock.filename)
+            raise JobProgressLocked(msg)
+
+        journal = read_job_progress_journal(self.journal)
+        if journal is not None and journal.get('job_id') == job_id:
+            dtslogger.debug('Continuing the progress of job %s from %s.', job_id, self.journal)
+            with self.cond:
+                self.progress = journal.get('progress', {})
+                self.stats = journal.get('stats', {})
+                self.unsent_progress = journal.get('unsent_progress', {})
+                self.unsent_stats = journal.get('unsent_stats', {})
+                self.seq = journal.get('seq', 0)
+
+    def set_progress(self, fraction=None, message=None, **extra):
+        """ Any other JSON-serializable values can be passed as keyword arguments. """
+        update = dict(extra)
+        if fraction is not None:
+            update['fraction'] = fraction
+        if message is not None:
+            update['message'] = message
+        self._update(self.progress, self.unsent_progress, update)
+
+    def update_stats(self, stats=None, **kwargs):
+        """ Merges the (JSON-serializable) partial stats into the ones already streamed. """
+        update = dict(stats or {})
+        update.update(kwargs)
+        self._update(self.stats, self.unsent_stats, update)
+
+    def _update(self, streamed, unsent, update):
+        with self.cond:
+            if self.closed:
+                raise ValueError('The progress of job %s was already closed.' % self.job_id)
+            streamed.update(update)
+            unsent.update(update)
+            self.updates += 1
+
+    def _run(self):
+        self.locked = self.lock.acquire(timeout=0)
+        self.started.set()
+        if not self.locked:
+            return
+        try:
+            try:
+                self._send_loop()
+            finally:
+                self.stopped.set()
+            # keep the lock until the journal is removed
+            self.finished.wait()
+        finally:
+            self.lock.release()
+
+    def _send_loop(self):
+        delay = self.interval
+        while True:
+            with self.cond:
+                if not self.closed:
+                    self.cond.wait(delay)
+                closing = self.closed
+                if self.error is not None or not (self.unsent_progress or self.unsent_stats):
+                    if closing:
+                        return
+                    continue
+                # a new seq for each attempt: the server may have applied a batch whose answer was lost
+                self.seq = next_seq(self.seq)
+                seq = self.seq
+                progress, self.unsent_progress = self.unsent_progress, {}
+                stats, self.unsent_stats = self.unsent_stats, {}
+                self._write_journal(progress, stats)
+            try:
+                dtserver_report_job_progress(self.token, self.job_id, seq, progress, stats, timeout=SEND_TIMEOUT)
+                sent = True
+            except RequestFailed as e:
+                # e.g. the job was already reported or reassigned: no use insisting
+                dtslogger.warning('Stopping the progress reports of job %s: %s', self.job_id, e)
+                sent = False
+                self.error = str(e)
+            except RequestException as e:
+                dtslogger.debug('Cannot send the progress of job %s: %s', self.job_id, e)
+                sent = False
+            with self.cond:
+                if sent:
+                    self.batches += 1
+                    delay = self.interval
+                else:
+                    self.failures += 1
+                    # the updates made in the meantime are newer
+                    progress.update(self.unsent_progress)
+                    stats.update(self.unsent_stats)
+                    self.unsent_progress, self.unsent_stats = progress, stats
+                    delay = min(delay * 2, max(MAX_BACKOFF, self.interval))
+                self._write_journal(self.unsent_progress, self.unsent_stats)
+            if closing:
+                return
+
+    def _write_journal(self, unsent_progress, unsent_stats):
+        if self.reported:
+            # a last batch that took longer than report()
+            return
+        data = {'job_id': self.job_id, 'seq': self.seq, 'progress': self.progress, 'stats': self.stats,
+                'unsent_progress': unsent_progress, 'unsent_stats': unsent_stats}
+        try:
+            write_atomic(self.journal, json.dumps(data))
+        except (IOError, OSError) as e:
+            dtslogger.debug('Cannot write %s: %s', self.journal, e)
+
+    def close(self, timeout=CLOSE_TIMEOUT):
+        """ Sends what was not sent yet (one attempt); what fails stays in the journal. """
+        self._stop(timeout)
+        self._release()
+
+    def _stop(self, timeout):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.stopped.wait(timeout)
+
+    def _release(self):
+        """ Lets the thread release the lock; waits for it, unless it is stuck sending. """
+        self.finished.set()
+        if self.stopped.is_set():
+            self.thread.join()
+
+    def merged_stats(self, stats):
+        """ The streamed stats, updated with the final ones. """
+        with self.cond:
+            merged = dict(self.stats)
+        merged.update(stats or {})
+        return merged
+
+    def report(self, result, stats, machine_id, process_id, evaluation_container, evaluator_version):
+        """ Like dtserver_report_job(), with the streamed stats merged into `stats`. """
+        try:
+            self._stop(CLOSE_TIMEOUT)
+            res = dtserver_report_job(self.token, self.job_id, result, self.merged_stats(stats), machine_id,
+                                      process_id, evaluation_container, evaluator_version)
+            with self.cond:
+                self.reported = True
+                remove_journal(self.journal)
+            return res
+        finally:
+            self._release()
+
+
+def replay_job_progress(token, journal_dir=None):
+    """
+        Sends the progress left unsent in the journals of the jobs that no
+        reporter is running for (e.g. their evaluators crashed), and removes
+        the journals with nothing left to send, or of the jobs that the
+        server does not accept progress for anymore. Returns the number of
+        batches sent.
+    """
+    d = journal_dir or get_job_progress_dir()
+    if not os.path.exists(d):
+        return 0
+    n = 0
+    for name in sorted(os.listdir(d)):
+        if not name.endswith('.json'):
+            continue
+        fn = os.path.join(d, name)
+        lock = FileLock(get_journal_lock_filename(fn))
+        if not lock.acquire(timeout=0):
+            # a reporter is running
+            continue
+        try:
+            if _replay_journal(token, fn):
+                n += 1
+        finally:
+            lock.release()
+    return n
+
+
+def _replay_journal(token, fn):
+    journal = read_job_progress_journal(fn)
+    if journal is not None and (journal.get('unsent_progress') or journal.get('unsent_stats')):
+        journal['seq'] = next_seq(journal.get('seq', 0))
+        try:
+            dtserver_report_job_progress(token, journal['job_id'], journal['seq'], journal['unsent_progress'],
+                                         journal['unsent_stats'], timeout=SEND_TIMEOUT)
+        except RequestFailed as e:
+            dtslogger.debug('Removing %s: %s', fn, e)
+            remove_journal(fn)
+            return False
+        except RequestException as e:
+            dtslogger.debug('Cannot send the progress in %s: %s', fn, e)
+            return False
+        sent = True
+    else:
+        sent = False
+    remove_journal(fn)
+    return sent
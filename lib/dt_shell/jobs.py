@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+    Background jobs of the interactive shell.
+
+    `<command> &` runs the command in a job; `jobs` lists them, `fg <id>`
+    shows the output of a job and waits for it, `kill <id>` stops it. The
+    commands can also submit work directly:
+
+        job = shell.jobs.submit('download logs', download, url)
+
+    The jobs run on a bounded pool of worker threads owned by the shell;
+    the jobs beyond that wait in a queue. What a job prints (sys.stdout and
+    sys.stderr of its thread) is captured in the job; the output of
+    subprocesses that write directly to the terminal is not.
+
+    Stopping a running job raises JobKilled in its thread, which happens at
+    the next Python instruction: a job blocked in a system call (e.g.
+    waiting for a subprocess) stops when the call returns.
+"""
+import ctypes
+import sys
+import threading
+import time
+import traceback
+
+try:
+    from Queue import Queue
+except ImportError:  # Python 3
+    from queue import Queue
+
+DEFAULT_MAX_WORKERS = 4
+
+STATE_QUEUED = 'queued'
+STATE_RUNNING = 'running'
+STATE_DONE = 'done'
+STATE_FAILED = 'failed'
+STATE_KILLED = 'killed'
+
+
+class JobKilled(KeyboardInterrupt):
+    """ Raised in the thread of a job stopped with `kill`; like Ctrl-C for a foreground command. """
+
+
+class ThreadLocalOutput(object):
+    """ Replaces sys.stdout/stderr: writes to the output of the current job, if any. """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, s):
+        target = getattr(self.local, 'target', None)
+        (target if target is not None else self.stream).write(s)
+
+    def flush(self):
+        target = getattr(self.local, 'target', None)
+        if target is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def install_output_capture():
+    for name in ['stdout', 'stderr']:
+        stream = getattr(sys, name)
+        if not isinstance(stream, ThreadLocalOutput):
+            setattr(sys, name, ThreadLocalOutput(stream))
+
+
+class JobOutput(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.parts = []
+
+    def write(self, s):
+        with self.lock:
+            self.parts.append(s)
+
+    def flush(self):
+        pass
+
+    def read(self, offset=0):
+        """ Returns (text written after offset, new offset). """
+        with self.lock:
+            text = ''.join(self.parts)
+        return text[offset:], len(text)
+
+
+class Job(object):
+
+    def __init__(self, job_id, name, f, args, kwargs):
+        self.id = job_id
+        self.name = name
+        self.f = f
+        self.args = args
+        self.kwargs = kwargs
+        self.state = STATE_QUEUED
+        self.output = JobOutput()
+        self.result = None
+        self.error = None
+        self.thread = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.killing = False
+        self.done = threading.Event()
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+    def wait(self, timeout=None):
+        """ Returns True if the job finished within timeout seconds. """
+        self.done.wait(timeout)
+        return self.done.is_set()
+
+
+class JobManager(object):
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS):
+        self.max_workers = max_workers
+        self.lock = threading.Lock()
+        self.queue = Queue()
+        self.jobs = {}
+        self.workers = []
+        self.next_id = 1
+        self.finished = []
+
+    def submit(self, name, f, *args, **kwargs):
+        """ Runs f(*args, **kwargs) in a job; returns the Job. """
+        install_output_capture()
+        with self.lock:
+            job = Job(self.next_id, name, f, args, kwargs)
+            self.next_id += 1
+            self.jobs[job.id] = job
+            pending = self._count(STATE_QUEUED, STATE_RUNNING)
+            if len(self.workers) < self.max_workers and pending > len(self.workers):
+                t = threading.Thread(target=self._worker, name='dts-job-worker-%d' % len(self.workers))
+                t.daemon = True
+                self.workers.append(t)
+                t.start()
+        self.queue.put(job)
+        return job
+
+    def _count(self, *states):
+        return len([j for j in self.jobs.values() if j.state in states])
+
+    def _worker(self):
+        while True:
+            job = self.queue.get()
+            try:
+                self._run(job)
+            except JobKilled:
+                # the job was stopped just as it finished, before its bookkeeping
+                self._finish(job, STATE_KILLED)
+
+    def _run(self, job):
+        with self.lock:
+            if job.state != STATE_QUEUED:
+                return
+            job.state = STATE_RUNNING
+            job.thread = threading.current_thread()
+            job.started = time.time()
+        out = sys.stdout
+        if isinstance(out, ThreadLocalOutput):
+            out.local.target = job.output
+        if isinstance(sys.stderr, ThreadLocalOutput):
+            sys.stderr.local.target = job.output
+        state = STATE_DONE
+        try:
+            job.result = job.f(*job.args, **job.kwargs)
+        except JobKilled:
+            state = STATE_KILLED
+        except (Exception, SystemExit, KeyboardInterrupt) as e:
+            state = STATE_FAILED
+            job.error = e
+            job.output.write(traceback.format_exc())
+        finally:
+            self._finish(job, state)
+
+    def _finish(self, job, state):
+        """ The bookkeeping of a job that stopped; it can be repeated if JobKilled interrupts it. """
+        for stream in [sys.stdout, sys.stderr]:
+            if isinstance(stream, ThreadLocalOutput):
+                stream.local.target = None
+        with self.lock:
+            # kill() sends at most one JobKilled, under this lock: discard it if it is still pending
+            if job.killing:
+                set_async_exc(threading.current_thread(), None)
+            if job.done.is_set():
+                return
+            job.state = state
+            job.finished = time.time()
+            job.thread = None
+            self.finished.append(job)
+            job.done.set()
+
+    def get(self, job_id):
+        return self.jobs.get(job_id, None)
+
+    def list(self):
+        return [self.jobs[i] for i in sorted(self.jobs)]
+
+    def kill(self, job_id):
+        """ Returns False if the job had already finished. """
+        with self.lock:
+            job = self.jobs.get(job_id, None)
+            if job is None or job.state not in [STATE_QUEUED, STATE_RUNNING]:
+                return False
+            if job.state == STATE_QUEUED:
+                job.state = STATE_KILLED
+                job.finished = time.time()
+                self.finished.append(job)
+                job.done.set()
+                return True
+            # under the lock, so that the job cannot finish in the meantime
+            if not job.killing:
+                job.killing = True
+                set_async_exc(job.thread, JobKilled)
+        return True
+
+    def acknowledge(self, job):
+        """ No notification is needed for this job (e.g. its output was shown). """
+        with self.lock:
+            if job in self.finished:
+                self.finished.remove(job)
+
+    def pop_finished(self):
+        """ Returns the jobs that finished since the last call (for the notifications). """
+        with self.lock:
+            finished, self.finished = self.finished, []
+        return finished
+
+
+def set_async_exc(thread, exc):
+    """ Raises exc in the thread at its next Python instruction; None cancels a pending one. """
+    if exc is not None:
+        exc = ctypes.py_object(exc)
+    ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_long(thread.ident), exc)
+
+
+def format_job(job):
+    return '[%d] %-8s %7.1fs  %s' % (job.id, job.state, job.elapsed, job.name)
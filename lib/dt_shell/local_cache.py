@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+    Small on-disk cache for the data that the shell needs at startup.
+
+    Each entry is a JSON file in ~/.dt-shell/cache/ containing the value and
+    the time it was written. Reading an entry costs one open() and a tiny
+    json.loads(); writes are atomic (write to a temporary file, then rename).
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+
+from .constants import DTShellConstants
+
+string_types = (str, type(u''))
+
+
+class NoCacheAvailable(Exception):
+    pass
+
+
+class CacheEntry(object):
+    """
+        A typed entry of the cache.
+
+        :param name: used as the file name.
+        :param ttl: seconds after which the value is considered stale (None = never).
+        :param types: if given, values that are not instances of these types are ignored.
+    """
+
+    def __init__(self, name, ttl=None, types=None):
+        self.name = name
+        self.ttl = ttl
+        self.types = types
+
+    def __repr__(self):
+        return 'CacheEntry(%r, ttl=%r)' % (self.name, self.ttl)
+
+
+PYPI_VERSION = CacheEntry('pypi-version', ttl=10 * 60, types=string_types)
+COMMANDS_REMOTE_SHA = CacheEntry('commands-remote-sha', ttl=5 * 60, types=string_types)
+ENV_CHECK = CacheEntry('env-check', types=(dict,))
+DOCKER_API_VERSION = CacheEntry('docker-api-version', types=string_types)
+
+
+def get_cache_dir():
+    d0 = os.path.expanduser(DTShellConstants.ROOT)
+    return os.path.join(d0, 'cache')
+
+
+def get_cache_filename(entry, key=None):
+    """ Entries can be qualified by a key (e.g. a path); each key has its own file. """
+    basename = entry.name
+    if key is not None:
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        basename += '-' + hashlib.sha1(key).hexdigest()[:16]
+    return os.path.join(get_cache_dir(), basename + '.json')
+
+
+def cache_get(entry, key=None, ttl=None):
+    """
+        Returns the cached value, or raises NoCacheAvailable if it is missing,
+        expired or of the wrong type. The ttl argument overrides the entry's.
+    """
+    value, timestamp = cache_get_with_timestamp(entry, key=key)
+    ttl = entry.ttl if ttl is None else ttl
+    if ttl is not None:
+        age = time.time() - timestamp
+        if not (0 <= age < ttl):
+            msg = 'Cache entry %s is outdated (%.1f s old).' % (entry.name, age)
+            raise NoCacheAvailable(msg)
+    return value
+
+
+def cache_get_with_timestamp(entry, key=None):
+    """ Returns the tuple (value, timestamp) regardless of the TTL; raises NoCacheAvailable. """
+    fn = get_cache_filename(entry, key)
+    try:
+        with open(fn) as f:
+            data = json.loads(f.read())
+        value = data['value']
+        timestamp = float(data['timestamp'])
+    except (IOError, OSError) as e:
+        raise NoCacheAvailable('Could not read %s: %s' % (fn, e))
+    except (ValueError, KeyError, TypeError) as e:
+        raise NoCacheAvailable('Invalid cache file %s: %s' % (fn, e))
+    if entry.types is not None and not isinstance(value, entry.types):
+        msg = 'Cache entry %s has unexpected type %s.' % (entry.name, type(value).__name__)
+        raise NoCacheAvailable(msg)
+    return value, timestamp
+
+
+def cache_set(entry, value, key=None, timestamp=None):
+    """
+        Atomically writes the value, with the time it was obtained (default:
+        now). Errors are ignored: the cache is only an optimization.
+    """
+    fn = get_cache_filename(entry, key)
+    data = json.dumps({'value': value, 'timestamp': time.time() if timestamp is None else timestamp})
+    try:
+        write_atomic(fn, data)
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def cache_clear(entry, key=None):
+    fn = get_cache_filename(entry, key)
+    try:
+        os.unlink(fn)
+    except OSError:
+        pass
+
+
+def write_atomic(fn, data):
+    d0 = os.path.dirname(fn)
+    if not os.path.exists(d0):
+        try:
+            os.makedirs(d0)
+        except OSError:
+            if not os.path.isdir(d0):
+                raise
+    tmp = '%s.tmp-%s-%s' % (fn, os.getpid(), threading.current_thread().ident)
+    with open(tmp, 'w') as f:
+        f.write(data)
+    try:
+        os.rename(tmp, fn)
+    except OSError:
+        # on Windows, rename() does not replace an existing file
+        if os.path.exists(fn):
+            os.unlink(fn)
+            os.rename(tmp, fn)
+        else:
+            raise
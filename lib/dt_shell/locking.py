@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+    Inter-process locks, so that several dts processes (e.g. parallel CI
+    jobs) can share one ~/.dt-shell.
+
+    Writers (installing or updating the commands) take an exclusive lock.
+    Readers do not need to lock anything in the common case: they only check,
+    with one non-blocking call, that no writer is active, and otherwise wait
+    briefly for it to finish. The cache files are written atomically, so
+    they can always be read without locking.
+"""
+import errno
+import hashlib
+import os
+import threading
+import time
+
+from . import dtslogger
+from .constants import DTShellConstants
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+POLL_INTERVAL = 0.05
+
+
+class LockTimeout(Exception):
+    pass
+
+
+def get_lock_filename(name):
+    d0 = os.path.expanduser(DTShellConstants.ROOT)
+    return os.path.join(d0, 'locks', name + '.lock')
+
+
+class FileLock(object):
+    """
+        A lock on a file, shared between processes (and between threads, as
+        each acquisition opens its own file descriptor). Nested acquisitions
+        in the same thread are independent: a thread that holds the lock
+        exclusively and acquires it again waits for itself.
+
+        Use acquire()/release() or `with lock.exclusive(timeout=...)`.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.local = threading.local()
+
+    def acquire(self, shared=False, timeout=None):
+        """ Returns True if the lock was acquired within timeout seconds (None = wait forever). """
+        d = os.path.dirname(self.filename)
+        if not os.path.exists(d):
+            try:
+                os.makedirs(d)
+            except OSError:
+                if not os.path.isdir(d):
+                    raise
+        fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o644)
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            if _try_lock(fd, shared):
+                # released in the reverse order
+                self._get_fds().append(fd)
+                return True
+            if deadline is not None and time.time() >= deadline:
+                os.close(fd)
+                return False
+            time.sleep(POLL_INTERVAL)
+
+    def _get_fds(self):
+        if not hasattr(self.local, 'fds'):
+            self.local.fds = []
+        return self.local.fds
+
+    def release(self):
+        """ Releases the last acquisition of this thread. """
+        fds = self._get_fds()
+        if not fds:
+            return
+        fd = fds.pop()
+        _unlock(fd)
+        os.close(fd)
+
+    def is_locked(self):
+        """ True if some process holds the lock exclusively. Costs one non-blocking call. """
+        if not os.path.exists(self.filename):
+            return False
+        if self.acquire(shared=True, timeout=0):
+            self.release()
+            return False
+        return True
+
+    def exclusive(self, timeout=None):
+        return _LockContext(self, False, timeout)
+
+    def shared(self, timeout=None):
+        return _LockContext(self, True, timeout)
+
+
+class _LockContext(object):
+
+    def __init__(self, lock, shared, timeout):
+        self.lock = lock
+        self.shared = shared
+        self.timeout = timeout
+
+    def __enter__(self):
+        if not self.lock.acquire(shared=self.shared, timeout=self.timeout):
+            msg = 'Could not lock %s within %s seconds.' % (self.lock.filename, self.timeout)
+            raise LockTimeout(msg)
+        return self.lock
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.lock.release()
+
+
+def _try_lock(fd, shared):
+    if fcntl is not None:
+        flags = (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | fcntl.LOCK_NB
+        try:
+            fcntl.flock(fd, flags)
+            return True
+        except (IOError, OSError) as e:
+            if e.errno in (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK):
+                return False
+            raise
+    else:
+        # msvcrt only has exclusive locks
+        try:
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+            return True
+        except (IOError, OSError):
+            return False
+
+
+def _unlock(fd):
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    else:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+
+def get_commands_lock(commands_path):
+    """ The lock protecting a commands repository (and all its worktrees) from concurrent writers. """
+    # not the real path: ~/.dt-shell/commands is a symlink to the current tree (see commands_trees.py)
+    h = hashlib.sha1(os.path.abspath(commands_path).encode('utf-8')).hexdigest()[:16]
+    return FileLock(get_lock_filename('commands-' + h))
+
+
+def wait_for_writers(lock, timeout):
+    """
+        Waits up to timeout seconds for a writer holding the lock to finish.
+        Returns True if no writer is active anymore.
+    """
+    if not lock.is_locked():
+        return True
+    dtslogger.info('Another dts process is updating the commands; waiting up to %s s.', timeout)
+    if lock.acquire(shared=True, timeout=timeout):
+        lock.release()
+        return True
+    return False
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""
+    Logging of dts, set up by cli_main(); before that (importing dt_shell),
+    the warnings and errors of dts go to stderr.
+
+    The log calls only put the records in a queue; a background thread
+    formats them (the messages are formatted there, not by the caller) and
+    writes them to stderr, as text or as JSON lines. The last records of
+    dts, DEBUG included whatever the levels, are also kept in memory and
+    written to ~/.dt-shell/logs/ if dts crashes. For that the logger of dts
+    is at DEBUG: every dtslogger.debug() call creates a record and passes
+    it to the handlers (some 10-20 microseconds, although the message is
+    not formatted), so keep them out of hot loops.
+
+    Levels can be set per module, in the config file:
+
+        "log_levels": {"dts": "INFO", "remote": "DEBUG", "dts.commands": "WARNING"}
+
+    or with DTSHELL_LOG_LEVELS=dts=INFO,remote=DEBUG. A key is either the
+    name of a logger (and its children) or the name of a module of dt_shell
+    (e.g. `remote` for the messages of remote.py logged with dtslogger).
+    DTSHELL_LOG_FORMAT=json (or "log_format": "json") selects JSON output.
+"""
+import atexit
+import collections
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+from .constants import DTShellConstants
+
+try:
+    from Queue import Queue, Full
+except ImportError:  # Python 3
+    from queue import Queue, Full
+
+QUEUE_SIZE = 10000
+RING_SIZE = 1000
+STOP_TIMEOUT = 2.0
+TEXT_FORMAT = '%(levelname)s:%(name)s:%(message)s'
+
+
+def parse_levels(s):
+    """ Parses 'dts=INFO,remote=DEBUG' into a dict. """
+    levels = {}
+    for part in s.split(','):
+        if '=' in part:
+            k, v = part.split('=', 1)
+            levels[k.strip()] = v.strip()
+    return levels
+
+
+def get_level(name):
+    level = logging.getLevelName(str(name).upper())
+    if not isinstance(level, int):
+        raise ValueError('Unknown log level %r.' % name)
+    return level
+
+
+class LevelsFilter(logging.Filter):
+    """ Applies the per-logger and per-module levels to the records of dts. """
+
+    def __init__(self, levels):
+        logging.Filter.__init__(self)
+        self.levels = levels
+        # the longest names first, so that children override their parents
+        self.names = sorted(levels, key=len, reverse=True)
+
+    def get_threshold(self, record):
+        if record.module in self.levels and record.name.startswith('dts'):
+            return self.levels[record.module]
+        for name in self.names:
+            if record.name == name or record.name.startswith(name + '.'):
+                return self.levels[name]
+        return None
+
+    def filter(self, record):
+        threshold = self.get_threshold(record)
+        return threshold is None or record.levelno >= threshold
+
+
+class QueueHandler(logging.Handler):
+    """ Puts the records in a queue; drops them (and counts them) if the queue is full. """
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def emit(self, record):
+        if record.exc_info:
+            # the traceback must be formatted while it exists
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+
+class QueueListener(threading.Thread):
+    """ Formats and writes the queued records. """
+
+    def __init__(self, queue, handlers, queue_handler):
+        threading.Thread.__init__(self, name='dts-logging')
+        self.daemon = True
+        self.queue = queue
+        self.handlers = handlers
+        self.queue_handler = queue_handler
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                return
+            self.handle(record)
+            if self.queue_handler.dropped:
+                n, self.queue_handler.dropped = self.queue_handler.dropped, 0
+                self.handle(logging.makeLogRecord({'name': 'dts', 'levelno': logging.WARNING,
+                                                   'levelname': 'WARNING',
+                                                   'msg': '%d log messages were dropped.' % n}))
+
+    def handle(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def stop(self):
+        self.queue.put(None)
+        self.join(STOP_TIMEOUT)
+
+
+class RingBufferHandler(logging.Handler):
+    """ Keeps the last records in memory, to be written out if dts crashes. """
+
+    def __init__(self, capacity=RING_SIZE):
+        logging.Handler.__init__(self)
+        self.records = collections.deque(maxlen=capacity)
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def dump(self, f, formatter):
+        for record in list(self.records):
+            f.write(formatter.format(record) + '\n')
+
+
+class FallbackHandler(logging.StreamHandler):
+    """
+        The handler of dts until setup_logging(): writes the warnings and
+        errors to stderr, unless the root logger has handlers (they get them).
+    """
+
+    def __init__(self):
+        logging.StreamHandler.__init__(self, sys.stderr)
+        self.setLevel(logging.WARNING)
+        self.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+    def emit(self, record):
+        if not logging.getLogger().handlers:
+            logging.StreamHandler.emit(self, record)
+
+
+class JSONFormatter(logging.Formatter):
+
+    def format(self, record):
+        data = {'t': record.created, 'level': record.levelname, 'logger': record.name,
+                'module': record.module, 'thread': record.threadName, 'msg': record.getMessage()}
+        if record.exc_text:
+            data['exc'] = record.exc_text
+        return json.dumps(data)
+
+
+class Storage(object):
+    listener = None
+    ring = None
+
+
+def get_logging_settings(config):
+    """ Returns (levels, format) from the environment, else from the config. """
+    levels = dict(config.get(DTShellConstants.CONFIG_LOG_LEVELS, None) or {})
+    levels.update(parse_levels(os.environ.get(DTShellConstants.ENV_LOG_LEVELS, '')))
+    fmt = os.environ.get(DTShellConstants.ENV_LOG_FORMAT, None) or config.get(DTShellConstants.CONFIG_LOG_FORMAT,
+                                                                              'text')
+    return levels, fmt
+
+
+def read_config():
+    fn = os.path.join(os.path.expanduser(DTShellConstants.ROOT), 'config')
+    try:
+        with open(fn) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def setup_logging(config=None, stream=None):
+    """ Installs the asynchronous pipeline on the root logger (once). """
+    if Storage.listener is not None:
+        return
+    names, fmt = get_logging_settings(read_config() if config is None else config)
+    levels = {}
+    invalid = []
+    for k, v in names.items():
+        try:
+            levels[k] = get_level(v)
+        except ValueError:
+            invalid.append('%s=%s' % (k, v))
+    levels.setdefault('dts', logging.INFO)
+
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(JSONFormatter() if fmt == 'json' else logging.Formatter(TEXT_FORMAT))
+    queue = Queue(QUEUE_SIZE)
+    queue_handler = QueueHandler(queue)
+    queue_handler.addFilter(LevelsFilter(levels))
+    # not filtered: the crash dumps have the DEBUG messages too
+    Storage.ring = RingBufferHandler()
+    Storage.ring.setLevel(logging.DEBUG)
+
+    root = logging.getLogger()
+    # replace the handlers of logging.basicConfig(), which some libraries call when imported
+    for h in list(root.handlers):
+        if isinstance(h, logging.StreamHandler) and getattr(h, 'stream', None) in [sys.stderr, sys.__stderr__]:
+            root.removeHandler(h)
+    root.addHandler(queue_handler)
+    root.addHandler(Storage.ring)
+    dts = logging.getLogger('dts')
+    for h in list(dts.handlers):
+        if isinstance(h, FallbackHandler):
+            dts.removeHandler(h)
+    # everything reaches the ring; the filter of the queue handler applies the levels
+    dts.setLevel(logging.DEBUG)
+    for name, level in levels.items():
+        if not name.startswith('dts'):
+            # e.g. 'docker' or 'urllib3'
+            logging.getLogger(name).setLevel(level)
+
+    Storage.listener = QueueListener(queue, [handler], queue_handler)
+    Storage.listener.start()
+    atexit.register(stop_logging)
+    if invalid:
+        dts.warning('Ignoring invalid log levels: %s', ', '.join(invalid))
+
+
+def stop_logging():
+    """ Writes out the queued records. """
+    listener = Storage.listener
+    if listener is not None and listener.is_alive():
+        listener.stop()
+
+
+def dump_log_ring(reason=''):
+    """ Writes the last log records to ~/.dt-shell/logs/; returns the file name (None if there is nothing). """
+    if Storage.ring is None or not Storage.ring.records:
+        return None
+    d = os.path.join(os.path.expanduser(DTShellConstants.ROOT), 'logs')
+    if not os.path.exists(d):
+        os.makedirs(d)
+    fn = os.path.join(d, 'crash-%s-%d.log' % (time.strftime('%Y%m%d-%H%M%S'), os.getpid()))
+    with open(fn, 'w') as f:
+        if reason:
+            f.write(reason.rstrip() + '\n\n')
+        Storage.ring.dump(f, logging.Formatter('%(asctime)s ' + TEXT_FORMAT))
+    return fn
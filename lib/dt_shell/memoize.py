@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+    Memoization for the commands, scoped to the shell session.
+
+        from dt_shell import DTCommandAbs
+
+        @DTCommandAbs.memoize(ttl=60)
+        def list_images(client):
+            return [i.tags for i in client.images.list()]
+
+    Each memoized function has a Memo: an LRU of at most `maxsize` values,
+    each valid for `ttl` seconds (None = for the whole session). With
+    persistent=True the values (which must then be JSON-serializable) are
+    also saved in ~/.dt-shell/cache/ and reused by the next invocations of
+    dts, within their TTL.
+
+    The memos keep their own copies of the values that are lists, dicts,
+    sets or tuples, and return a new copy each time, so that the callers can
+    modify what they get. Other mutable values are shared: treat them as
+    immutable.
+
+    The memos are cleared when the events in `invalidate_on` happen:
+    'commands' (the commands were updated or reloaded) and 'config' (the
+    configuration was saved). `dts memo` shows the hits and misses.
+"""
+import atexit
+import copy
+import functools
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from . import dtslogger
+from .local_cache import CacheEntry, NoCacheAvailable, cache_clear, cache_get, cache_set
+
+DEFAULT_MAXSIZE = 128
+EVENT_COMMANDS = 'commands'
+EVENT_CONFIG = 'config'
+
+
+def make_key(args, kwargs):
+    """ A string identifying the arguments: their JSON if possible, else their repr. """
+    try:
+        return json.dumps([args, kwargs], sort_keys=True)
+    except (TypeError, ValueError):
+        return repr((args, sorted(kwargs.items())))
+
+
+def copy_value(value):
+    if isinstance(value, (list, dict, set, tuple)):
+        return copy.deepcopy(value)
+    return value
+
+
+class Memo(object):
+
+    def __init__(self, name, ttl=None, maxsize=DEFAULT_MAXSIZE, persistent=False,
+                 invalidate_on=(EVENT_COMMANDS,)):
+        self.name = name
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.persistent = persistent
+        self.invalidate_on = tuple(invalidate_on)
+        self.lock = threading.RLock()
+        # key -> (value, timestamp), least recently used first
+        self.values = OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+        self.loaded = not persistent
+        self.dirty = False
+
+    @property
+    def cache_entry(self):
+        return CacheEntry('memo-' + self.name, types=(dict,))
+
+    def get(self, key):
+        """ Returns (True, value) or (False, None). """
+        with self.lock:
+            self._load()
+            item = self.values.get(key, None)
+            if item is not None and (self.ttl is None or time.time() - item[1] < self.ttl):
+                # most recently used last
+                del self.values[key]
+                self.values[key] = item
+                self.hits += 1
+                return True, copy_value(item[0])
+            if item is not None:
+                del self.values[key]
+            self.misses += 1
+            return False, None
+
+    def set(self, key, value):
+        with self.lock:
+            self.values.pop(key, None)
+            self.values[key] = (copy_value(value), time.time())
+            while self.maxsize is not None and len(self.values) > self.maxsize:
+                self.values.popitem(last=False)
+                self.evictions += 1
+            self.dirty = True
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+            self.dirty = False
+            if self.persistent:
+                cache_clear(self.cache_entry)
+
+    def _load(self):
+        if self.loaded:
+            return
+        self.loaded = True
+        try:
+            data = cache_get(self.cache_entry)
+        except NoCacheAvailable:
+            return
+        now = time.time()
+        for key, (value, timestamp) in sorted(data.items(), key=lambda x: x[1][1]):
+            if self.ttl is None or now - timestamp < self.ttl:
+                self.values[key] = (value, timestamp)
+
+    def save(self):
+        with self.lock:
+            if not self.persistent or not self.dirty:
+                return
+            data = dict((k, list(v)) for k, v in self.values.items())
+            self.dirty = False
+        try:
+            cache_set(self.cache_entry, data)
+        except (TypeError, ValueError) as e:
+            dtslogger.debug('Cannot save the memo %s: %s', self.name, e)
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.values), 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions}
+
+
+class MemoRegistry(object):
+    """ The memos of the session. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.memos = {}
+
+    def get_memo(self, name, **kwargs):
+        with self.lock:
+            if name not in self.memos:
+                self.memos[name] = Memo(name, **kwargs)
+            return self.memos[name]
+
+    def invalidate(self, event):
+        """ Clears the memos that depend on the event (EVENT_COMMANDS, EVENT_CONFIG). """
+        for memo in list(self.memos.values()):
+            if event in memo.invalidate_on:
+                memo.clear()
+
+    def clear(self, name=None):
+        for memo in list(self.memos.values()):
+            if name is None or memo.name == name:
+                memo.clear()
+
+    def save(self):
+        for memo in list(self.memos.values()):
+            memo.save()
+
+    def stats(self):
+        return dict((name, memo.stats()) for name, memo in self.memos.items())
+
+
+class Storage(object):
+    registry = None
+
+
+def get_memo_registry():
+    if Storage.registry is None:
+        Storage.registry = MemoRegistry()
+        atexit.register(Storage.registry.save)
+    return Storage.registry
+
+
+def memoize(name=None, ttl=None, maxsize=DEFAULT_MAXSIZE, persistent=False, invalidate_on=(EVENT_COMMANDS,),
+            key=None):
+    """
+        Decorator. `name` defaults to module.function; `key(*args, **kwargs)`
+        can replace the default key (see make_key()).
+    """
+
+    def decorator(f):
+        memo_name = name or '%s.%s' % (f.__module__, f.__name__)
+
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            memo = get_memo_registry().get_memo(memo_name, ttl=ttl, maxsize=maxsize, persistent=persistent,
+                                                invalidate_on=invalidate_on)
+            k = key(*args, **kwargs) if key is not None else make_key(args, kwargs)
+            found, value = memo.get(k)
+            if found:
+                return value
+            value = f(*args, **kwargs)
+            memo.set(k, value)
+            return value
+
+        wrapper.memo_name = memo_name
+        return wrapper
+
+    return decorator
+
+
+def format_memo_stats(stats):
+    if not stats:
+        return 'No memoized functions used in this session.'
+    lines = ['  %-50s %6s %8s %8s %9s' % ('memo', 'size', 'hits', 'misses', 'evictions')]
+    for name in sorted(stats):
+        s = stats[name]
+        lines.append('  %-50s %6d %8d %8d %9d' % (name[-50:], s['size'], s['hits'], s['misses'], s['evictions']))
+    return '\n'.join(lines)
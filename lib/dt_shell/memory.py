@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+    Memory instrumentation of commands: `dts --memory[=<budget>] <command ...>`
+    or, in the interactive shell, `memory [--budget <size>] <command ...>`.
+
+    For each command it reports the peak resident set size (RSS), the net
+    memory allocated, and the top allocation sites. The allocation sites come
+    from tracemalloc when available (Python 3, or the pytracemalloc backport);
+    otherwise the report shows the object types whose count grew the most.
+
+    With a budget, a watchdog thread samples the RSS and, if the budget is
+    exceeded, interrupts the command and raises MemoryBudgetExceeded with the
+    report. Only the memory of the shell process is counted, not that of the
+    containers or processes it starts. Where the current RSS cannot be read
+    (/proc is Linux only), the peak RSS of the process is used instead.
+"""
+from __future__ import print_function
+
+import ctypes
+import gc
+import os
+import re
+import sys
+import threading
+import time
+from collections import defaultdict
+
+from .constants import DTShellConstants
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+SAMPLE_INTERVAL = 0.05
+TOP_N = 10
+
+
+class MemoryBudgetExceeded(Exception):
+    pass
+
+
+class MemoryBudgetInterrupt(BaseException):
+    """
+        Raised in the thread of a command that exceeds its budget (then
+        replaced by MemoryBudgetExceeded); not an Exception nor a
+        KeyboardInterrupt, so that the command does not catch it.
+    """
+
+
+def parse_size(s):
+    """ Parses sizes such as '512M', '2G', '1.5g', '1048576' into bytes. """
+    m = re.match(r'^\s*([0-9.]+)\s*([kKmMgG]?)[bB]?\s*$', s)
+    if not m:
+        raise ValueError('Invalid size %r; use e.g. 512M or 2G.' % s)
+    factor = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}[m.group(2).lower()]
+    return int(float(m.group(1)) * factor)
+
+
+def format_size(n):
+    sign = '-' if n < 0 else ''
+    n = abs(n)
+    for unit in ['B', 'KiB', 'MiB']:
+        if n < 1024:
+            return '%s%.1f %s' % (sign, n, unit)
+        n /= 1024.0
+    return '%s%.2f GiB' % (sign, n)
+
+
+def get_rss():
+    """ Returns the current resident set size in bytes, or None if unknown. """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+def get_peak_rss():
+    """ Returns the peak RSS of the process so far in bytes, or None if unknown. """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def count_objects_by_type():
+    counts = defaultdict(int)
+    for o in gc.get_objects():
+        counts[type(o).__name__] += 1
+    return counts
+
+
+class RSSWatchdog(threading.Thread):
+    """
+        Samples the RSS; if a budget is given and exceeded, raises
+        MemoryBudgetInterrupt in the thread that created the watchdog.
+
+        The exception is asynchronous: it is raised when that thread next
+        runs Python code, so a blocking C call (a long read(), a computation
+        in an extension) is not interrupted before it returns.
+    """
+
+    def __init__(self, budget=None, interval=SAMPLE_INTERVAL):
+        threading.Thread.__init__(self, name='dts-memory-watchdog')
+        self.daemon = True
+        self.budget = budget
+        self.interval = interval
+        self.target = threading.current_thread().ident
+        # the current RSS, else the peak RSS, else nothing to measure
+        self.measure = get_rss if get_rss() is not None else get_peak_rss if get_peak_rss() is not None else None
+        self.peak = get_rss() or 0
+        self.exceeded = False
+        self._stop_event = threading.Event()
+        # so that no exception is set once stop() has started
+        self._lock = threading.Lock()
+        self._stopping = False
+
+    def run(self):
+        if self.measure is None:
+            return
+        while not self._stop_event.wait(self.interval):
+            rss = self.measure()
+            self.peak = max(self.peak, rss)
+            if self.budget is not None and rss > self.budget and not self.exceeded:
+                with self._lock:
+                    if self._stopping:
+                        return
+                    self.exceeded = True
+                    ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_long(self.target),
+                                                               ctypes.py_object(MemoryBudgetInterrupt))
+
+    def stop(self):
+        """
+            Can raise the MemoryBudgetInterrupt that was pending (once): call it
+            again in that case.
+        """
+        with self._lock:
+            self._stopping = True
+            if self.exceeded:
+                # in case the command finished before the exception was raised
+                ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_long(self.target), None)
+        # nothing can be raised anymore, even in the threading code
+        self._stop_event.set()
+        self.join()
+
+
+class MemoryTrace(object):
+    """
+        Context manager that measures the memory used by the code in its body
+        and prints a report at the end.
+    """
+
+    def __init__(self, command_line, budget=None, out=None, top=TOP_N):
+        self.command_line = command_line
+        self.budget = budget
+        self.out = out or sys.stderr
+        self.top = top
+        self.tracemalloc = None
+        try:
+            import tracemalloc
+            self.tracemalloc = tracemalloc
+        except ImportError:
+            pass
+
+    def __enter__(self):
+        self.t0 = time.time()
+        self.rss0 = get_rss()
+        self.peak0 = get_peak_rss()
+        if self.tracemalloc is not None:
+            self.was_tracing = self.tracemalloc.is_tracing()
+            if not self.was_tracing:
+                self.tracemalloc.start()
+            self.snapshot0 = self.tracemalloc.take_snapshot()
+        else:
+            self.objects0 = count_objects_by_type()
+        self.watchdog = RSSWatchdog(self.budget)
+        if self.budget is not None and self.watchdog.measure is None:
+            print('The memory used cannot be measured on this platform; the budget of %s is not enforced.' %
+                  format_size(self.budget), file=self.out)
+        self.watchdog.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            self.watchdog.stop()
+        except MemoryBudgetInterrupt:
+            # raised after the end of the command, before stop() could clear it
+            self.watchdog.stop()
+        report = self.get_report()
+        if self.tracemalloc is not None and not self.was_tracing:
+            self.tracemalloc.stop()
+        if self.watchdog.exceeded:
+            msg = 'The command %r exceeded the memory budget of %s and was stopped.\n\n%s' % (
+                self.command_line, format_size(self.budget), report)
+            raise MemoryBudgetExceeded(msg)
+        print(report, file=self.out)
+        return False
+
+    def get_report(self):
+        lines = ['', 'Memory report for %r (%.2f s):' % (self.command_line, time.time() - self.t0)]
+        rss = get_rss()
+        peak = self.watchdog.peak
+        peak_total = get_peak_rss()
+        if peak_total is not None and self.peak0 is not None and peak_total > self.peak0:
+            # the process reached a new maximum during the command
+            peak = max(peak, peak_total)
+        if rss is not None:
+            lines.append('  peak RSS:       %s' % format_size(peak))
+            lines.append('  RSS at start:   %s' % format_size(self.rss0))
+            lines.append('  RSS at end:     %s' % format_size(rss))
+        if self.tracemalloc is not None:
+            snapshot = self.tracemalloc.take_snapshot()
+            stats = snapshot.compare_to(self.snapshot0, 'lineno')
+            net = sum(s.size_diff for s in stats)
+            lines.append('  net allocated:  %s' % format_size(net))
+            lines.append('  top allocation sites:')
+            for s in stats[:self.top]:
+                frame = s.traceback[0]
+                lines.append('    %10s  %s:%d' % (format_size(s.size_diff), frame.filename, frame.lineno))
+        else:
+            if rss is not None and self.rss0 is not None:
+                lines.append('  net allocated:  %s (RSS difference)' % format_size(rss - self.rss0))
+            objects = count_objects_by_type()
+            grown = [(objects[k] - self.objects0.get(k, 0), k) for k in objects]
+            grown = sorted([g for g in grown if g[0] > 0], reverse=True)[:self.top]
+            lines.append('  object types that grew the most (tracemalloc not available):')
+            for n, k in grown:
+                lines.append('    %+10d  %s' % (n, k))
+        return '\n'.join(lines)
+
+
+def get_memory_settings_from_env():
+    """
+        Returns (enabled, budget in bytes or None) from the env variables
+        DTShellConstants.ENV_MEMORY_TRACE and DTShellConstants.ENV_MEMORY_BUDGET.
+        Setting a budget enables the trace.
+    """
+    budget = os.environ.get(DTShellConstants.ENV_MEMORY_BUDGET, '').strip()
+    budget = parse_size(budget) if budget else None
+    enabled = os.environ.get(DTShellConstants.ENV_MEMORY_TRACE, '').strip() not in ['', '0']
+    return enabled or budget is not None, budget
+
+
+def parse_memory_flag(arguments):
+    """
+        Removes a leading `--memory` or `--memory=<budget>` from the arguments.
+        Returns (enabled, budget in bytes or None, remaining arguments).
+    """
+    if arguments and arguments[0] == '--memory':
+        return True, None, arguments[1:]
+    if arguments and arguments[0].startswith('--memory='):
+        return True, parse_size(arguments[0].split('=', 1)[1]), arguments[1:]
+    return False, None, arguments
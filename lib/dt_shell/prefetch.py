@@ -0,0 +1,404 @@
+# -*- coding: utf-8 -*-
+"""
+    Background pulls of the Docker images used by the commands, so that the
+    first run of a command does not wait for a pull.
+
+    A command declares its images with the class attribute `images`:
+
+        class DTCommand(DTCommandAbs):
+            images = ['duckietown/dt-core:daffy']
+
+    The images are pulled after the commands are updated and, in the
+    interactive shell, again every REFRESH_INTERVAL seconds when the machine
+    is idle. At most `parallel` pulls run at once; with `max_rate` (bytes/s)
+    the pulls are spaced out so that the average rate over all of them
+    stays below it. This is not a bandwidth limit: the daemon does the
+    transfer and the Docker API has no way to slow it down, so each image is
+    downloaded at full speed, and the next pull waits as long as needed.
+
+    With `registry` (e.g. `localhost:5000`, a `registry:2` container used as
+    a lab mirror or as a stand-in in tests) the images are pulled from that
+    registry and tagged with their original names.
+
+    Only one process pulls at a time; the progress is written to
+    ~/.dt-shell/prefetch/status.json and shown by `dts prefetch status`.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from . import dtslogger
+from .constants import DTShellConstants
+from .local_cache import write_atomic
+from .locking import FileLock, get_lock_filename
+from .memory import format_size, parse_size
+
+try:
+    from Queue import Queue, Empty
+except ImportError:  # Python 3
+    from queue import Queue, Empty
+
+DEFAULT_PARALLEL = 2
+REFRESH_INTERVAL = 6 * 60 * 60
+IDLE_POLL_INTERVAL = 10
+# the machine is idle if the 1-minute load average is below this fraction of the CPUs
+IDLE_LOAD = 0.5
+STATUS_WRITE_INTERVAL = 1.0
+
+STATE_QUEUED = 'queued'
+STATE_PULLING = 'pulling'
+STATE_DOWNLOADED = 'downloaded'
+STATE_UP_TO_DATE = 'up-to-date'
+STATE_FAILED = 'failed'
+
+
+def get_prefetch_settings(config):
+    """ Returns the prefetch settings in the config (None if the prefetch is disabled). """
+    settings = config.get(DTShellConstants.CONFIG_PREFETCH, None)
+    if not settings or not settings.get('enabled', False):
+        return None
+    return settings
+
+
+def get_declared_images(commands):
+    """ Returns a dict image -> list of commands (full paths) that use it. """
+    images = {}
+
+    def visit(klasses, prefix):
+        for name, klass in klasses.items():
+            path = prefix + [name]
+            for image in getattr(klass, 'images', None) or []:
+                images.setdefault(image, []).append(' '.join(path))
+            visit(klass.commands or {}, path)
+
+    visit(commands, [])
+    return images
+
+
+def get_status_filename():
+    d0 = os.path.expanduser(DTShellConstants.ROOT)
+    return os.path.join(d0, 'prefetch', 'status.json')
+
+
+def read_status():
+    try:
+        with open(get_status_filename()) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def get_prefetch_lock():
+    return FileLock(get_lock_filename('prefetch'))
+
+
+def is_machine_idle():
+    try:
+        load = os.getloadavg()[0]
+    except (AttributeError, OSError):  # Windows
+        return True
+    try:
+        import multiprocessing
+        ncpus = multiprocessing.cpu_count()
+    except NotImplementedError:
+        ncpus = 1
+    return load < IDLE_LOAD * ncpus
+
+
+def split_image_name(image):
+    """ Splits `repo[:tag]` into (repo, tag); the tag defaults to `latest`. """
+    if '@' in image:
+        return image, None
+    last = image.rsplit('/', 1)[-1]
+    if ':' in last:
+        repo, tag = image.rsplit(':', 1)
+        return repo, tag
+    return image, 'latest'
+
+
+class RateLimiter(object):
+    """ Token bucket shared by the pulls: consume() blocks while the average rate is above max_rate. """
+
+    def __init__(self, max_rate, burst=None):
+        self.max_rate = float(max_rate)
+        self.burst = burst if burst is not None else self.max_rate
+        self.tokens = self.burst
+        self.t = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, nbytes, stop_event=None, wait=True):
+        """ Takes nbytes from the bucket; unless wait=False, waits until the bucket is not in debt. """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.t) * self.max_rate)
+            self.t = now
+            self.tokens -= nbytes
+            delay = -self.tokens / self.max_rate if self.tokens < 0 and wait else 0
+        if delay > 0:
+            if stop_event is not None:
+                stop_event.wait(delay)
+            else:
+                time.sleep(delay)
+
+
+class ImagePrefetcher(object):
+    """
+        Pulls a list of images with a bounded number of worker threads.
+
+        `client` is a docker.DockerClient; `is_idle` is called before each pull
+        and the pull waits while it returns False.
+    """
+
+    def __init__(self, client, images, parallel=DEFAULT_PARALLEL, max_rate=None, registry=None,
+                 is_idle=None, status_file=None, stop_event=None):
+        self.client = client
+        self.images = list(images)
+        self.parallel = max(1, int(parallel))
+        self.limiter = RateLimiter(max_rate) if max_rate else None
+        self.registry = registry.rstrip('/') if registry else None
+        self.is_idle = is_idle
+        self.status_file = status_file
+        self.stop_event = stop_event if stop_event is not None else threading.Event()
+        self.lock = threading.Lock()
+        self.status = {'started': time.time(), 'finished': None, 'images': {}}
+        self.last_write = 0
+
+    def run(self):
+        """ Pulls all the images; returns the status dict. """
+        queue = Queue()
+        for image in self.images:
+            self._update(image, state=STATE_QUEUED, current=0, total=None, error=None)
+            queue.put(image)
+        workers = [threading.Thread(target=self._worker, args=(queue,), name='dts-prefetch-%d' % i)
+                   for i in range(min(self.parallel, len(self.images)))]
+        for w in workers:
+            w.daemon = True
+            w.start()
+        for w in workers:
+            w.join()
+        self.status['finished'] = time.time()
+        self._write_status(force=True)
+        return self.status
+
+    def stop(self):
+        """ Stops after the pulls in progress. """
+        self.stop_event.set()
+
+    def _worker(self, queue):
+        while not self.stop_event.is_set():
+            try:
+                image = queue.get_nowait()
+            except Empty:
+                return
+            if not self._wait_idle():
+                return
+            if self.limiter is not None:
+                # wait until the bytes already pulled fit in the average rate
+                self.limiter.consume(0, self.stop_event)
+                if self.stop_event.is_set():
+                    return
+            try:
+                self.pull(image)
+            except Exception as e:
+                dtslogger.debug('Cannot pull %s: %s', image, e)
+                self._update(image, state=STATE_FAILED, error=str(e))
+
+    def _wait_idle(self):
+        while self.is_idle is not None and not self.is_idle():
+            self.stop_event.wait(IDLE_POLL_INTERVAL)
+            if self.stop_event.is_set():
+                return False
+        return not self.stop_event.is_set()
+
+    def pull(self, image):
+        repo, tag = split_image_name(image)
+        source = '%s/%s' % (self.registry, repo) if self.registry else repo
+        self._update(image, state=STATE_PULLING, started=time.time())
+        layers = {}
+        done = 0
+        state = STATE_DOWNLOADED
+        for event in self.client.api.pull(source, tag=tag, stream=True, decode=True):
+            if 'error' in event:
+                raise Exception(event['error'])
+            status = event.get('status', '')
+            if status.startswith('Status: Image is up to date'):
+                state = STATE_UP_TO_DATE
+            detail = event.get('progressDetail') or {}
+            if status == 'Downloading' and 'current' in detail:
+                previous = layers.get(event.get('id'), (0, 0))[0]
+                layers[event.get('id')] = (detail['current'], detail.get('total') or 0)
+                delta = detail['current'] - previous
+                if delta > 0:
+                    done += delta
+                    if self.limiter is not None:
+                        # counted now, waited for before the next pull (reading the stream
+                        # more slowly would not slow down the daemon)
+                        self.limiter.consume(delta, wait=False)
+                total = sum(t for _, t in layers.values())
+                self._update(image, current=done, total=total or None)
+        if self.registry and tag is not None:
+            self.client.api.tag('%s:%s' % (source, tag), repo, tag=tag)
+        self._update(image, state=state, finished=time.time())
+
+    def _update(self, image, **kwargs):
+        with self.lock:
+            self.status['images'].setdefault(image, {}).update(kwargs)
+        self._write_status()
+
+    def _write_status(self, force=False):
+        if self.status_file is None:
+            return
+        now = time.time()
+        with self.lock:
+            if not force and now - self.last_write < STATUS_WRITE_INTERVAL:
+                return
+            self.last_write = now
+            data = json.dumps(self.status)
+        try:
+            write_atomic(self.status_file, data)
+        except (IOError, OSError) as e:
+            dtslogger.debug('Cannot write the prefetch status: %s', e)
+
+
+def prefetch_images(client, images, settings, is_idle=None, stop_event=None):
+    """
+        Pulls the images unless another process is already doing it.
+        Returns the status dict, or None if the pulls were skipped.
+    """
+    lock = get_prefetch_lock()
+    if not lock.acquire(timeout=0):
+        dtslogger.debug('Another process is pulling the images.')
+        return None
+    try:
+        prefetcher = ImagePrefetcher(client, images,
+                                     parallel=settings.get('parallel', DEFAULT_PARALLEL),
+                                     max_rate=settings.get('max_rate', None),
+                                     registry=settings.get('registry', None),
+                                     is_idle=is_idle,
+                                     status_file=get_status_filename(),
+                                     stop_event=stop_event)
+        return prefetcher.run()
+    finally:
+        lock.release()
+
+
+class PrefetchScheduler(threading.Thread):
+    """
+        Pulls the images in the background of the interactive shell: when
+        request() is called (e.g. after the commands are updated) and every
+        REFRESH_INTERVAL seconds, only while `is_busy` returns False and the
+        machine is idle.
+    """
+
+    def __init__(self, get_client, settings, is_busy):
+        super(PrefetchScheduler, self).__init__(name='dts-prefetch-scheduler')
+        self.daemon = True
+        self.get_client = get_client
+        self.settings = settings
+        self.is_busy = is_busy
+        self.images = []
+        self.requested = threading.Event()
+        self.stopped = threading.Event()
+
+    def set_images(self, images):
+        """ Sets the images pulled at the next periodic refresh. """
+        self.images = sorted(images)
+
+    def request(self, images):
+        """ Pulls the images as soon as the shell and the machine are idle. """
+        self.set_images(images)
+        self.requested.set()
+
+    def stop(self):
+        self.stopped.set()
+        self.requested.set()
+
+    def is_idle(self):
+        return not self.is_busy() and is_machine_idle()
+
+    def run(self):
+        while not self.stopped.is_set():
+            finished = read_status().get('finished', None) or 0
+            # without images, only request() (or stop()) wakes the thread up
+            timeout = max(0, finished + REFRESH_INTERVAL - time.time()) if self.images else None
+            self.requested.wait(timeout)
+            self.requested.clear()
+            if self.stopped.is_set():
+                return
+            if not self.images:
+                continue
+            try:
+                status = prefetch_images(self.get_client(), self.images, self.settings, is_idle=self.is_idle,
+                                         stop_event=self.stopped)
+            except Exception as e:
+                dtslogger.debug('Image prefetch failed: %s', e)
+                status = None
+            if status is None or not status.get('finished', None):
+                # failed, or another process is pulling (its status is not finished): do not retry in a loop
+                self.stopped.wait(IDLE_POLL_INTERVAL)
+
+
+def spawn_prefetch_process(images, settings):
+    """ Pulls the images in a detached process, which outlives a non-interactive `dts`. """
+    args = [sys.executable, '-m', 'dt_shell.prefetch', '--parallel', str(settings.get('parallel', DEFAULT_PARALLEL))]
+    if settings.get('max_rate', None):
+        args += ['--max-rate', str(settings['max_rate'])]
+    if settings.get('registry', None):
+        args += ['--registry', settings['registry']]
+    args += sorted(images)
+    kwargs = {}
+    if os.name == 'posix':
+        kwargs['preexec_fn'] = os.setsid
+    devnull = open(os.devnull, 'r+')
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([p for p in sys.path if p])
+    return subprocess.Popen(args, stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True, env=env,
+                            **kwargs)
+
+
+def format_prefetch_status(status, declared=None):
+    images = dict(status.get('images', {}))
+    for image in declared or []:
+        images.setdefault(image, {'state': 'not pulled yet'})
+    if not images:
+        return 'No images declared by the commands.'
+    lines = []
+    for image in sorted(images):
+        s = images[image]
+        line = '  %-50s %s' % (image, s.get('state', '?'))
+        if s.get('state') == STATE_PULLING and s.get('total'):
+            line += ' %d%% of %s' % (100 * s.get('current', 0) / s['total'], format_size(s['total']))
+        elif s.get('state') in [STATE_DOWNLOADED, STATE_UP_TO_DATE] and s.get('finished'):
+            line += ' (%s)' % time.strftime('%Y-%m-%d %H:%M', time.localtime(s['finished']))
+        elif s.get('state') == STATE_FAILED:
+            line += ': %s' % s.get('error', '')
+        lines.append(line)
+    if status.get('finished'):
+        lines.append('')
+        lines.append('Last run finished at %s.' % time.strftime('%Y-%m-%d %H:%M',
+                                                                 time.localtime(status['finished'])))
+    return '\n'.join(lines)
+
+
+def prefetch_main(args=None):
+    parser = argparse.ArgumentParser(prog='python -m dt_shell.prefetch')
+    parser.add_argument('--parallel', type=int, default=DEFAULT_PARALLEL)
+    parser.add_argument('--max-rate', default=None, help='Average rate of the pulls, e.g. 10M (bytes/s).')
+    parser.add_argument('--registry', default=None, help='e.g. localhost:5000')
+    parser.add_argument('images', nargs='+')
+    parsed = parser.parse_args(args)
+    from .docker_client import get_docker_client
+    settings = {'parallel': parsed.parallel,
+                'max_rate': parse_size(parsed.max_rate) if parsed.max_rate else None,
+                'registry': parsed.registry}
+    prefetch_images(get_docker_client(), parsed.images, settings, is_idle=is_machine_idle)
+
+
+if __name__ == '__main__':
+    prefetch_main()
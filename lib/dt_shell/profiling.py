@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+    CPU profiling of commands: `dts --profile <command ...>` or, in the
+    interactive shell, `profile <command ...>`.
+
+    Two profilers are available:
+
+    - 'sample': a statistical profiler that records the stack of the main
+      thread every few milliseconds (SIGPROF). Its overhead is low enough to
+      leave it on, e.g. in CI with DTSHELL_PROFILE=sample.
+    - 'full' (default for --profile): cProfile, plus the sampler.
+
+    The results go to ~/.dt-shell/profiles/: a .pstats file (full mode, for
+    pstats/snakeviz) and a .collapsed file with one `stack count` line per
+    stack, the input format of flamegraph.pl and speedscope.
+"""
+from __future__ import print_function
+
+import os
+import re
+import signal
+import sys
+import time
+from collections import defaultdict
+
+from . import dtslogger
+from .constants import DTShellConstants
+
+MODES = ['full', 'sample']
+DEFAULT_INTERVAL = 0.005
+TOP_N = 15
+
+
+def get_profiles_dir():
+    d0 = os.path.expanduser(DTShellConstants.ROOT)
+    return os.path.join(d0, 'profiles')
+
+
+def frame_label(code):
+    return '%s:%s:%d' % (os.path.basename(code.co_filename), code.co_name, code.co_firstlineno)
+
+
+class StackSampler(object):
+    """ Samples the stack of the main thread on SIGPROF (CPU time). Unix only. """
+
+    def __init__(self, interval=DEFAULT_INTERVAL):
+        self.interval = interval
+        self.counts = defaultdict(int)
+        self.nsamples = 0
+        self._labels = {}
+        self._previous_handler = None
+
+    @staticmethod
+    def available():
+        return hasattr(signal, 'setitimer') and hasattr(signal, 'SIGPROF')
+
+    def start(self):
+        """ Must be called from the main thread (signal handlers can only be installed there). """
+        self._previous_handler = signal.signal(signal.SIGPROF, self._sample)
+        # restart the system calls interrupted by the samples: Python 2 does not retry
+        # them, and blocking reads, select() and waits would fail with EINTR
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self._previous_handler or signal.SIG_DFL)
+        # what signal.signal() sets (the previous setting cannot be read)
+        signal.siginterrupt(signal.SIGPROF, True)
+
+    def _sample(self, signum, frame):
+        # keep this cheap: it runs every `interval` seconds of CPU time
+        labels = self._labels
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            label = labels.get(code)
+            if label is None:
+                label = labels[code] = frame_label(code)
+            stack.append(label)
+            frame = frame.f_back
+        stack.reverse()
+        self.counts[';'.join(stack)] += 1
+        self.nsamples += 1
+
+    def write_collapsed(self, filename):
+        with open(filename, 'w') as f:
+            for stack, count in sorted(self.counts.items()):
+                f.write('%s %d\n' % (stack, count))
+
+    def top_functions(self, n):
+        """ Returns a list of (label, self samples, total samples), by self samples. """
+        own = defaultdict(int)
+        total = defaultdict(int)
+        for stack, count in self.counts.items():
+            frames = stack.split(';')
+            own[frames[-1]] += count
+            for label in set(frames):
+                total[label] += count
+        ranked = sorted(own.items(), key=lambda x: -x[1])[:n]
+        return [(label, c, total[label]) for label, c in ranked]
+
+
+class ProfileSession(object):
+    """
+        Context manager that profiles the code in its body and writes and
+        summarizes the results at the end (also if the body raises).
+    """
+
+    def __init__(self, command_line, mode='full', interval=DEFAULT_INTERVAL, out=None, top=TOP_N):
+        if mode not in MODES:
+            msg = 'Invalid profiling mode %r; use one of %s.' % (mode, ', '.join(MODES))
+            raise ValueError(msg)
+        self.command_line = command_line
+        self.mode = mode
+        self.top = top
+        self.out = out or sys.stderr
+        self.profiler = None
+        self.sampler = StackSampler(interval) if StackSampler.available() else None
+        self.files = []
+        self.elapsed = None
+
+    def __enter__(self):
+        if self.mode == 'full':
+            import cProfile
+            self.profiler = cProfile.Profile()
+        self.t0 = time.time()
+        if self.sampler is not None:
+            self.sampler.start()
+        if self.profiler is not None:
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.profiler is not None:
+            self.profiler.disable()
+        if self.sampler is not None:
+            self.sampler.stop()
+        self.elapsed = time.time() - self.t0
+        try:
+            self.save()
+            self.report()
+        except (IOError, OSError) as e:
+            print('Could not save the profile: %s' % e, file=self.out)
+        return False
+
+    def save(self):
+        d = get_profiles_dir()
+        if not os.path.exists(d):
+            os.makedirs(d)
+        slug = re.sub(r'[^A-Za-z0-9_-]+', '_', self.command_line.strip())[:60].strip('_') or 'shell'
+        base = os.path.join(d, '%s-%s' % (time.strftime('%Y%m%d-%H%M%S'), slug))
+        if self.profiler is not None:
+            fn = base + '.pstats'
+            self.profiler.dump_stats(fn)
+            self.files.append(fn)
+        if self.sampler is not None:
+            fn = base + '.collapsed'
+            self.sampler.write_collapsed(fn)
+            self.files.append(fn)
+
+    def report(self):
+        out = self.out
+        print('\nProfile of %r: %.3f s wall time.' % (self.command_line, self.elapsed), file=out)
+        if self.profiler is not None:
+            import pstats
+            stats = pstats.Stats(self.profiler, stream=out)
+            stats.sort_stats('tottime').print_stats(self.top)
+        elif self.sampler is not None and self.sampler.nsamples:
+            print('%d samples every %.1f ms of CPU time.' % (self.sampler.nsamples, self.sampler.interval * 1000),
+                  file=out)
+            print('%8s %8s  %s' % ('self%', 'total%', 'function'), file=out)
+            for label, own, total in self.sampler.top_functions(self.top):
+                print('%7.1f%% %7.1f%%  %s' % (100.0 * own / self.sampler.nsamples,
+                                               100.0 * total / self.sampler.nsamples, label), file=out)
+        for fn in self.files:
+            print('Saved %s' % fn, file=out)
+
+
+# the invalid values of the env variable already warned about
+_warned_modes = set()
+
+
+def get_profile_mode_from_env():
+    """
+        Returns the mode set with the env variable DTShellConstants.ENV_PROFILE,
+        or None; an invalid mode disables profiling (with a warning).
+    """
+    mode = os.environ.get(DTShellConstants.ENV_PROFILE, '').strip()
+    if not mode or mode == '0':
+        return None
+    if mode not in MODES:
+        if mode not in _warned_modes:
+            _warned_modes.add(mode)
+            dtslogger.warning('Ignoring invalid %s=%s (use one of %s); not profiling.',
+                              DTShellConstants.ENV_PROFILE, mode, ', '.join(MODES))
+        return None
+    return mode
+
+
+def parse_profile_flag(arguments):
+    """
+        Removes a leading `--profile` or `--profile=<mode>` from the arguments.
+        Returns the tuple (mode or None, remaining arguments); raises
+        ValueError for an unknown mode.
+    """
+    if arguments and arguments[0] == '--profile':
+        return 'full', arguments[1:]
+    if arguments and arguments[0].startswith('--profile='):
+        mode = arguments[0].split('=', 1)[1]
+        if mode not in MODES:
+            msg = 'Invalid profiling mode %r; use one of %s.' % (mode, ', '.join(MODES))
+            raise ValueError(msg)
+        return mode, arguments[1:]
+    return None, arguments
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+    The tree of the commands, as a prefix trie over the command paths.
+
+    The registry is built once per discovery of the commands and is not
+    modified afterwards (a reload builds a new one). Dispatch and completion
+    are a single walk over the tokenized line; the names of the children of
+    each node are kept sorted, so that the completions of a prefix are found
+    by bisection instead of scanning all the sub-commands.
+
+    A command class that redefines DTCommandAbs.do_command (or
+    complete_command) handles the rest of the line itself, as before the
+    registry existed.
+"""
+from __future__ import print_function
+
+from bisect import bisect_left
+from collections import namedtuple
+
+from .dt_command_abs import DTCommandAbs
+from .history import STATUS_NOT_FOUND
+
+# path: tuple of names from the top-level command; names: sorted tuple of the children names
+CommandNode = namedtuple('CommandNode', ['name', 'path', 'klass', 'children', 'names'])
+
+
+def complete_prefix(names, prefix):
+    """ Returns the names (a sorted sequence) that start with prefix. """
+    res = []
+    for i in range(bisect_left(names, prefix), len(names)):
+        if not names[i].startswith(prefix):
+            break
+        res.append(names[i])
+    return res
+
+
+def overrides(klass, name):
+    """ True if the command class redefines the static method `name` of DTCommandAbs. """
+    return getattr(klass, name, None) is not getattr(DTCommandAbs, name)
+
+
+class CommandRegistry(object):
+
+    def __init__(self, root, builtin_names=()):
+        self.root = root
+        # completions of the first word: the commands and the commands of the shell itself
+        self.top_names = tuple(sorted(set(root.names) | set(builtin_names)))
+
+    @staticmethod
+    def build(command_classes, builtin_names=()):
+        """ Builds the registry from the loaded classes (name -> class, with `commands` for the children). """
+
+        def node(name, path, klass):
+            sub = getattr(klass, 'commands', None) or {}
+            children = dict((c, node(c, path + (c,), k)) for c, k in sub.items())
+            return CommandNode(name, path, klass, children, tuple(sorted(children)))
+
+        root = node(None, (), None)._replace(
+            children=dict((c, node(c, (c,), k)) for c, k in command_classes.items()),
+            names=tuple(sorted(command_classes)))
+        return CommandRegistry(root, builtin_names)
+
+    def __contains__(self, name):
+        return name in self.root.children
+
+    def find(self, argv, stop_at=None):
+        """
+            Returns the deepest node matching the beginning of argv and the
+            number of tokens used; with stop_at, stops at the first command
+            that overrides that method.
+        """
+        node = self.root
+        i = 0
+        while i < len(argv) and argv[i] in node.children:
+            node = node.children[argv[i]]
+            i += 1
+            if stop_at is not None and overrides(node.klass, stop_at):
+                break
+        return node, i
+
+    def iter_nodes(self):
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node.klass is not None:
+                yield node
+            stack.extend(node.children[n] for n in reversed(node.names))
+
+    def dispatch(self, shell, argv):
+        """ Runs the command in argv (a list of words, starting with the top-level command). """
+        node, i = self.find(argv, stop_at='do_command')
+        if node is self.root:
+            return
+        if getattr(shell, 'command_path', None) is not None:
+            shell.command_path.extend(node.path)
+        args = argv[i:]
+        if overrides(node.klass, 'do_command'):
+            return node.klass.do_command(node.klass, shell, ' '.join(args))
+        if node.children:
+            if args:
+                shell.command_status = STATUS_NOT_FOUND
+                print('Command `%s` not recognized.\nAvailable sub-commands are:\n\n\t%s' % (
+                    args[0], '\n\t'.join(node.names)))
+            else:
+                print('Available sub-commands are:\n\n\t%s' % '\n\t'.join(node.names))
+            return
+        if args or not getattr(node.klass, 'fake', False):
+            node.klass.command(shell, args)
+
+    def complete(self, shell, text, line, begidx=0, endidx=0):
+        """ Returns the completions of text, the word being typed at the end of line. """
+        all_words = line.split()
+        words = all_words[:-1] if text and all_words else all_words
+        node, i = self.find(words, stop_at='complete_command')
+        if node is self.root:
+            return []
+        node_line = ' '.join(all_words[len(node.path) - 1:])
+        if overrides(node.klass, 'complete_command'):
+            return node.klass.complete_command(node.klass, shell, text, node_line, begidx, endidx)
+        if i < len(words):
+            return []
+        static = node.klass.complete(shell, text, node_line)
+        return [k for k in static if k.startswith(text)] + complete_prefix(node.names, text)
+
+    def complete_top(self, text):
+        return complete_prefix(self.top_names, text)
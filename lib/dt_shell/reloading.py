@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+    Support for reloading the commands in a running shell.
+
+    Each command package is fingerprinted by the names, sizes and mtimes of
+    its Python files; when the fingerprint changes, only the modules of
+    that package are evicted from sys.modules and imported again.
+"""
+import hashlib
+import os
+import sys
+import threading
+
+from . import dtslogger
+
+SKIP_DIRS = ['.git']
+
+
+def get_tree_fingerprint(path):
+    """ Returns a hash of the names, sizes and mtimes of the Python files under path. """
+    h = hashlib.sha1()
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames[:] = sorted(d for d in dirnames if d not in SKIP_DIRS)
+        for f in sorted(filenames):
+            if not f.endswith('.py'):
+                continue
+            fn = os.path.join(dirpath, f)
+            try:
+                st = os.stat(fn)
+            except OSError:
+                continue
+            h.update(('%s %d %r\n' % (fn, st.st_size, st.st_mtime)).encode('utf-8'))
+    return h.hexdigest()
+
+
+def get_commands_fingerprints(commands_path, commands):
+    """ Returns a dict command name -> fingerprint for the top-level commands given. """
+    return dict((c, get_tree_fingerprint(os.path.join(commands_path, c))) for c in commands)
+
+
+def get_lib_packages(commands_path):
+    """ Returns the names of the top-level modules and packages in the `lib` directory. """
+    lib = os.path.join(commands_path, 'lib')
+    if not os.path.isdir(lib):
+        return []
+    names = []
+    for f in os.listdir(lib):
+        if f.endswith('.py'):
+            names.append(f[:-3])
+        elif os.path.isfile(os.path.join(lib, f, '__init__.py')):
+            names.append(f)
+    return names
+
+
+def evict_modules(names, root):
+    """
+        Removes from sys.modules the modules and submodules with the given names
+        that were loaded from files under root. Returns the names evicted.
+    """
+    root = os.path.realpath(root) + os.sep
+    evicted = []
+    for k, mod in list(sys.modules.items()):
+        top = k.split('.', 1)[0]
+        if top not in names:
+            continue
+        if mod is not None:
+            fn = getattr(mod, '__file__', None)
+            if fn is None or not os.path.realpath(fn).startswith(root):
+                continue
+        del sys.modules[k]
+        evicted.append(k)
+    return evicted
+
+
+class CommandsWatcher(threading.Thread):
+    """
+        Polls the fingerprints of the commands tree every `interval` seconds
+        and calls on_change() (from this thread) when they change.
+    """
+
+    def __init__(self, compute_fingerprints, on_change, interval=1.0):
+        threading.Thread.__init__(self, name='dts-commands-watcher')
+        self.daemon = True
+        self.compute_fingerprints = compute_fingerprints
+        self.on_change = on_change
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        last = self.compute_fingerprints()
+        while not self._stop_event.wait(self.interval):
+            try:
+                current = self.compute_fingerprints()
+            except Exception as e:
+                dtslogger.debug('Cannot compute commands fingerprints: %s', e)
+                continue
+            if current != last:
+                last = current
+                self.on_change()
+
+    def stop(self):
+        self._stop_event.set()
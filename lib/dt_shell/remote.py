@@ -1,15 +1,26 @@
+import hashlib
+import httplib
 import json
 import os
+import socket
+import sys
+import threading
 import urllib2
+import urlparse
+from multiprocessing.pool import ThreadPool
 
 import dateutil.parser
 from contracts import raise_wrapped, indent
 
 from . import dtslogger
+from .constants import DTShellConstants
+from .local_cache import write_atomic
 
 
 class Storage(object):
     done = False
+    lock = threading.Lock()
+    pool = None
 
 
 def get_duckietown_server_url():
@@ -43,6 +54,13 @@ class RequestFailed(RequestException):
     """
 
 
+def raise_connection_error(e, msg):
+    # the recent versions of PyContracts want a unicode message (and raise ValueError otherwise)
+    if isinstance(msg, bytes):
+        msg = msg.decode('utf-8', 'replace')
+    raise_wrapped(ConnectionError, e, msg)
+
+
 def make_server_request(token, endpoint, data=None, method='GET', timeout=3):
     """
         Raise RequestFailed or ConnectionError.
@@ -60,17 +78,22 @@ def make_server_request(token, endpoint, data=None, method='GET', timeout=3):
     try:
         res = urllib2.urlopen(req, timeout=timeout)
         data = res.read()
-    except urllib2.URLError as e:
+    except (urllib2.URLError, httplib.HTTPException, socket.error) as e:
         msg = 'Cannot connect to server %s' % url
-        raise_wrapped(ConnectionError, e, msg)
+        raise_connection_error(e, msg)
         raise
 
+    return _decode_answer(url, data)
+
+
+def _decode_answer(url, data):
+    """ Returns the 'result' of an {'ok': ..., 'result': ...} answer, or raises. """
     try:
         result = json.loads(data)
     except ValueError as e:
         msg = 'Cannot read answer from server.'
         msg += '\n\n' + indent(data, '  > ')
-        raise_wrapped(ConnectionError, e, msg)
+        raise_connection_error(e, msg)
         raise
 
     if not isinstance(result, dict) or 'ok' not in result:
@@ -104,10 +127,14 @@ def dtserver_update_challenge(token, queue, challenge_parameters):
     return make_server_request(token, endpoint, data=data, method=method)
 
 
-def dtserver_submit(token, queue, data):
+def dtserver_submit(token, queue, data, files=None):
+    """ The files (e.g. logs, maps) are uploaded first with dtserver_upload_file. """
     endpoint = '/submissions'
     method = 'POST'
+    artifacts = [dtserver_upload_file(token, fn) for fn in files or []]
     data = {'queue': queue, 'parameters': data}
+    if artifacts:
+        data['artifacts'] = artifacts
     return make_server_request(token, endpoint, data=data, method=method)
 
 
@@ -118,16 +145,24 @@ def dtserver_retire(token, submission_id):
     return make_server_request(token, endpoint, data=data, method=method)
 
 
-def dtserver_get_user_submissions(token):
-    """ Returns a dictionary with information about the user submissions """
+def dtserver_get_user_submissions(token, since=None, parse_dates=True):
+    """
+        Returns a dictionary with information about the user submissions
+
+        With `since` (an ISO date), the server may return only the submissions
+        changed at or after it. With parse_dates=False, the dates are left as strings.
+    """
     endpoint = '/submissions'
     method = 'GET'
     data = {}
+    if since is not None:
+        data['since'] = since
     submissions = make_server_request(token, endpoint, data=data, method=method)
 
-    for v in submissions.values():
-        for k in ['date_submitted', 'last_status_change']:
-            v[k] = dateutil.parser.parse(v[k])
+    if parse_dates:
+        for v in submissions.values():
+            for k in ['date_submitted', 'last_status_change']:
+                v[k] = dateutil.parser.parse(v[k])
     return submissions
 
 
@@ -154,3 +189,267 @@ def dtserver_report_job(token, job_id, result, stats, machine_id,
             'evaluator_version': evaluator_version,
             }
     return make_server_request(token, endpoint, data=data, method=method)
+
+
+# Chunked uploads of files (logs, maps, evaluation outputs, ...).
+#
+# The file is split in chunks of UPLOAD_CHUNK_SIZE bytes, addressed by their
+# sha256: the server is asked which chunks it is missing, only those are
+# sent (in parallel, over keep-alive connections) and the file is then
+# committed as the list of its chunks. The chunks already sent are
+# recorded in a journal in ~/.dt-shell/uploads/, so that an interrupted
+# upload restarts where it stopped.
+#
+#     POST /uploads/check          {'chunks': [sha256, ...]} -> {'missing': [sha256, ...]}
+#     PUT  /uploads/chunks/<sha256>  (the bytes of the chunk)
+#     POST /uploads/commit         {'name', 'size', 'sha256', 'chunk_size', 'chunks'} -> {'sha256', ...}
+
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+UPLOAD_PARALLEL = 4
+UPLOAD_TIMEOUT = 60
+UPLOAD_RETRIES = 3
+IDEMPOTENT_METHODS = ['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS']
+
+
+class ConnectionPool(object):
+    """ Keep-alive HTTP(S) connections, shared by the threads and reused across requests. """
+
+    def __init__(self, maxsize=UPLOAD_PARALLEL * 2):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def request(self, method, url, body=None, headers=None, timeout=UPLOAD_TIMEOUT, idempotent=None):
+        """
+            Returns (status, data); raises httplib.HTTPException or socket.error.
+
+            If a reused connection turns out to be closed, the request is sent
+            again on a new one only if it could not have reached the server, or
+            if it is idempotent (by default, according to the method).
+        """
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        parts = urlparse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        while True:
+            conn, reused = self._get(key, timeout)
+            sent = False
+            try:
+                conn.request(method, path, body, headers or {})
+                sent = True
+                res = conn.getresponse()
+                data = res.read()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if reused and (not sent or idempotent):
+                    # the server closed the idle connection; try with a new one
+                    continue
+                raise
+            if res.will_close:
+                conn.close()
+            else:
+                self._put(key, conn)
+            return res.status, data
+
+    def _get(self, key, timeout):
+        with self.lock:
+            conns = self.idle.get(key, [])
+            if conns:
+                conn = conns.pop()
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+        scheme, netloc = key
+        klass = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+        return klass(netloc, timeout=timeout), False
+
+    def _put(self, key, conn):
+        with self.lock:
+            conns = self.idle.setdefault(key, [])
+            if len(conns) < self.maxsize:
+                conns.append(conn)
+                return
+        conn.close()
+
+
+def get_connection_pool():
+    with Storage.lock:
+        if Storage.pool is None:
+            Storage.pool = ConnectionPool()
+        return Storage.pool
+
+
+def make_pooled_request(token, endpoint, data=None, method='GET', body=None, timeout=UPLOAD_TIMEOUT,
+                        idempotent=None):
+    """
+        Like make_server_request, over a pooled connection; `body` is sent as
+        is (application/octet-stream) instead of the JSON of `data`. See
+        ConnectionPool.request() for `idempotent`.
+    """
+    url = get_duckietown_server_url() + endpoint
+    headers = {'X-Messaging-Token': token}
+    if data is not None:
+        body = json.dumps(data)
+        headers['Content-Type'] = 'application/json'
+    elif body is not None:
+        headers['Content-Type'] = 'application/octet-stream'
+    try:
+        status, answer = get_connection_pool().request(method, url, body=body, headers=headers, timeout=timeout,
+                                                       idempotent=idempotent)
+    except (httplib.HTTPException, socket.error) as e:
+        msg = 'Cannot connect to server %s' % url
+        raise_connection_error(e, msg)
+        raise
+    if not 200 <= status < 300:
+        msg = 'Server answered %d for %s' % (status, url)
+        msg += '\n\n' + indent(answer, '  > ')
+        raise ConnectionError(msg)
+    return _decode_answer(url, answer)
+
+
+def get_filesystem_encoding():
+    return sys.getfilesystemencoding() or 'utf-8'
+
+
+def get_upload_journal_filename(filename):
+    d0 = os.path.expanduser(DTShellConstants.ROOT)
+    path = os.path.realpath(filename)
+    if not isinstance(path, bytes):
+        path = path.encode(get_filesystem_encoding())
+    key = hashlib.sha1(path).hexdigest()
+    return os.path.join(d0, 'uploads', key + '.json')
+
+
+def read_upload_journal(filename, size, mtime, chunk_size):
+    """ Returns the journal of a previous upload of the same version of the file, or None. """
+    try:
+        with open(get_upload_journal_filename(filename)) as f:
+            journal = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if [journal.get('size'), journal.get('mtime'), journal.get('chunk_size')] != [size, mtime, chunk_size]:
+        return None
+    return journal
+
+
+def hash_file_chunks(filename, chunk_size):
+    """ Returns (sha256 of the file, list of the sha256 of its chunks). """
+    whole = hashlib.sha256()
+    chunks = []
+    with open(filename, 'rb') as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            whole.update(data)
+            chunks.append(hashlib.sha256(data).hexdigest())
+    return whole.hexdigest(), chunks
+
+
+def dtserver_upload_file(token, filename, chunk_size=UPLOAD_CHUNK_SIZE, parallel=UPLOAD_PARALLEL, progress=None):
+    """
+        Uploads the file in chunks, skipping the chunks that the server
+        already has, and resuming a previous interrupted upload.
+
+        progress(bytes_done, bytes_total) is called as chunks are sent.
+
+        Returns {'name': ..., 'size': ..., 'sha256': ...}, to be passed to the
+        server (e.g. in the parameters of a submission) to refer to the file.
+    """
+    st = os.stat(filename)
+    size, mtime = st.st_size, st.st_mtime
+    journal = read_upload_journal(filename, size, mtime, chunk_size)
+    if journal is None:
+        sha256, chunks = hash_file_chunks(filename, chunk_size)
+        path = os.path.realpath(filename)
+        if isinstance(path, bytes):
+            # only informative
+            path = path.decode(get_filesystem_encoding(), 'replace')
+        journal = {'filename': path, 'size': size, 'mtime': mtime,
+                   'chunk_size': chunk_size, 'sha256': sha256, 'chunks': chunks, 'sent': []}
+    journal_fn = get_upload_journal_filename(filename)
+    write_atomic(journal_fn, json.dumps(journal))
+
+    chunks = journal['chunks']
+    lock = threading.Lock()
+    done = [0]
+
+    def send(item):
+        h, offset = item
+        with open(filename, 'rb') as f:
+            f.seek(offset)
+            data = f.read(chunk_size)
+        if hashlib.sha256(data).hexdigest() != h:
+            raise RequestException('The file %s changed during the upload.' % filename)
+        for attempt in range(UPLOAD_RETRIES):
+            try:
+                make_pooled_request(token, '/uploads/chunks/' + str(h), method='PUT', body=data)
+                break
+            except ConnectionError as e:
+                if attempt == UPLOAD_RETRIES - 1:
+                    raise
+                dtslogger.debug('Retrying chunk %s: %s', h, e)
+        with lock:
+            journal['sent'].append(h)
+            write_atomic(journal_fn, json.dumps(journal))
+            done[0] += len(data)
+            if progress is not None:
+                progress(done[0], size)
+
+    def upload_missing(to_check):
+        """ Sends the chunks in to_check that the server does not have. """
+        missing = set()
+        if to_check:
+            res = make_pooled_request(token, '/uploads/check', data={'chunks': to_check}, method='POST',
+                                      idempotent=True)
+            missing = set(res.get('missing', []))
+        # one upload per distinct missing chunk
+        offsets = {}
+        for i, h in enumerate(chunks):
+            if h in missing and h not in offsets:
+                offsets[h] = i * chunk_size
+        done[0] = size - sum(min(chunk_size, size - o) for o in offsets.values())
+        if progress is not None:
+            progress(done[0], size)
+        if offsets:
+            pool = ThreadPool(max(1, min(parallel, len(offsets))))
+            try:
+                # consume the iterator to propagate the first error
+                for _ in pool.imap_unordered(send, sorted(offsets.items(), key=lambda x: x[1])):
+                    pass
+            finally:
+                pool.terminate()
+        return len(offsets)
+
+    upload_missing(sorted(set(chunks) - set(journal['sent'])))
+    data = {'name': os.path.basename(filename), 'size': size, 'sha256': journal['sha256'],
+            'chunk_size': chunk_size, 'chunks': chunks}
+    try:
+        make_pooled_request(token, '/uploads/commit', data=data, method='POST')
+    except RequestFailed as e:
+        # the server may have dropped chunks sent earlier (e.g. by an interrupted upload): check them all
+        dtslogger.debug('Commit of %s failed (%s); checking all the chunks.', filename, e)
+        if not upload_missing(sorted(set(chunks))):
+            raise
+        make_pooled_request(token, '/uploads/commit', data=data, method='POST')
+    try:
+        os.unlink(journal_fn)
+    except OSError:
+        pass
+    return {'name': data['name'], 'size': size, 'sha256': data['sha256']}
+
+
+def dtserver_report_job_progress(token, job_id, seq, progress, stats, timeout=UPLOAD_TIMEOUT):
+    """
+        Sends partial results of a job still running: `progress` (e.g.
+        {'fraction': 0.4, 'message': ...}) and `stats` (the partial stats,
+        merged by the server into the ones already received). The server
+        ignores a batch whose `seq` is not greater than the last one it
+        received, so a batch can be sent again. See job_progress.py.
+    """
+    endpoint = '/job-progress'
+    method = 'POST'
+    data = {'job_id': job_id, 'seq': seq, 'progress': progress, 'stats': stats}
+    return make_pooled_request(token, endpoint, data=data, method=method, timeout=timeout)
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+    Local index of the submissions of the user, in ~/.dt-shell/submissions.sqlite.
+
+    The index is synchronized incrementally: the server is asked for the
+    submissions changed since the last `last_status_change` seen (included,
+    as several submissions can change at the same time), and only
+    the submissions whose `last_status_change` differs from the stored one
+    are parsed and written. Queries by queue, status and date range use the
+    indexes of the database and work offline; get_user_submissions() says
+    how fresh the answer is.
+
+        index = SubmissionsIndex(token)
+        submissions, freshness = index.get_user_submissions(max_age=60)
+        print(freshness)   # e.g. "synchronized 12 s ago"
+"""
+import calendar
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+import dateutil.parser
+import dateutil.tz
+
+from . import dtslogger
+from .constants import DTShellConstants
+from .remote import ConnectionError, dtserver_get_user_submissions, get_duckietown_server_url
+
+DB_TIMEOUT = 10
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS submissions (
+    account TEXT NOT NULL,
+    submission_id TEXT NOT NULL,
+    queue TEXT,
+    status TEXT,
+    date_submitted REAL,
+    last_status_change REAL,
+    last_status_change_raw TEXT,
+    naive_dates INTEGER,
+    data TEXT NOT NULL,
+    PRIMARY KEY (account, submission_id)
+);
+CREATE INDEX IF NOT EXISTS submissions_queue ON submissions (account, queue, date_submitted);
+CREATE INDEX IF NOT EXISTS submissions_status ON submissions (account, status, date_submitted);
+CREATE INDEX IF NOT EXISTS submissions_date ON submissions (account, date_submitted);
+CREATE TABLE IF NOT EXISTS sync (
+    account TEXT PRIMARY KEY,
+    last_sync REAL,
+    last_status_change_raw TEXT
+);
+'''
+
+DATE_FIELDS = ['date_submitted', 'last_status_change']
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def get_submissions_db_filename():
+    d0 = os.path.expanduser(DTShellConstants.ROOT)
+    return os.path.join(d0, 'submissions.sqlite')
+
+
+def to_timestamp(d):
+    if d.tzinfo is not None:
+        return calendar.timegm(d.utctimetuple()) + d.microsecond / 1e6
+    return (d - EPOCH).total_seconds()
+
+
+def from_timestamp(t, naive):
+    if naive:
+        return EPOCH + datetime.timedelta(seconds=t)
+    return datetime.datetime.fromtimestamp(t, dateutil.tz.tzutc())
+
+
+class Freshness(object):
+    """ How up to date an answer from the index is. """
+
+    def __init__(self, last_sync, synced_now, error=None):
+        self.last_sync = last_sync
+        self.synced_now = synced_now
+        self.error = error
+
+    @property
+    def age(self):
+        return None if self.last_sync is None else max(0.0, time.time() - self.last_sync)
+
+    @property
+    def offline(self):
+        return self.error is not None
+
+    def __str__(self):
+        if self.last_sync is None:
+            s = 'never synchronized'
+        elif self.synced_now:
+            s = 'synchronized now'
+        else:
+            s = 'synchronized %s ago' % format_age(self.age)
+        if self.error is not None:
+            s += ' (offline: %s)' % self.error.split('\n')[0]
+        return s
+
+
+def format_age(seconds):
+    for unit, n in [('d', 86400), ('h', 3600), ('min', 60)]:
+        if seconds >= n:
+            return '%d %s' % (seconds // n, unit)
+    return '%d s' % seconds
+
+
+class SubmissionsIndex(object):
+
+    def __init__(self, token, filename=None, server=None):
+        self.token = token
+        self.filename = filename or get_submissions_db_filename()
+        server = server or get_duckietown_server_url()
+        # the submissions of a user on a server; the token itself is not stored
+        self.account = hashlib.sha1(server + '\n' + token).hexdigest()
+        d = os.path.dirname(self.filename)
+        if not os.path.exists(d):
+            os.makedirs(d)
+        self.db = sqlite3.connect(self.filename, timeout=DB_TIMEOUT)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def get_last_sync(self):
+        row = self.db.execute('SELECT last_sync, last_status_change_raw FROM sync WHERE account = ?',
+                              (self.account,)).fetchone()
+        return row if row is not None else (None, None)
+
+    def sync(self):
+        """ Fetches the submissions changed since the last sync; returns the number of changed ones. """
+        _, since = self.get_last_sync()
+        t0 = time.time()
+        submissions = dtserver_get_user_submissions(self.token, since=since, parse_dates=False)
+        stored = dict(self.db.execute('SELECT submission_id, data FROM submissions WHERE account = ?',
+                                      (self.account,)))
+        rows = []
+        latest = since
+        for submission_id, v in submissions.items():
+            submission_id = str(submission_id)
+            raw = v.get('last_status_change', None)
+            if latest is None or (raw is not None and raw > latest):
+                latest = raw
+            data = json.dumps(v, sort_keys=True)
+            # the ones changed at `since` are sent again: skip them if they are the same
+            if stored.get(submission_id, None) == data:
+                continue
+            dates = [dateutil.parser.parse(v[k]) if v.get(k, None) else None for k in DATE_FIELDS]
+            naive = all(d is None or d.tzinfo is None for d in dates)
+            ts = [to_timestamp(d) if d is not None else None for d in dates]
+            rows.append((self.account, submission_id, v.get('queue', v.get('challenge_name', None)),
+                         v.get('status', None), ts[0], ts[1], raw, int(naive), data))
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO submissions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            self.db.execute('INSERT OR REPLACE INTO sync VALUES (?, ?, ?)', (self.account, t0, latest))
+        dtslogger.debug('Synchronized %d submissions (%d changed) in %.2f s.',
+                        len(submissions), len(rows), time.time() - t0)
+        return len(rows)
+
+    def query(self, queue=None, status=None, since=None, until=None, limit=None):
+        """
+            Returns the submissions (dicts, as returned by the server, with the
+            dates parsed), most recent first, filtered by queue, status and date
+            of submission (datetimes or timestamps).
+        """
+        where = ['account = ?']
+        args = [self.account]
+        for column, op, value in [('queue', '=', queue), ('status', '=', status),
+                                  ('date_submitted', '>=', since), ('date_submitted', '<', until)]:
+            if value is None:
+                continue
+            if isinstance(value, datetime.datetime):
+                value = to_timestamp(value)
+            where.append('%s %s ?' % (column, op))
+            args.append(value)
+        sql = 'SELECT data, date_submitted, last_status_change, naive_dates FROM submissions WHERE %s ' \
+              'ORDER BY date_submitted DESC' % ' AND '.join(where)
+        if limit is not None:
+            sql += ' LIMIT %d' % int(limit)
+        res = []
+        for data, date_submitted, last_status_change, naive in self.db.execute(sql, args):
+            v = json.loads(data)
+            for k, t in zip(DATE_FIELDS, [date_submitted, last_status_change]):
+                if t is not None:
+                    v[k] = from_timestamp(t, naive)
+            res.append(v)
+        return res
+
+    def get_user_submissions(self, max_age=0, offline=False, **filters):
+        """
+            Returns (submissions, Freshness): synchronizes first if the index is
+            older than max_age seconds, unless offline. If the server cannot be
+            reached, answers from the index.
+        """
+        last_sync, _ = self.get_last_sync()
+        synced_now = False
+        error = None
+        if not offline and (last_sync is None or time.time() - last_sync > max_age):
+            try:
+                self.sync()
+                synced_now = True
+                last_sync, _ = self.get_last_sync()
+            except ConnectionError as e:
+                error = str(e)
+        return self.query(**filters), Freshness(last_sync, synced_now, error)
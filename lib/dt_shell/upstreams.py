@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+    URLs of the services that the shell contacts at startup and when
+    updating the commands.
+
+    If a LAN cache server is configured (see cache_server.py), with the env
+    variable DTShellConstants.ENV_CACHE_SERVER or the config key
+    DTShellConstants.CONFIG_CACHE_SERVER, the requests go to it instead.
+"""
+import os
+
+from .constants import DTShellConstants
+
+PYPI_URL = 'https://pypi.org'
+GITHUB_API_URL = 'https://api.github.com'
+PACKAGE_NAME = 'duckietown-shell'
+# path under which the cache server exposes its mirror of the commands
+COMMANDS_MIRROR_PATH = '/commands.git'
+
+
+class Storage(object):
+    config = {}
+
+
+def configure(config):
+    """ Called by the shell once the configuration is loaded. """
+    Storage.config = config
+
+
+def get_cache_server():
+    """ Returns the base URL of the cache server, or None. """
+    V = DTShellConstants.ENV_CACHE_SERVER
+    url = os.environ.get(V, '') or Storage.config.get(DTShellConstants.CONFIG_CACHE_SERVER, None)
+    if url:
+        return url.rstrip('/')
+    return None
+
+
+def get_pypi_json_url(package=PACKAGE_NAME):
+    base = get_cache_server() or PYPI_URL
+    return '%s/pypi/%s/json' % (base, package)
+
+
+def get_github_branch_url(owner, name, branch):
+    base = get_cache_server() or GITHUB_API_URL
+    return '%s/repos/%s/%s/branches/%s' % (base, owner, name, branch)
+
+
+def get_commands_remote_url():
+    server = get_cache_server()
+    if server is not None:
+        return server + COMMANDS_MIRROR_PATH
+    return DTShellConstants.COMMANDS_REMOTE_URL
+
+
+def is_mirror_url(url):
+    return url.rstrip('/').endswith(COMMANDS_MIRROR_PATH)
@@ -3,17 +3,16 @@ from __future__ import print_function
 
 import datetime
 import json
-import os
+import time
 import urllib2
 
-import ruamel
-import ruamel.yaml as yaml
 import termcolor
 from system_cmd import system_cmd_result
 from whichcraft import which
 
 from . import __version__, dtslogger
-from .constants import DTShellConstants
+from .local_cache import PYPI_VERSION, NoCacheAvailable, cache_get, cache_get_with_timestamp, cache_set
+from .upstreams import get_pypi_json_url
 
 
 class CouldNotGetVersion(Exception):
@@ -21,7 +20,7 @@ class CouldNotGetVersion(Exception):
 
 
 def get_last_version_fresh():
-    url = 'https://pypi.org/pypi/duckietown-shell/json'
+    url = get_pypi_json_url()
 
     try:
         req = urllib2.Request(url)
@@ -44,64 +43,27 @@ def get_last_version_fresh():
     except Exception as e:
         raise CouldNotGetVersion(str(e))
 
-def get_cache_filename():
-    d0 = os.path.expanduser(DTShellConstants.ROOT)
-    return os.path.join(d0, 'pypi-cache.yaml')
-
-
-class NoCacheAvailable(Exception):
-    pass
-
-
 def read_cache():
-    try:
-        fn = get_cache_filename()
-        if os.path.exists(fn):
-            data = open(fn).read()
-            interpreted = yaml.load(data, Loader=ruamel.yaml.Loader)
-            version = interpreted['version']
-            dt = interpreted['timestamp']
-            return version, dt
-        else:
-            msg = 'File %s does not exist.' % fn
-            raise NoCacheAvailable(msg)
-    except Exception as e:
-        msg = 'Could not read cache: %s' % e
-        raise NoCacheAvailable(msg)
-
+    """ Returns the tuple (version, datetime) last written; raises NoCacheAvailable. """
+    version, timestamp = cache_get_with_timestamp(PYPI_VERSION)
+    return version, datetime.datetime.fromtimestamp(timestamp)
 
-def write_cache(version, dt):
-    fn = get_cache_filename()
-    d0 = os.path.dirname(fn)
-    if not os.path.exists(d0):
-        os.makedirs(d0)
 
-    with open(fn, 'w') as f:
-        contents = dict(version=version, timestamp=dt)
-        y = yaml.dump(contents)
-        f.write(y)
+def write_cache(version, dt=None):
+    """ dt is the (local) datetime when the version was obtained; default: now. """
+    timestamp = None if dt is None else time.mktime(dt.timetuple()) + dt.microsecond / 1e6
+    cache_set(PYPI_VERSION, version, timestamp=timestamp)
 
 
 def get_last_version():
-    now = datetime.datetime.now()
-    update = False
     try:
-        version, timestamp = read_cache()
-    except NoCacheAvailable:
-        timestamp = now
-        update = True
-
-    if not update:
-        delta = now - timestamp
-        if delta > datetime.timedelta(minutes=10):
-            dtslogger.debug('Version cache is outdated (%s).' % delta)
-            update = True
-
-    if update:
-        dtslogger.debug('Getting last version from PyPI.')
-        version = get_last_version_fresh()
-        write_cache(version, now)
+        return cache_get(PYPI_VERSION)
+    except NoCacheAvailable as e:
+        dtslogger.debug('Version cache not usable: %s', e)
 
+    dtslogger.debug('Getting last version from PyPI.')
+    version = get_last_version_fresh()
+    write_cache(version)
     return version
 
 
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+    Base class of the tests that talk to the challenges stub: one stub per
+    test class (DTSERVER points to it), emptied before each test, and a
+    temporary home per test, so that ~/.dt-shell is empty.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from dt_shell.challenges_stub import ChallengesState, start_challenges_stub
+
+TOKEN = 'dt1-test-token'
+
+
+class StubTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server, cls.url = start_challenges_stub()
+        cls.previous_server = os.environ.get('DTSERVER', None)
+        os.environ['DTSERVER'] = cls.url
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        if cls.previous_server is None:
+            del os.environ['DTSERVER']
+        else:
+            os.environ['DTSERVER'] = cls.previous_server
+
+    def setUp(self):
+        self.server.state = ChallengesState()
+        self.home = tempfile.mkdtemp(prefix='dts-test-')
+        self.previous_home = os.environ.get('HOME', None)
+        os.environ['HOME'] = self.home
+
+    def tearDown(self):
+        if self.previous_home is not None:
+            os.environ['HOME'] = self.previous_home
+        shutil.rmtree(self.home, ignore_errors=True)
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def count_requests(self, prefix):
+        """ The number of requests received by the stub whose 'METHOD /path' starts with prefix. """
+        with self.state.lock:
+            return sum(n for k, n in self.state.counts.items() if k.startswith(prefix))
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from dt_shell.remote import (RequestFailed, dtserver_get_user_submissions, dtserver_report_job, dtserver_retire,
+                             dtserver_submit, dtserver_work_submission)
+from stub_case import StubTestCase, TOKEN
+
+
+class ChallengesStubTest(StubTestCase):
+
+    def test_submission_lifecycle(self):
+        submission_id = dtserver_submit(TOKEN, 'aido-test', {'k': 1})['submission_id']
+        submissions = dtserver_get_user_submissions(TOKEN)
+        self.assertEqual(submissions[str(submission_id)]['status'], 'submitted')
+
+        job = dtserver_work_submission(TOKEN, submission_id, 'machine', 'process', 'v1')
+        self.assertEqual(job['submission_id'], submission_id)
+        self.assertEqual(job['parameters'], {'k': 1})
+        # nothing else to evaluate
+        self.assertIsNone(dtserver_work_submission(TOKEN, None, 'machine', 'process', 'v1')['job_id'])
+
+        dtserver_report_job(TOKEN, job['job_id'], 'success', {'score': 1.0}, 'machine', 'process', 'c', 'v1')
+        self.assertEqual(dtserver_get_user_submissions(TOKEN)[str(submission_id)]['status'], 'success')
+        with self.assertRaises(RequestFailed):
+            dtserver_report_job(TOKEN, job['job_id'], 'success', {}, 'machine', 'process', 'c', 'v1')
+
+    def test_other_users_submissions_are_hidden(self):
+        submission_id = dtserver_submit(TOKEN, 'aido-test', {})['submission_id']
+        self.assertNotIn(str(submission_id), dtserver_get_user_submissions(TOKEN + '-other'))
+        with self.assertRaises(RequestFailed):
+            dtserver_retire(TOKEN + '-other', submission_id)
+
+
+if __name__ == '__main__':
+    unittest.main()
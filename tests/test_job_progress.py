@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import unittest
+
+from dt_shell.job_progress import (JobProgressLocked, JobProgressReporter, get_job_progress_journal_filename,
+                                   get_journal_lock_filename, replay_job_progress)
+from dt_shell.remote import dtserver_report_job, dtserver_submit, dtserver_work_submission
+from stub_case import StubTestCase, TOKEN
+
+
+class JobProgressTest(StubTestCase):
+
+    def setUp(self):
+        StubTestCase.setUp(self)
+        self.dir = os.path.join(self.home, 'job-progress')
+        os.makedirs(self.dir)
+
+    def take_job(self):
+        dtserver_submit(TOKEN, 'aido-test', {})
+        return dtserver_work_submission(TOKEN, None, 'machine', 'process', 'v1')['job_id']
+
+    def write_journal(self, job_id, seq=0, unsent_progress=None, unsent_stats=None):
+        """ What a crashed evaluator leaves behind. """
+        fn = get_job_progress_journal_filename(job_id, self.dir)
+        unsent_progress = unsent_progress or {}
+        unsent_stats = unsent_stats or {}
+        data = {'job_id': job_id, 'seq': seq, 'progress': unsent_progress, 'stats': unsent_stats,
+                'unsent_progress': unsent_progress, 'unsent_stats': unsent_stats}
+        with open(fn, 'w') as f:
+            json.dump(data, f)
+        return fn
+
+    def stub_job(self, job_id):
+        with self.state.lock:
+            return dict(self.state.jobs[job_id])
+
+    def test_replay(self):
+        job_id = self.take_job()
+        fn = self.write_journal(job_id, unsent_progress={'fraction': 0.5}, unsent_stats={'episodes': 3})
+        self.assertEqual(replay_job_progress(TOKEN, self.dir), 1)
+        job = self.stub_job(job_id)
+        self.assertEqual(job['progress'], {'fraction': 0.5})
+        self.assertEqual(job['partial_stats'], {'episodes': 3})
+        self.assertFalse(os.path.exists(fn))
+        # the lock file stays
+        self.assertTrue(os.path.exists(get_journal_lock_filename(fn)))
+        self.assertEqual(replay_job_progress(TOKEN, self.dir), 0)
+
+    def test_replay_with_nothing_to_send(self):
+        fn = self.write_journal(self.take_job())
+        self.assertEqual(replay_job_progress(TOKEN, self.dir), 0)
+        self.assertFalse(os.path.exists(fn))
+
+    def test_replay_of_a_reported_job(self):
+        job_id = self.take_job()
+        dtserver_report_job(TOKEN, job_id, 'success', {}, 'machine', 'process', 'c', 'v1')
+        fn = self.write_journal(job_id, unsent_progress={'fraction': 0.5})
+        # the server refuses it: nothing to retry
+        self.assertEqual(replay_job_progress(TOKEN, self.dir), 0)
+        self.assertFalse(os.path.exists(fn))
+
+    def test_replay_skips_the_journals_of_running_reporters(self):
+        job_id = self.take_job()
+        fn = self.write_journal(job_id, unsent_progress={'fraction': 0.5})
+        reporter = JobProgressReporter(TOKEN, job_id, interval=60, journal_dir=self.dir)
+        try:
+            self.assertEqual(replay_job_progress(TOKEN, self.dir), 0)
+            self.assertTrue(os.path.exists(fn))
+            with self.assertRaises(JobProgressLocked):
+                JobProgressReporter(TOKEN, job_id, interval=60, journal_dir=self.dir)
+        finally:
+            reporter.close()
+
+    def test_restarted_reporter_continues_from_the_journal(self):
+        job_id = self.take_job()
+        self.write_journal(job_id, seq=5, unsent_progress={'fraction': 0.5}, unsent_stats={'episodes': 3})
+        reporter = JobProgressReporter(TOKEN, job_id, interval=60, journal_dir=self.dir)
+        reporter.update_stats(score=1.0)
+        reporter.report('success', {'final': True}, 'machine', 'process', 'c', 'v1')
+        job = self.stub_job(job_id)
+        # the unsent progress of the journal was sent before the final report
+        self.assertEqual(job['progress'], {'fraction': 0.5})
+        self.assertEqual(job['stats'], {'episodes': 3, 'score': 1.0, 'final': True})
+        self.assertEqual(os.listdir(self.dir), ['%s.lock' % job_id])
+
+    def test_new_reporter_after_report(self):
+        job_id = self.take_job()
+        reporter = JobProgressReporter(TOKEN, job_id, interval=60, journal_dir=self.dir)
+        reporter.report('success', {}, 'machine', 'process', 'c', 'v1')
+        # the lock file was kept, and is free
+        JobProgressReporter(TOKEN, job_id, interval=60, journal_dir=self.dir).close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import random
+import threading
+import time
+import unittest
+
+from dt_shell.jobs import (JobManager, STATE_DONE, STATE_FAILED, STATE_KILLED, STATE_QUEUED, STATE_RUNNING)
+
+TIMEOUT = 10
+
+
+def busy_loop(started, stop=None):
+    started.set()
+    while stop is None or not stop.is_set():
+        time.sleep(0.001)
+
+
+def count(n):
+    x = 0
+    for i in range(n):
+        x += i
+    return x
+
+
+class JobManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.jobs = JobManager(max_workers=2)
+
+    def test_result_and_error(self):
+        job = self.jobs.submit('count', count, 10)
+        self.assertTrue(job.wait(TIMEOUT))
+        self.assertEqual((job.state, job.result), (STATE_DONE, 45))
+
+        job = self.jobs.submit('fail', count, None)
+        self.assertTrue(job.wait(TIMEOUT))
+        self.assertEqual(job.state, STATE_FAILED)
+        self.assertIsInstance(job.error, TypeError)
+        self.assertEqual(set(self.jobs.pop_finished()), set(self.jobs.list()))
+
+    def test_kill_running(self):
+        started = threading.Event()
+        job = self.jobs.submit('loop', busy_loop, started)
+        self.assertTrue(started.wait(TIMEOUT))
+        self.assertEqual(job.state, STATE_RUNNING)
+        self.assertTrue(self.jobs.kill(job.id))
+        self.assertTrue(job.wait(TIMEOUT))
+        self.assertEqual(job.state, STATE_KILLED)
+        self.assertIsNone(job.thread)
+        # already finished
+        self.assertFalse(self.jobs.kill(job.id))
+
+    def test_kill_queued(self):
+        started = threading.Event()
+        stop = threading.Event()
+        running = [self.jobs.submit('loop', busy_loop, started, stop) for _ in range(2)]
+        queued = self.jobs.submit('count', count, 10)
+        self.assertEqual(queued.state, STATE_QUEUED)
+        self.assertTrue(self.jobs.kill(queued.id))
+        self.assertEqual(queued.state, STATE_KILLED)
+        stop.set()
+        for job in running:
+            self.assertTrue(job.wait(TIMEOUT))
+            self.assertEqual(job.state, STATE_DONE)
+        # the worker skips the killed job
+        self.assertIsNone(queued.started)
+
+    def test_kill_finishing(self):
+        # killed at any point, also while their bookkeeping is done: the jobs always finish
+        jobs = []
+        for i in range(500):
+            job = self.jobs.submit('count', count, random.randint(0, 2000))
+            time.sleep(random.random() * 0.0005)
+            self.jobs.kill(job.id)
+            jobs.append(job)
+        for job in jobs:
+            self.assertTrue(job.wait(TIMEOUT), job.state)
+            self.assertIn(job.state, [STATE_DONE, STATE_KILLED])
+        # the workers are still alive
+        job = self.jobs.submit('count', count, 10)
+        self.assertTrue(job.wait(TIMEOUT))
+        self.assertEqual(job.result, 45)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import os
+import unittest
+
+from dt_shell import submissions_db
+from dt_shell.remote import dtserver_retire, dtserver_submit
+from stub_case import StubTestCase, TOKEN
+
+
+class SubmissionsIndexTest(StubTestCase):
+
+    def setUp(self):
+        StubTestCase.setUp(self)
+        self.index = submissions_db.SubmissionsIndex(TOKEN, filename=os.path.join(self.home, 'submissions.sqlite'))
+        # what the server returned at each sync
+        self.answers = []
+        get_user_submissions = submissions_db.dtserver_get_user_submissions
+
+        def recording(*args, **kwargs):
+            res = get_user_submissions(*args, **kwargs)
+            self.answers.append(sorted(int(k) for k in res))
+            return res
+
+        submissions_db.dtserver_get_user_submissions = recording
+        self.addCleanup(setattr, submissions_db, 'dtserver_get_user_submissions', get_user_submissions)
+        self.addCleanup(self.index.close)
+
+    def submit(self, queue):
+        return dtserver_submit(TOKEN, queue, {})['submission_id']
+
+    def test_incremental_sync(self):
+        a = self.submit('aido-lf')
+        b = self.submit('aido-lfv')
+        c = self.submit('aido-lf')
+        self.assertEqual(self.index.sync(), 3)
+        self.assertEqual(self.answers[-1], [a, b, c])
+
+        # nothing changed: only the one changed at `since` comes back, and it is skipped
+        self.assertEqual(self.index.sync(), 0)
+        self.assertEqual(self.answers[-1], [c])
+
+        dtserver_retire(TOKEN, a)
+        d = self.submit('aido-lf')
+        self.assertEqual(self.index.sync(), 2)
+        self.assertEqual(self.answers[-1], [a, c, d])
+
+        self.assertEqual([s['submission_id'] for s in self.index.query()], [d, c, b, a])
+        self.assertEqual([s['submission_id'] for s in self.index.query(queue='aido-lf', status='submitted')],
+                         [d, c])
+        self.assertEqual([s['submission_id'] for s in self.index.query(status='retired')], [a])
+
+    def test_max_age_and_offline(self):
+        a = self.submit('aido-lf')
+        submissions, freshness = self.index.get_user_submissions(max_age=60)
+        self.assertTrue(freshness.synced_now)
+        self.assertEqual([s['submission_id'] for s in submissions], [a])
+
+        # recent enough: answered from the index
+        self.submit('aido-lf')
+        submissions, freshness = self.index.get_user_submissions(max_age=60)
+        self.assertFalse(freshness.synced_now)
+        self.assertEqual(len(submissions), 1)
+        self.assertEqual(len(self.answers), 1)
+
+        # the server cannot be reached: answered from the index
+        os.environ['DTSERVER'] = 'http://127.0.0.1:1'
+        self.addCleanup(os.environ.__setitem__, 'DTSERVER', self.url)
+        submissions, freshness = self.index.get_user_submissions(max_age=0)
+        self.assertTrue(freshness.offline)
+        self.assertEqual(len(submissions), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import unittest
+
+from dt_shell.challenges_stub import StubRequestFailed
+from dt_shell.remote import RequestFailed, dtserver_upload_file, get_upload_journal_filename, hash_file_chunks
+from stub_case import StubTestCase, TOKEN
+
+CHUNK_SIZE = 1024
+
+
+class ChunkedUploadTest(StubTestCase):
+
+    def setUp(self):
+        StubTestCase.setUp(self)
+        self.filename = os.path.join(self.home, 'log.bin')
+        # 5 distinct chunks, the last one shorter
+        self.content = os.urandom(4 * CHUNK_SIZE + 100)
+        with open(self.filename, 'wb') as f:
+            f.write(self.content)
+        _, self.chunks = hash_file_chunks(self.filename, CHUNK_SIZE)
+
+    def upload(self):
+        return dtserver_upload_file(TOKEN, self.filename, chunk_size=CHUNK_SIZE, parallel=1)
+
+    def interrupt_after(self, n):
+        """ Uploads the file with the stub refusing all the chunks but the first n. """
+        put_chunk = self.state.put_chunk
+        accepted = set(self.chunks[:n])
+
+        def refusing_put_chunk(user, sha256, body):
+            if sha256 not in accepted:
+                raise StubRequestFailed('Refused.')
+            return put_chunk(user, sha256, body)
+
+        self.state.put_chunk = refusing_put_chunk
+        with self.assertRaises(RequestFailed):
+            self.upload()
+        self.assertEqual(self.read_journal()['sent'], self.chunks[:n])
+        self.state.put_chunk = put_chunk
+
+    def read_journal(self):
+        with open(get_upload_journal_filename(self.filename)) as f:
+            return json.load(f)
+
+    def count_puts(self, h):
+        return self.count_requests('PUT /uploads/chunks/%s' % h)
+
+    def test_upload(self):
+        res = self.upload()
+        self.assertEqual(res['size'], len(self.content))
+        self.assertEqual(self.state.files[res['sha256']], self.content)
+        self.assertEqual([self.count_puts(h) for h in self.chunks], [1] * 5)
+        self.assertFalse(os.path.exists(get_upload_journal_filename(self.filename)))
+
+    def test_resume(self):
+        self.interrupt_after(2)
+        res = self.upload()
+        self.assertEqual(self.state.files[res['sha256']], self.content)
+        # the chunks sent before the interruption are not sent again
+        self.assertEqual([self.count_puts(h) for h in self.chunks[:2]], [1, 1])
+        self.assertFalse(os.path.exists(get_upload_journal_filename(self.filename)))
+
+    def test_resume_after_the_server_lost_chunks(self):
+        self.interrupt_after(2)
+        with self.state.lock:
+            self.state.chunks.clear()
+        res = self.upload()
+        # the commit fails, then all the chunks are checked and the lost ones sent again
+        self.assertEqual(self.state.files[res['sha256']], self.content)
+        self.assertEqual([self.count_puts(h) for h in self.chunks[:2]], [2, 2])
+
+    def test_journal_of_another_version_is_ignored(self):
+        self.interrupt_after(2)
+        with open(self.filename, 'ab') as f:
+            f.write('more')
+        res = self.upload()
+        self.assertEqual(self.state.files[res['sha256']], self.content + 'more')
+
+
+if __name__ == '__main__':
+    unittest.main()